@@ -0,0 +1,152 @@
+"""
+Compression of harvested records.
+
+Records are compressed one by one, so that single records can still be read by id. The codec is detected
+from the magic bytes at the start of each record, so a reader handles uncompressed, gzip and zstd records
+side by side, and a store can be converted gradually.
+
+MARCXML records are small and very repetitive, so zstd does much better with a dictionary trained on a
+sample of records. Dictionaries are kept in `<harvest dir>/dictionaries/<dict id>.zdict`. Each zstd frame
+records the id of the dictionary it was written with, so old records can still be read after a new
+dictionary has been trained.
+
+zstd requires the optional `zstandard` package, installed with the `zstd` extra. gzip works out of the box.
+"""
+from __future__ import annotations
+
+import gzip
+import logging
+import os
+import random
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Union
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None  # type: ignore[assignment]
+
+logger = logging.getLogger(__name__)
+
+CODEC_NONE = 'none'
+CODEC_GZIP = 'gzip'
+CODEC_ZSTD = 'zstd'
+CODECS = [CODEC_NONE, CODEC_GZIP, CODEC_ZSTD]
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# File suffixes used by FileStore
+SUFFIXES = {CODEC_NONE: '', CODEC_GZIP: '.gz', CODEC_ZSTD: '.zst'}
+
+
+class CompressionError(IOError):
+    pass
+
+
+def detect_codec(data: bytes) -> str:
+    if data.startswith(ZSTD_MAGIC):
+        return CODEC_ZSTD
+    if data.startswith(GZIP_MAGIC):
+        return CODEC_GZIP
+    return CODEC_NONE
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise CompressionError('zstd compression requires the zstandard package. Install the zstd extra '
+                               '(uv sync --extra zstd) or use --compression gzip')
+
+
+def dictionary_dir(harvest_dir: Path) -> Path:
+    return Path(harvest_dir).joinpath('dictionaries')
+
+
+def train_dictionary(harvest_dir: Path, samples: Iterable[bytes], size: int = 112640,
+                     max_samples: int = 20000) -> int:
+    """Train a zstd dictionary on a random sample of records and save it in the harvest dir.
+    Returns the dictionary id. The newest dictionary is used by `Codec` for new records."""
+    _require_zstandard()
+    # Reservoir sampling, so we don't need to hold all records in memory
+    sample: List[Union[bytes, bytearray, memoryview]] = []
+    for n, data in enumerate(samples):
+        if len(sample) < max_samples:
+            sample.append(data)
+        else:
+            i = random.randint(0, n)
+            if i < max_samples:
+                sample[i] = data
+    if not sample:
+        raise CompressionError('No records to train a dictionary on')
+    dictionary = zstandard.train_dictionary(size, sample)
+    path = dictionary_dir(harvest_dir)
+    path.mkdir(exist_ok=True)
+    tmp_file = path.joinpath('%d.tmp' % dictionary.dict_id())
+    tmp_file.write_bytes(dictionary.as_bytes())
+    os.replace(tmp_file, path.joinpath('%d.zdict' % dictionary.dict_id()))
+    logger.info('Trained zstd dictionary %d on %d records', dictionary.dict_id(), len(sample))
+    return dictionary.dict_id()
+
+
+class Codec:
+    """Compresses records with the configured codec and decompresses records of any codec.
+
+    zstd compressors and decompressors keep state, so each thread gets its own."""
+
+    def __init__(self, harvest_dir: Path, codec: str = CODEC_NONE, level: Optional[int] = None):
+        if codec not in CODECS:
+            raise ValueError('Unknown compression codec: %s' % codec)
+        self.harvest_dir = Path(harvest_dir)
+        self.codec = codec
+        self.level = level
+        self.dictionaries: Dict[int, 'zstandard.ZstdCompressionDict'] = {}
+        self._local = threading.local()
+        if codec == CODEC_ZSTD:
+            _require_zstandard()
+        self._load_dictionaries()
+
+    @property
+    def suffix(self) -> str:
+        return SUFFIXES[self.codec]
+
+    def _load_dictionaries(self) -> None:
+        if zstandard is None:
+            return
+        path = dictionary_dir(self.harvest_dir)
+        if not path.is_dir():
+            return
+        # Sort by mtime so that the last one is the newest
+        for dict_file in sorted(path.glob('*.zdict'), key=lambda p: p.stat().st_mtime):
+            dictionary = zstandard.ZstdCompressionDict(dict_file.read_bytes())
+            self.dictionaries[dictionary.dict_id()] = dictionary
+
+    def compress(self, data: bytes) -> bytes:
+        if self.codec == CODEC_GZIP:
+            return gzip.compress(data, compresslevel=self.level or 6, mtime=0)
+        if self.codec == CODEC_ZSTD:
+            compressor = getattr(self._local, 'compressor', None)
+            if compressor is None:
+                dictionary = list(self.dictionaries.values())[-1] if self.dictionaries else None
+                compressor = zstandard.ZstdCompressor(level=self.level or 3, dict_data=dictionary)
+                self._local.compressor = compressor
+            return compressor.compress(data)
+        return data
+
+    def decompress(self, data: bytes) -> bytes:
+        codec = detect_codec(data)
+        if codec == CODEC_GZIP:
+            return gzip.decompress(data)
+        if codec == CODEC_ZSTD:
+            _require_zstandard()
+            dict_id = zstandard.get_frame_parameters(data).dict_id
+            if not hasattr(self._local, 'decompressors'):
+                self._local.decompressors = {}
+            decompressor = self._local.decompressors.get(dict_id)
+            if decompressor is None:
+                if dict_id != 0 and dict_id not in self.dictionaries:
+                    raise CompressionError('Record was compressed with unknown zstd dictionary %d' % dict_id)
+                decompressor = zstandard.ZstdDecompressor(dict_data=self.dictionaries.get(dict_id))
+                self._local.decompressors[dict_id] = decompressor
+            return decompressor.decompress(data)
+        return data
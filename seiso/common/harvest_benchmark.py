@@ -0,0 +1,105 @@
+"""
+Offline benchmark of the harvester.
+
+`run_benchmark` starts the local OAI-PMH server from `seiso.common.oai_server` in a child process, so that
+its CPU time and memory are not counted, and harvests it into a temporary dir with one of the harvest
+methods of `OaiPmh`. It reports the throughput, the CPU time used by the harvester process and its peak
+RSS, so that changes to the harvester can be compared without touching the real endpoints.
+"""
+from __future__ import annotations
+
+import multiprocessing
+import resource
+import sys
+import tempfile
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from time import time
+from typing import Callable, Dict, List, Optional
+
+from seiso.common.oai_server import MARCXCHANGE_NS, OaiServerSettings, ServedRecord, serve
+from seiso.services.oai import HarvestSummary, OaiPmh, OaiPmhSettings
+
+HARVEST_METHODS: Dict[str, Callable[[OaiPmh, int], None]] = {
+    'harvest': lambda provider, workers: provider.harvest(),
+    'pipelined': lambda provider, workers: provider.harvest_pipelined(workers=workers),
+    'partitioned': lambda provider, workers: provider.harvest_partitioned(workers),
+}
+
+
+@dataclass
+class BenchmarkResult:
+    method: str
+    records: int
+    deleted: int
+    wall_time: float
+    cpu_time: float  # User + system time of the harvester process, all threads
+    peak_rss_mb: float  # Peak RSS of the harvester process over its lifetime
+    retries: int
+
+    @property
+    def records_per_sec(self) -> float:
+        return (self.records + self.deleted) / max(self.wall_time, 1e-6)
+
+    def serialize(self) -> dict:
+        return {**asdict(self), 'records_per_sec': self.records_per_sec}
+
+    def __str__(self):
+        return '%s: %d records (%d deleted) in %.2fs = %.0f recs/sec. CPU time %.2fs (%.0f%% of wall time), ' \
+               'peak RSS %.0f MB, %d retries' % (
+                   self.method, self.records, self.deleted, self.wall_time, self.records_per_sec, self.cpu_time,
+                   100 * self.cpu_time / max(self.wall_time, 1e-6), self.peak_rss_mb, self.retries)
+
+
+def _cpu_time() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def run_benchmark(records: List[ServedRecord], server_settings: Optional[OaiServerSettings] = None,
+                  method: str = 'harvest', workers: int = 4, store: Optional[str] = None,
+                  compression: Optional[str] = None, work_dir: Optional[Path] = None) -> BenchmarkResult:
+    if method not in HARVEST_METHODS:
+        raise ValueError('Unknown harvest method: %s. Available: %s' % (method, ', '.join(HARVEST_METHODS)))
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    server = multiprocessing.Process(target=serve, args=(records, server_settings or OaiServerSettings()),
+                                     kwargs={'port': 0, 'ready': sender}, daemon=True)
+    server.start()
+    try:
+        if not receiver.poll(60):
+            raise RuntimeError('The OAI-PMH server did not start')
+        url = receiver.recv()
+        with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+            settings = OaiPmhSettings(
+                endpoint=url,
+                metadata_prefix='marcxchange',
+                metadata_schema=MARCXCHANGE_NS,
+                storage_dir=Path(tmp_dir),
+                store=store,
+                compression=compression,
+            )
+            provider = OaiPmh(settings)
+            t0, cpu0 = time(), _cpu_time()
+            HARVEST_METHODS[method](provider, workers)
+            wall_time, cpu_time = time() - t0, _cpu_time() - cpu0
+            summary = HarvestSummary.load(provider.summary_file)
+            for extractor in provider.extractors:
+                extractor.close()
+            return BenchmarkResult(
+                method=method,
+                records=summary.fetched,
+                deleted=summary.deleted,
+                wall_time=wall_time,
+                cpu_time=cpu_time,
+                peak_rss_mb=_peak_rss_mb(),
+                retries=provider.metrics.totals()['retries'],
+            )
+    finally:
+        server.terminate()
+        server.join()
@@ -0,0 +1,770 @@
+"""
+Extractors that build indexes from the records as they are harvested.
+
+An extractor gets every stored and deleted record during the harvest, so its index always matches the
+harvest without another full read of the store. The state is persisted incrementally: `flush` is called at
+every harvest checkpoint, right after the store has been flushed. Records processed after the last
+checkpoint are processed again when a harvest is resumed, so `upsert` and `delete` must be idempotent.
+
+The extractors here keep their state in SQLite databases in `<harvest dir>/indexes`. To add an extractor
+to an existing harvest, build it from the store once with `build_extractors` (`oai index`).
+"""
+from __future__ import annotations
+
+import logging
+import re
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple, Type
+
+from lxml import etree  # type: ignore
+
+from seiso.common.harvest_store import HarvestStore
+from seiso.common.xml import XmlNode
+from seiso.constants import bibbi_uri_namespace
+
+logger = logging.getLogger(__name__)
+
+
+def index_dir(harvest_dir: Path) -> Path:
+    return Path(harvest_dir).joinpath('indexes')
+
+
+class Extractor(ABC):
+    """Base class for in-harvest extractors. Methods may be called from several threads."""
+
+    name: str = ''
+
+    def __init__(self, harvest_dir: Path):
+        self.harvest_dir = Path(harvest_dir)
+        self.lock = threading.RLock()
+
+    @abstractmethod
+    def upsert(self, record_id: str, record: XmlNode, datestamp: Optional[str] = None) -> None:
+        """Add or replace a record. `datestamp` is the OAI datestamp, if known."""
+
+    @abstractmethod
+    def delete(self, record_id: str, datestamp: Optional[str] = None) -> None:
+        """Remove a record. Called for every deleted record in the harvest, also those we never had."""
+
+    def flush(self) -> None:
+        """Persist the state."""
+
+    def clear(self) -> None:
+        """Remove all state, before building the extractor from scratch."""
+
+    def close(self) -> None:
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SqliteExtractor(Extractor):
+    """Extractor keeping its state in `indexes/<name>.sqlite`. Changes are committed on `flush`."""
+
+    schema: str = ''
+
+    def __init__(self, harvest_dir: Path, readonly: bool = False):
+        super().__init__(harvest_dir)
+        self.path = index_dir(harvest_dir).joinpath('%s.sqlite' % self.name)
+        if readonly:
+            self.db = sqlite3.connect('file:%s?mode=ro' % self.path, uri=True, check_same_thread=False)
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.db = sqlite3.connect(str(self.path), check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.executescript(self.schema)
+
+    def execute(self, sql: str, params: Iterable = ()) -> List[tuple]:
+        with self.lock:
+            return self.db.execute(sql, tuple(params)).fetchall()
+
+    def flush(self) -> None:
+        with self.lock:
+            self.db.commit()
+
+    def clear(self) -> None:
+        with self.lock:
+            for (table,) in self.db.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall():
+                self.db.execute('DELETE FROM %s' % table)
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+VOCABULARY_ALIASES = {'hdl': 'handle'}
+IDENTIFIER_URI_PATTERNS = {
+    'viaf': re.compile(r'^https?://(www\.)?viaf\.org/viaf/'),
+    'isni': re.compile(r'^https?://(www\.)?isni\.org/isni/'),
+    'handle': re.compile(r'^https?://hdl\.handle\.net/'),
+    'orcid': re.compile(r'^https?://(www\.)?orcid\.org/'),
+    'wikidata': re.compile(r'^https?://(www\.)?wikidata\.org/(entity|wiki)/'),
+}
+
+
+def normalize_identifier(vocabulary: str, identifier: str) -> Tuple[str, str]:
+    """Normalize a 024 $2/$a pair, so that the same identifier is found whether it's given as a plain id
+    or as a URI, e.g. ('bibbi', 'https://id.bs.no/bibbi/123') -> ('bibbi', '123')."""
+    vocabulary = vocabulary.strip()
+    vocabulary = VOCABULARY_ALIASES.get(vocabulary, vocabulary)
+    identifier = identifier.strip()
+    if vocabulary == 'bibbi':
+        identifier = bibbi_id_from_link(identifier) or identifier
+    elif vocabulary in IDENTIFIER_URI_PATTERNS:
+        identifier = IDENTIFIER_URI_PATTERNS[vocabulary].sub('', identifier).rstrip('/')
+    if vocabulary == 'isni':
+        identifier = re.sub(r'\s+', '', identifier).upper()
+    return vocabulary, identifier
+
+
+class IdentifierIndex(SqliteExtractor):
+    """Reverse index from the identifiers in 024 $a, with the vocabulary from $2, to the records having
+    them, e.g. to find the Noraf records claiming a Bibbi id or an ISNI. The identifiers are normalized
+    with `normalize_identifier` for lookups, while `identifiers` gives them as they are in the records."""
+
+    name = 'identifiers'
+    schema = '''
+        CREATE TABLE IF NOT EXISTS identifiers (
+            record_id TEXT NOT NULL,
+            vocabulary TEXT NOT NULL,
+            identifier TEXT NOT NULL,
+            normalized TEXT
+        );
+        CREATE INDEX IF NOT EXISTS identifiers_record_id ON identifiers (record_id);
+    '''
+
+    def __init__(self, harvest_dir: Path, readonly: bool = False):
+        super().__init__(harvest_dir, readonly)
+        columns = [row[1] for row in self.execute('PRAGMA table_info(identifiers)')]
+        self.normalized = 'normalized' in columns
+        if not readonly:
+            if not self.normalized:
+                self._add_normalized()
+            self.db.execute('DROP INDEX IF EXISTS identifiers_identifier')
+            self.db.execute('CREATE INDEX IF NOT EXISTS identifiers_normalized '
+                            'ON identifiers (vocabulary, normalized, record_id)')
+            self.db.commit()
+        elif not self.normalized:
+            logger.warning('The identifier index in %s is from an older version, and only finds identifiers '
+                           'written exactly as in the records until it is opened for writing', self.path)
+
+    def _add_normalized(self) -> None:
+        """Upgrade an index from before the identifiers were normalized."""
+        logger.info('Normalizing the identifiers in %s', self.path)
+        rows = self.db.execute('SELECT rowid, vocabulary, identifier FROM identifiers').fetchall()
+        self.db.execute('ALTER TABLE identifiers ADD COLUMN normalized TEXT')
+        self.db.executemany('UPDATE identifiers SET vocabulary = ?, normalized = ? WHERE rowid = ?', [
+            normalize_identifier(vocabulary, identifier) + (rowid,) for rowid, vocabulary, identifier in rows
+        ])
+        self.normalized = True
+
+    @staticmethod
+    def extract(record: XmlNode) -> List[Tuple[str, str]]:
+        identifiers = []
+        for datafield in record.all(':datafield[@tag="024"]'):
+            vocabulary = datafield.text_or_none(':subfield[@code="2"]')
+            identifier = datafield.text_or_none(':subfield[@code="a"]')
+            if vocabulary and identifier:
+                identifiers.append((vocabulary.strip(), identifier.strip()))
+        return identifiers
+
+    def upsert(self, record_id: str, record: XmlNode, datestamp: Optional[str] = None) -> None:
+        rows = []
+        for vocabulary, identifier in self.extract(record):
+            vocabulary, normalized = normalize_identifier(vocabulary, identifier)
+            rows.append((record_id, vocabulary, identifier, normalized))
+        with self.lock:
+            self.db.execute('DELETE FROM identifiers WHERE record_id = ?', (record_id,))
+            self.db.executemany('INSERT INTO identifiers VALUES (?, ?, ?, ?)', rows)
+
+    def delete(self, record_id: str, datestamp: Optional[str] = None) -> None:
+        with self.lock:
+            self.db.execute('DELETE FROM identifiers WHERE record_id = ?', (record_id,))
+
+    def identifiers(self, record_id: str) -> List[Tuple[str, str]]:
+        return self.execute('SELECT vocabulary, identifier FROM identifiers WHERE record_id = ?', [record_id])
+
+    def lookup(self, vocabulary: str, identifier: str) -> List[str]:
+        """Ids of the records having the identifier, sorted. The identifier may be given as a plain id or
+        as a URI, e.g. lookup('bibbi', '123') also finds records having https://id.bs.no/bibbi/123."""
+        if not self.normalized:
+            return sorted({row[0] for row in self.execute(
+                'SELECT record_id FROM identifiers WHERE vocabulary = ? AND identifier = ?', [vocabulary, identifier]
+            )})
+        return [row[0] for row in self.execute(
+            'SELECT DISTINCT record_id FROM identifiers WHERE vocabulary = ? AND normalized = ? ORDER BY record_id',
+            normalize_identifier(vocabulary, identifier)
+        )]
+
+
+class VocabularyIndex(SqliteExtractor):
+    """Inverted index from the vocabularies in 024 $2 to the records having identifiers from them, e.g. to
+    find all Noraf records linking to Bibbi without reading the whole harvest. Unlike `IdentifierIndex`,
+    only one row is kept per vocabulary and record, so the index stays small."""
+
+    name = 'vocabularies'
+    schema = '''
+        CREATE TABLE IF NOT EXISTS vocabularies (
+            vocabulary TEXT NOT NULL,
+            record_id TEXT NOT NULL,
+            PRIMARY KEY (vocabulary, record_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS vocabularies_record_id ON vocabularies (record_id);
+    '''
+
+    @staticmethod
+    def extract(record: XmlNode) -> List[str]:
+        vocabularies = []
+        for value in record.all_text(':datafield[@tag="024"]/:subfield[@code="2"]'):
+            value = (value or '').strip()
+            if value and value not in vocabularies:
+                vocabularies.append(value)
+        return vocabularies
+
+    def upsert(self, record_id: str, record: XmlNode, datestamp: Optional[str] = None) -> None:
+        rows = [(vocabulary, record_id) for vocabulary in self.extract(record)]
+        with self.lock:
+            self.db.execute('DELETE FROM vocabularies WHERE record_id = ?', (record_id,))
+            self.db.executemany('INSERT INTO vocabularies VALUES (?, ?)', rows)
+
+    def delete(self, record_id: str, datestamp: Optional[str] = None) -> None:
+        with self.lock:
+            self.db.execute('DELETE FROM vocabularies WHERE record_id = ?', (record_id,))
+
+    def lookup(self, vocabulary: str) -> List[str]:
+        """Ids of the records with identifiers from the vocabulary, sorted."""
+        return [row[0] for row in self.execute(
+            'SELECT record_id FROM vocabularies WHERE vocabulary = ? ORDER BY record_id', [vocabulary]
+        )]
+
+    def vocabularies(self, record_id: str) -> List[str]:
+        return [row[0] for row in self.execute(
+            'SELECT vocabulary FROM vocabularies WHERE record_id = ? ORDER BY vocabulary', [record_id]
+        )]
+
+    def counts(self) -> Dict[str, int]:
+        """Number of records by vocabulary."""
+        return dict(self.execute('SELECT vocabulary, COUNT(*) FROM vocabularies GROUP BY vocabulary'))
+
+
+class NameIndex(SqliteExtractor):
+    """Names from the headings (1XX $a) and the see-from references (4XX $a), with dates from $d.
+
+    Besides the exact lookups, the names and dates are indexed for full-text search with SQLite FTS5, with
+    diacritics folded, so `Bronte` finds `Brontë`. Letters that don't decompose, like ø and æ, are kept as
+    they are. The FTS table only indexes the `names` table (external content), so the names are stored once.
+    """
+
+    name = 'names'
+    schema = '''
+        CREATE TABLE IF NOT EXISTS names (
+            rowid INTEGER PRIMARY KEY,
+            record_id TEXT NOT NULL,
+            tag TEXT NOT NULL,
+            name TEXT NOT NULL,
+            dates TEXT
+        );
+        CREATE INDEX IF NOT EXISTS names_record_id ON names (record_id);
+        CREATE INDEX IF NOT EXISTS names_name ON names (name COLLATE NOCASE);
+        CREATE VIRTUAL TABLE IF NOT EXISTS names_fts USING fts5(
+            name, dates, content = 'names', content_rowid = 'rowid', tokenize = 'unicode61 remove_diacritics 2'
+        );
+    '''
+
+    @staticmethod
+    def extract(record: XmlNode) -> List[Tuple[str, str, Optional[str]]]:
+        names = []
+        for datafield in record.all(':datafield'):
+            tag = datafield.get('tag', '')
+            if tag[:1] not in ('1', '4'):
+                continue
+            name = datafield.text_or_none(':subfield[@code="a"]')
+            if name and name.strip():
+                names.append((tag, name.strip(), datafield.text_or_none(':subfield[@code="d"]')))
+        return names
+
+    @staticmethod
+    def match_query(text: str) -> Optional[str]:
+        """An FTS5 query matching all the words in `text`, in any order. Only the words are kept, and each
+        is quoted, so FTS5 operators and syntax in the text have no effect."""
+        words = re.findall(r'\w+', text)
+        if not words:
+            return None
+        return ' '.join('"%s"' % word for word in words)
+
+    def _delete(self, record_id: str) -> None:
+        # An external content FTS table must be given the old values to remove them from the index
+        self.db.execute('''INSERT INTO names_fts (names_fts, rowid, name, dates)
+                           SELECT 'delete', rowid, name, dates FROM names WHERE record_id = ?''', (record_id,))
+        self.db.execute('DELETE FROM names WHERE record_id = ?', (record_id,))
+
+    def upsert(self, record_id: str, record: XmlNode, datestamp: Optional[str] = None) -> None:
+        names = self.extract(record)
+        with self.lock:
+            self._delete(record_id)
+            for tag, name, dates in names:
+                rowid = self.db.execute('INSERT INTO names (record_id, tag, name, dates) VALUES (?, ?, ?, ?)',
+                                        (record_id, tag, name, dates)).lastrowid
+                self.db.execute('INSERT INTO names_fts (rowid, name, dates) VALUES (?, ?, ?)', (rowid, name, dates))
+
+    def delete(self, record_id: str, datestamp: Optional[str] = None) -> None:
+        with self.lock:
+            self._delete(record_id)
+
+    def lookup(self, name: str) -> List[str]:
+        """Ids of the records with this heading or reference, ignoring case."""
+        return [row[0] for row in self.execute(
+            'SELECT DISTINCT record_id FROM names WHERE name = ? COLLATE NOCASE', [name]
+        )]
+
+    def search(self, name: str, dates: Optional[str] = None, limit: int = 20) -> List[str]:
+        """Ids of the records with a heading or reference containing all the words in `name`, best match
+        first. With `dates`, only records whose 1XX $d contains those words (e.g. a year) are returned."""
+        query = self.match_query(name)
+        if query is None:
+            return []
+        sql = '''SELECT names.record_id, MIN(names_fts.rank) AS best
+                 FROM names_fts JOIN names ON names.rowid = names_fts.rowid
+                 WHERE names_fts MATCH ?'''
+        params: List = ['{name} : (%s)' % query]
+        date_query = self.match_query(dates) if dates else None
+        if date_query:
+            # The dates of the heading apply to the references too
+            sql += ''' AND names.record_id IN (
+                         SELECT names.record_id FROM names_fts JOIN names ON names.rowid = names_fts.rowid
+                         WHERE names_fts MATCH ? AND names.tag LIKE '1%')'''
+            params.append('{dates} : (%s)' % date_query)
+        sql += ' GROUP BY names.record_id ORDER BY best LIMIT ?'
+        return [row[0] for row in self.execute(sql, params + [limit])]
+
+    def clear(self) -> None:
+        with self.lock:
+            self.db.execute('DELETE FROM names')
+            self.db.execute("INSERT INTO names_fts (names_fts) VALUES ('delete-all')")
+
+
+class RecordStats(SqliteExtractor):
+    """Statistics on the harvested records. To make the counters idempotent, one row is kept per record,
+    and the counters are computed from those."""
+
+    name = 'stats'
+    schema = '''
+        CREATE TABLE IF NOT EXISTS records (
+            record_id TEXT PRIMARY KEY,
+            main_tag TEXT,
+            fields INTEGER NOT NULL,
+            bytes INTEGER NOT NULL
+        );
+    '''
+
+    def upsert(self, record_id: str, record: XmlNode, datestamp: Optional[str] = None) -> None:
+        fields = record.all(':datafield')
+        main_tag = next((datafield.get('tag') for datafield in fields
+                         if datafield.get('tag', '').startswith('1')), None)
+        size = len(etree.tostring(record.node))
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)',
+                            (record_id, main_tag, len(fields), size))
+
+    def delete(self, record_id: str, datestamp: Optional[str] = None) -> None:
+        with self.lock:
+            self.db.execute('DELETE FROM records WHERE record_id = ?', (record_id,))
+
+    def counts(self) -> Dict[str, int]:
+        """Number of records by main heading tag (100, 110, ...)."""
+        return {
+            main_tag or 'none': count
+            for main_tag, count in self.execute('SELECT main_tag, COUNT(*) FROM records GROUP BY main_tag')
+        }
+
+    def summary(self) -> dict:
+        records, fields, size = self.execute('SELECT COUNT(*), SUM(fields), SUM(bytes) FROM records')[0]
+        return {'records': records, 'fields': fields or 0, 'bytes': size or 0, 'main_tags': self.counts()}
+
+
+STATUS_LIVE = 'live'
+STATUS_DELETED = 'deleted'
+STATUS_REPLACED = 'replaced'
+
+
+@dataclass
+class RecordStatus:
+    record_id: str
+    status: str  # STATUS_LIVE, STATUS_DELETED or STATUS_REPLACED
+    replaced_by: Optional[str] = None
+    datestamp: Optional[str] = None
+
+    @property
+    def live(self) -> bool:
+        return self.status == STATUS_LIVE
+
+
+class StatusIndex(SqliteExtractor):
+    """The status of every record id seen in the harvest: live, deleted or replaced by another record.
+
+    Unlike the store, the index remembers deleted records, so "deleted" can be told apart from "never
+    existed" without asking the API. OAI-PMH doesn't tell what a deleted record was replaced by, so the
+    replacement is taken from the surviving record, which lists the ids it replaced in 035 $z (cancelled
+    control numbers). A record replaced by a live record is marked as replaced once it has been deleted.
+    """
+
+    name = 'status'
+    schema = '''
+        CREATE TABLE IF NOT EXISTS status (
+            record_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            replaced_by TEXT,
+            datestamp TEXT
+        ) WITHOUT ROWID;
+    '''
+
+    @staticmethod
+    def extract(record: XmlNode) -> List[str]:
+        """Ids of the records replaced by this record."""
+        replaced = []
+        for datafield in record.all(':datafield[@tag="035"]'):
+            for value in datafield.all(':subfield[@code="z"]'):
+                record_id = re.sub(r'^\(.*?\)', '', value.text() or '').strip()
+                if record_id:
+                    replaced.append(record_id)
+        return replaced
+
+    def __init__(self, harvest_dir: Path, readonly: bool = False):
+        super().__init__(harvest_dir, readonly)
+        self.rebuilding = False
+
+    def upsert(self, record_id: str, record: XmlNode, datestamp: Optional[str] = None) -> None:
+        replaced = [old_id for old_id in self.extract(record) if old_id != record_id]
+        with self.lock:
+            if datestamp is None and self.rebuilding:
+                # The store has no datestamps, so keep the one we had before the rebuild
+                row = self.db.execute('SELECT datestamp FROM previous_datestamps WHERE record_id = ?',
+                                      (record_id,)).fetchone()
+                datestamp = row[0] if row else None
+            self.db.execute('INSERT OR REPLACE INTO status VALUES (?, ?, NULL, ?)',
+                            (record_id, STATUS_LIVE, datestamp))
+            for old_id in replaced:
+                self.db.execute(
+                    '''INSERT INTO status VALUES (?, ?, ?, NULL)
+                       ON CONFLICT (record_id) DO UPDATE SET replaced_by = excluded.replaced_by,
+                           status = CASE WHEN status = ? THEN status ELSE excluded.status END''',
+                    (old_id, STATUS_REPLACED, record_id, STATUS_LIVE)
+                )
+
+    def delete(self, record_id: str, datestamp: Optional[str] = None) -> None:
+        with self.lock:
+            self.db.execute(
+                '''INSERT INTO status VALUES (?, ?, NULL, ?)
+                   ON CONFLICT (record_id) DO UPDATE SET datestamp = excluded.datestamp,
+                       status = CASE WHEN replaced_by IS NULL THEN ? ELSE ? END''',
+                (record_id, STATUS_DELETED, datestamp, STATUS_DELETED, STATUS_REPLACED)
+            )
+
+    def clear(self) -> None:
+        """Only the live records can be rebuilt from the store, so keep what we know about deleted ones.
+        The datestamps of the live records are kept aside for `upsert`, since the store doesn't have them."""
+        with self.lock:
+            self.db.execute('CREATE TEMP TABLE IF NOT EXISTS previous_datestamps '
+                            '(record_id TEXT PRIMARY KEY, datestamp TEXT NOT NULL)')
+            self.db.execute('DELETE FROM previous_datestamps')
+            self.db.execute('INSERT INTO previous_datestamps SELECT record_id, datestamp FROM status '
+                            'WHERE status = ? AND datestamp IS NOT NULL', (STATUS_LIVE,))
+            self.db.execute('DELETE FROM status WHERE status = ?', (STATUS_LIVE,))
+            self.rebuilding = True
+
+    def get(self, record_id: str) -> Optional[RecordStatus]:
+        """The status of a record, or None if the record has never been seen in the harvest."""
+        rows = self.execute('SELECT record_id, status, replaced_by, datestamp FROM status WHERE record_id = ?',
+                            [record_id])
+        return RecordStatus(*rows[0]) if rows else None
+
+    def resolve(self, record_id: str) -> Optional[RecordStatus]:
+        """Follow the replacements from a record to the record that replaces it now, which may itself have
+        been deleted since. Returns None if the record has never been seen."""
+        status = self.get(record_id)
+        seen = {record_id}
+        while status is not None and status.replaced_by is not None and status.status == STATUS_REPLACED \
+                and status.replaced_by not in seen:
+            replacement = self.get(status.replaced_by)
+            if replacement is None:
+                break
+            seen.add(replacement.record_id)
+            status = replacement
+        return status
+
+    def counts(self) -> Dict[str, int]:
+        return dict(self.execute('SELECT status, COUNT(*) FROM status GROUP BY status'))
+
+
+BIBBI_RECORD_TYPES = {
+    '100': 'person',
+    '110': 'corporation',
+    '111': 'conference',
+    '130': 'work',
+    '150': 'topic',
+    '151': 'geographic',
+    '155': 'genre',
+}
+BIBBI_LABEL_SUBFIELDS = set('abcdnqxyz')  # Subfields of the heading included in the label
+BIBBI_ID_PREFIXES = ('(bibbi)', '(NO-OsBA)')  # Prefixes of Bibbi ids in $0
+NORAF_ID_PREFIX = '(NO-TrBIB)'
+BIBBI_ITEM_LINK_TAGS = ('100', '110', '111', '600', '610', '611', '700', '710', '711')
+
+
+@dataclass
+class BibbiLinkedItem:
+    item_id: str
+    tag: str  # The field linking the item to the authority, e.g. 100 for main entry and 600 for subject
+    title: Optional[str] = None
+
+
+@dataclass
+class BibbiAuthority:
+    bibbi_id: str
+    record_type: str  # person, corporation, conference, ... (from BIBBI_RECORD_TYPES)
+    tag: str
+    name: str  # 1XX $a
+    label: str  # The full heading
+    dates: Optional[str] = None
+    noraf_id: Optional[str] = None
+    modified: Optional[str] = None
+    references: List[str] = field(default_factory=list)
+
+
+def bibbi_id_from_link(value: str) -> Optional[str]:
+    """The Bibbi id from a $0/$1 link, e.g. `https://id.bs.no/bibbi/123` or `(bibbi)123`."""
+    value = value.strip()
+    if value.startswith(bibbi_uri_namespace):
+        return value[len(bibbi_uri_namespace):] or None
+    for prefix in BIBBI_ID_PREFIXES:
+        if value.startswith(prefix):
+            return value[len(prefix):].strip() or None
+    return None
+
+
+def noraf_id_from_link(value: str) -> Optional[str]:
+    """The Noraf id from `(NO-TrBIB)123` or a Noraf URI ending in the id."""
+    match = re.search(r'(\d+)$', value.strip())
+    return match.group(1) if match else None
+
+
+class BibbiIndex(SqliteExtractor):
+    """Local index of the Bibbi harvest, keyed by Bibbi id, so that read-only checks don't have to query Promus.
+
+    The Bibbi harvest holds both authority records and the bibliographic records (items) using them.
+    From the authority records we keep the heading (1XX), the see-from references (4XX $a) and the link to
+    Noraf, from 024 with $2 noraf, 035 `(NO-TrBIB)` or $0 in the heading. From the items we keep the
+    links to the authorities ($0/$1 in BIBBI_ITEM_LINK_TAGS), so the items using an authority can be listed.
+
+    The OAI-PMH deletions don't tell authorities and items apart, so a deleted id is removed from both.
+    """
+
+    name = 'bibbi'
+    schema = '''
+        CREATE TABLE IF NOT EXISTS authorities (
+            bibbi_id TEXT PRIMARY KEY,
+            record_type TEXT NOT NULL,
+            tag TEXT NOT NULL,
+            name TEXT NOT NULL,
+            label TEXT NOT NULL,
+            dates TEXT,
+            noraf_id TEXT,
+            modified TEXT
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS authorities_noraf_id ON authorities (noraf_id);
+        CREATE TABLE IF NOT EXISTS authority_references (
+            bibbi_id TEXT NOT NULL,
+            tag TEXT NOT NULL,
+            name TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS authority_references_bibbi_id ON authority_references (bibbi_id);
+        CREATE TABLE IF NOT EXISTS item_links (
+            item_id TEXT NOT NULL,
+            bibbi_id TEXT NOT NULL,
+            tag TEXT NOT NULL,
+            title TEXT
+        );
+        CREATE INDEX IF NOT EXISTS item_links_item_id ON item_links (item_id);
+        CREATE INDEX IF NOT EXISTS item_links_bibbi_id ON item_links (bibbi_id);
+    '''
+
+    @staticmethod
+    def is_authority(record: XmlNode) -> bool:
+        leader = record.text_or_none(':leader')
+        if leader and len(leader) > 6:
+            return leader[6] == 'z'
+        return record.first(':datafield[@tag="245"]') is None
+
+    @staticmethod
+    def extract_authority(record_id: str, record: XmlNode) -> Optional[BibbiAuthority]:
+        heading = next((datafield for datafield in record.all(':datafield')
+                        if datafield.get('tag') in BIBBI_RECORD_TYPES), None)
+        if heading is None:
+            return None
+        name = heading.text_or_none(':subfield[@code="a"]')
+        if not name:
+            return None
+        tag = heading.get('tag')
+        label = ' '.join(
+            (subfield.text() or '').strip() for subfield in heading.all(':subfield')
+            if subfield.get('code') in BIBBI_LABEL_SUBFIELDS and (subfield.text() or '').strip()
+        )
+        modified = record.text_or_none(':controlfield[@tag="005"]')
+        authority = BibbiAuthority(
+            bibbi_id=record_id,
+            record_type=BIBBI_RECORD_TYPES[tag],
+            tag=tag,
+            name=name.strip(),
+            label=label,
+            dates=heading.text_or_none(':subfield[@code="d"]'),
+            modified='%s-%s-%s' % (modified[:4], modified[4:6], modified[6:8]) if modified else None,
+        )
+
+        noraf_ids = [
+            noraf_id_from_link(value) for value in heading.all_text(':subfield[@code="0"]')
+            if value and value.strip().startswith(NORAF_ID_PREFIX)
+        ]
+        for datafield in record.all(':datafield[@tag="024"]'):
+            if (datafield.text_or_none(':subfield[@code="2"]') or '').strip() in ('noraf', 'bibsys'):
+                noraf_ids.append(noraf_id_from_link(datafield.text_or_none(':subfield[@code="a"]') or ''))
+        for datafield in record.all(':datafield[@tag="035"]'):
+            value = datafield.text_or_none(':subfield[@code="a"]') or ''
+            if value.startswith(NORAF_ID_PREFIX):
+                noraf_ids.append(noraf_id_from_link(value))
+        authority.noraf_id = next((noraf_id for noraf_id in noraf_ids if noraf_id), None)
+
+        for datafield in record.all(':datafield'):
+            if datafield.get('tag', '').startswith('4'):
+                reference = datafield.text_or_none(':subfield[@code="a"]')
+                if reference and reference.strip():
+                    authority.references.append(reference.strip())
+        return authority
+
+    @staticmethod
+    def extract_links(record: XmlNode) -> List[Tuple[str, str]]:
+        """(Bibbi id, tag) of the authorities linked from an item."""
+        links = []
+        for datafield in record.all(':datafield'):
+            tag = datafield.get('tag')
+            if tag not in BIBBI_ITEM_LINK_TAGS:
+                continue
+            for value in datafield.all_text(':subfield[@code="0"]') + datafield.all_text(':subfield[@code="1"]'):
+                bibbi_id = bibbi_id_from_link(value or '')
+                if bibbi_id and (bibbi_id, tag) not in links:
+                    links.append((bibbi_id, tag))
+        return links
+
+    def upsert(self, record_id: str, record: XmlNode, datestamp: Optional[str] = None) -> None:
+        if not self.is_authority(record):
+            title = record.text_or_none(':datafield[@tag="245"]/:subfield[@code="a"]')
+            rows = [(record_id, bibbi_id, tag, title) for bibbi_id, tag in self.extract_links(record)]
+            with self.lock:
+                self.db.execute('DELETE FROM item_links WHERE item_id = ?', (record_id,))
+                self.db.executemany('INSERT INTO item_links VALUES (?, ?, ?, ?)', rows)
+            return
+        authority = self.extract_authority(record_id, record)
+        with self.lock:
+            self._delete_authority(record_id)
+            if authority is None:
+                return
+            self.db.execute('INSERT INTO authorities VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (
+                authority.bibbi_id, authority.record_type, authority.tag, authority.name, authority.label,
+                authority.dates, authority.noraf_id, authority.modified,
+            ))
+            self.db.executemany('INSERT INTO authority_references VALUES (?, ?, ?)', [
+                (record_id, '4' + authority.tag[1:], reference) for reference in authority.references
+            ])
+
+    def _delete_authority(self, bibbi_id: str) -> None:
+        self.db.execute('DELETE FROM authorities WHERE bibbi_id = ?', (bibbi_id,))
+        self.db.execute('DELETE FROM authority_references WHERE bibbi_id = ?', (bibbi_id,))
+
+    def delete(self, record_id: str, datestamp: Optional[str] = None) -> None:
+        with self.lock:
+            self._delete_authority(record_id)
+            self.db.execute('DELETE FROM item_links WHERE item_id = ?', (record_id,))
+
+    def get(self, bibbi_id: str) -> Optional[BibbiAuthority]:
+        """The authority with its references, or None if there is no such authority."""
+        rows = self.execute('SELECT bibbi_id, record_type, tag, name, label, dates, noraf_id, modified '
+                            'FROM authorities WHERE bibbi_id = ?', [bibbi_id])
+        if not rows:
+            return None
+        authority = BibbiAuthority(*rows[0])
+        authority.references = [row[0] for row in self.execute(
+            'SELECT name FROM authority_references WHERE bibbi_id = ? ORDER BY rowid', [bibbi_id]
+        )]
+        return authority
+
+    def items(self, bibbi_id: str) -> List[BibbiLinkedItem]:
+        """The items linked to an authority."""
+        return [BibbiLinkedItem(*row) for row in self.execute(
+            'SELECT item_id, tag, title FROM item_links WHERE bibbi_id = ? ORDER BY item_id', [bibbi_id]
+        )]
+
+    def lookup_noraf(self, noraf_id: str) -> List[str]:
+        """Ids of the authorities linked to a Noraf record."""
+        return [row[0] for row in self.execute('SELECT bibbi_id FROM authorities WHERE noraf_id = ?', [noraf_id])]
+
+    def noraf_mapping(self, record_types: Optional[Iterable[str]] = None) -> Dict[str, Optional[str]]:
+        """Bibbi id -> Noraf id (or None) for all authorities, optionally only those of the given types."""
+        rows = self.execute('SELECT bibbi_id, record_type, noraf_id FROM authorities')
+        record_types = set(record_types) if record_types is not None else None
+        return {
+            bibbi_id: noraf_id for bibbi_id, record_type, noraf_id in rows
+            if record_types is None or record_type in record_types
+        }
+
+    def counts(self) -> Dict[str, int]:
+        """Number of authorities by type, and the number of linked items."""
+        counts = dict(self.execute('SELECT record_type, COUNT(*) FROM authorities GROUP BY record_type'))
+        counts['items'] = self.execute('SELECT COUNT(DISTINCT item_id) FROM item_links')[0][0]
+        return counts
+
+
+EXTRACTORS: Dict[str, Type[Extractor]] = {
+    extractor.name: extractor for extractor in (
+        IdentifierIndex, VocabularyIndex, NameIndex, RecordStats, StatusIndex, BibbiIndex,
+    )
+}
+
+
+def open_extractors(harvest_dir: Path, names: Iterable[str]) -> List[Extractor]:
+    extractors = []
+    for name in names:
+        if name not in EXTRACTORS:
+            raise ValueError('Unknown extractor: %s. Available: %s' % (name, ', '.join(EXTRACTORS)))
+        extractors.append(EXTRACTORS[name](harvest_dir))
+    return extractors
+
+
+def build_extractors(store: HarvestStore, extractors: List[Extractor], metadata_schema: str,
+                     flush_interval: int = 10000) -> int:
+    """Build the extractors from scratch from the records in the store, e.g. to add an extractor to an
+    existing harvest. Returns the number of records."""
+    parser = etree.XMLParser(remove_blank_text=True)
+    for extractor in extractors:
+        extractor.clear()
+    count = 0
+    for record_id, data in store.scan():
+        record = XmlNode(etree.fromstring(data, parser), metadata_schema)
+        for extractor in extractors:
+            extractor.upsert(record_id, record)
+        count += 1
+        if count % flush_interval == 0:
+            for extractor in extractors:
+                extractor.flush()
+            logger.info('Indexed %d records', count)
+    for extractor in extractors:
+        extractor.flush()
+    return count
@@ -0,0 +1,183 @@
+"""
+Change journal for OAI-PMH harvests.
+
+The harvester appends one line for every record it processes to `journal.tsv` in the harvest dir:
+
+    <sequence number>\t<record id>\t<upsert|delete>\t<datestamp>
+
+Downstream tools use a `JournalConsumer` to read the entries added since their last run, instead of
+rescanning the whole harvest. Each consumer keeps its own cursor in `journal.cursors/<name>.json`.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Generator, Optional
+
+logger = logging.getLogger(__name__)
+
+OP_UPSERT = 'upsert'
+OP_DELETE = 'delete'
+
+
+@dataclass
+class JournalEntry:
+    seq: int
+    record_id: str
+    op: str
+    datestamp: Optional[str] = None
+
+    def serialize(self) -> str:
+        return '%d\t%s\t%s\t%s\n' % (self.seq, self.record_id, self.op, self.datestamp or '')
+
+    @classmethod
+    def parse(cls, line: str) -> JournalEntry:
+        seq, record_id, op, datestamp = line.rstrip('\n').split('\t')
+        return cls(int(seq), record_id, op, datestamp or None)
+
+
+def journal_path(harvest_dir: Path) -> Path:
+    return Path(harvest_dir).joinpath('journal.tsv')
+
+
+def read_journal(path: Path, offset: int = 0) -> Generator[JournalEntry, None, None]:
+    """Read the complete entries of the journal from `offset`, a position it had earlier."""
+    if not path.exists():
+        return
+    with path.open('rb') as fp:
+        fp.seek(offset)
+        for line in fp:
+            if not line.endswith(b'\n'):
+                break
+            yield JournalEntry.parse(line.decode('utf-8'))
+
+
+class HarvestJournal:
+    """Append-only writer for the journal. Safe to use from several threads."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.seq = self._last_seq()
+        self.fp = self.path.open('a', encoding='utf-8')
+
+    def _last_seq(self) -> int:
+        """Find the last sequence number by reading the end of the journal. A torn last line is dropped."""
+        if not self.path.exists():
+            return 0
+        with self.path.open('rb') as fp:
+            size = fp.seek(0, os.SEEK_END)
+            fp.seek(max(0, size - 4096))
+            lines = fp.read().split(b'\n')
+        if lines[-1] != b'':
+            logger.warning('Dropping incomplete last line of journal %s', self.path)
+            with self.path.open('r+b') as fp:
+                fp.truncate(size - len(lines[-1]))
+        for line in reversed(lines[:-1]):
+            if line:
+                return int(line.split(b'\t', 1)[0])
+        return 0
+
+    def append(self, record_id: str, op: str, datestamp: Optional[str] = None) -> int:
+        with self.lock:
+            self.seq += 1
+            self.fp.write(JournalEntry(self.seq, record_id, op, datestamp).serialize())
+            return self.seq
+
+    def flush(self):
+        with self.lock:
+            self.fp.flush()
+
+    def offset(self) -> int:
+        """The current end of the journal, for `read_journal`."""
+        with self.lock:
+            self.fp.flush()
+            return self.path.stat().st_size
+
+    def close(self):
+        with self.lock:
+            self.fp.close()
+
+
+class JournalConsumer:
+    """Reads the journal entries added since the last committed cursor.
+
+    Typical use:
+
+        consumer = JournalConsumer(harvest_dir, 'verify_noraf_bibbi_mappings')
+        changes = consumer.changed_ids()
+        ... process changes ...
+        consumer.commit()
+
+    The cursor is only moved by `commit`, so if the consumer fails, the same changes are returned next time.
+    """
+
+    def __init__(self, harvest_dir: Path, name: str, end_offset: Optional[int] = None):
+        """With `end_offset`, entries after that position are not read, e.g. to stop at the journal position
+        of a snapshot."""
+        self.path = journal_path(harvest_dir)
+        self.end_offset = end_offset
+        self.cursor_file = Path(harvest_dir).joinpath('journal.cursors', '%s.json' % name)
+        self.seq, self.offset = self._load_cursor()
+        self._next_seq, self._next_offset = self.seq, self.offset
+
+    @property
+    def has_cursor(self) -> bool:
+        """False if the consumer has never committed, meaning that it should do a full run."""
+        return self.cursor_file.exists()
+
+    def _load_cursor(self):
+        try:
+            with self.cursor_file.open('r', encoding='utf-8') as fp:
+                data = json.load(fp)
+            return data['seq'], data['offset']
+        except FileNotFoundError:
+            return 0, 0
+        except (ValueError, KeyError):
+            logger.warning('Invalid journal cursor, starting from the beginning: %s', self.cursor_file)
+            return 0, 0
+
+    def entries(self) -> Generator[JournalEntry, None, None]:
+        """Read the entries after the cursor. Only complete lines are read, so entries being written
+        by a running harvest are picked up next time."""
+        if not self.path.exists():
+            return
+        offset = self.offset
+        if offset > self.path.stat().st_size:
+            # The journal has been replaced, so we can't trust the offset, only the sequence number
+            offset = 0
+        with self.path.open('rb') as fp:
+            fp.seek(offset)
+            for line in fp:
+                if not line.endswith(b'\n'):
+                    break
+                if self.end_offset is not None and offset + len(line) > self.end_offset:
+                    break
+                offset += len(line)
+                entry = JournalEntry.parse(line.decode('utf-8'))
+                if entry.seq <= self.seq:
+                    continue
+                self._next_seq, self._next_offset = entry.seq, offset
+                yield entry
+
+    def seek_to_end(self):
+        """Skip all current entries, e.g. before a full run, so that the next run starts from here."""
+        for _ in self.entries():
+            pass
+
+    def changed_ids(self) -> Dict[str, JournalEntry]:
+        """The last journal entry for each record changed since the cursor."""
+        return {entry.record_id: entry for entry in self.entries()}
+
+    def commit(self):
+        """Move the cursor past the entries read so far."""
+        self.cursor_file.parent.mkdir(exist_ok=True)
+        tmp_file = self.cursor_file.with_suffix('.tmp')
+        with tmp_file.open('w', encoding='utf-8') as fp:
+            json.dump({'seq': self._next_seq, 'offset': self._next_offset}, fp)
+        os.replace(tmp_file, self.cursor_file)
+        self.seq, self.offset = self._next_seq, self._next_offset
@@ -0,0 +1,164 @@
+"""
+Performance metrics for OAI-PMH harvests.
+
+For each page we record the request latency, the response size, the number of records, and the time spent
+parsing and writing. The metrics for a harvest run are saved as `metrics.json` in the harvest dir, next to
+`summary.json`, and can also be written as a Prometheus textfile for the node_exporter textfile collector.
+
+The split between request, parse and write time tells whether a slow harvest is limited by the endpoint,
+by our parsing or by the disk.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from pathlib import Path
+from time import time
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PageMetrics:
+    number: int
+    partition: str = ''
+    latency: float = 0.0  # Time until the response headers were received (the whole response when not streaming)
+    bytes: int = 0
+    records: int = 0
+    deleted: int = 0
+    parse_time: float = 0.0  # When streaming, this includes receiving the response body
+    write_time: float = 0.0
+    retries: int = 0
+
+
+def _distribution(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {'mean': 0.0, 'p50': 0.0, 'p90': 0.0, 'p99': 0.0, 'max': 0.0}
+    values = sorted(values)
+
+    def quantile(q: float) -> float:
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    return {
+        'mean': sum(values) / len(values),
+        'p50': quantile(0.5),
+        'p90': quantile(0.9),
+        'p99': quantile(0.99),
+        'max': values[-1],
+    }
+
+
+@dataclass
+class HarvestMetrics:
+    """Metrics for one harvest run. Pages can be added from several threads."""
+    harvest_started: datetime
+    run_started: datetime = field(default_factory=datetime.now)
+    run_ended: Optional[datetime] = None
+    pages: List[PageMetrics] = field(default_factory=list)
+    retries: int = 0  # Retries that can't be attributed to a page
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+    _saved: float = field(default=0.0, repr=False, compare=False)
+
+    def add_page(self, page: PageMetrics):
+        with self.lock:
+            self.pages.append(page)
+
+    def add_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def totals(self) -> dict:
+        with self.lock:
+            pages = list(self.pages)
+        return {
+            'pages': len(pages),
+            'records': sum(page.records for page in pages),
+            'deleted': sum(page.deleted for page in pages),
+            'bytes': sum(page.bytes for page in pages),
+            'request_time': sum(page.latency for page in pages),
+            'parse_time': sum(page.parse_time for page in pages),
+            'write_time': sum(page.write_time for page in pages),
+            'retries': sum(page.retries for page in pages) + self.retries,
+        }
+
+    def serialize(self) -> dict:
+        with self.lock:
+            pages = list(self.pages)
+        end = self.run_ended or datetime.now()
+        return {
+            'harvest_started': self.harvest_started.isoformat(),
+            'run_started': self.run_started.isoformat(),
+            'run_ended': self.run_ended.isoformat() if self.run_ended else None,
+            'elapsed': (end - self.run_started).total_seconds(),
+            'totals': self.totals(),
+            'page_latency': _distribution([page.latency for page in pages]),
+            'page_bytes': _distribution([page.bytes for page in pages]),
+            'records_per_page': _distribution([page.records + page.deleted for page in pages]),
+            'parse_time': _distribution([page.parse_time for page in pages]),
+            'write_time': _distribution([page.write_time for page in pages]),
+            'pages': [asdict(page) for page in pages],
+        }
+
+    def summary(self) -> str:
+        """One line saying where the time went."""
+        totals = self.totals()
+        total_time = max(totals['request_time'] + totals['parse_time'] + totals['write_time'], 1e-6)
+        return 'Harvest time: requests %.0f%%, parsing %.0f%%, writing %.0f%% (%d pages, %.1f MB, %d retries)' % (
+            100 * totals['request_time'] / total_time,
+            100 * totals['parse_time'] / total_time,
+            100 * totals['write_time'] / total_time,
+            totals['pages'],
+            totals['bytes'] / 1e6,
+            totals['retries'],
+        )
+
+    def save(self, dest: Path, min_interval: float = 0.0):
+        """Save the metrics as JSON. With `min_interval`, the file is only written if it's older than that,
+        since the per-page list can get long."""
+        if time() - self._saved < min_interval:
+            return
+        tmp_file = dest.with_suffix('.tmp')
+        with tmp_file.open('w', encoding='utf-8') as fp:
+            json.dump(self.serialize(), fp, indent=2)
+        os.replace(tmp_file, dest)
+        self._saved = time()
+
+    def write_prometheus(self, dest: Path, source: str):
+        """Write the metrics in the Prometheus text format. The file is replaced atomically, as required
+        by the textfile collector."""
+        data = self.serialize()
+        totals = data['totals']
+        labels = '{source="%s"}' % source
+        lines: List[str] = []
+
+        def gauge(name: str, help_text: str, value, extra_labels: str = ''):
+            if not any(line.startswith('# TYPE %s ' % name) for line in lines):
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s gauge' % name)
+            label_str = labels if not extra_labels else labels[:-1] + ',' + extra_labels + '}'
+            lines.append('%s%s %s' % (name, label_str, value))
+
+        gauge('oai_harvest_run_start_timestamp_seconds', 'Start time of the last harvest run.',
+              self.run_started.timestamp())
+        gauge('oai_harvest_run_duration_seconds', 'Duration of the last harvest run.', data['elapsed'])
+        gauge('oai_harvest_run_pages', 'Pages fetched in the last harvest run.', totals['pages'])
+        gauge('oai_harvest_run_records', 'Records fetched in the last harvest run.', totals['records'])
+        gauge('oai_harvest_run_deleted_records', 'Deleted records fetched in the last harvest run.', totals['deleted'])
+        gauge('oai_harvest_run_response_bytes', 'Response bytes received in the last harvest run.', totals['bytes'])
+        gauge('oai_harvest_run_retries', 'Retried requests in the last harvest run.', totals['retries'])
+        for stage, key in [('request', 'request_time'), ('parse', 'parse_time'), ('write', 'write_time')]:
+            gauge('oai_harvest_run_stage_seconds', 'Time spent in each stage in the last harvest run.',
+                  totals[key], 'stage="%s"' % stage)
+        for quantile in ['p50', 'p90', 'p99']:
+            gauge('oai_harvest_run_page_latency_seconds', 'Page request latency in the last harvest run.',
+                  data['page_latency'][quantile], 'quantile="0.%s"' % quantile[1:])
+
+        tmp_file = dest.with_name('.%s.tmp' % dest.name)
+        with tmp_file.open('w', encoding='utf-8') as fp:
+            fp.write('\n'.join(lines) + '\n')
+        os.replace(tmp_file, dest)
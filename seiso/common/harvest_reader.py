@@ -0,0 +1,215 @@
+"""
+Reading the records of a harvest.
+
+`HarvestReader` reads the records from the store of a harvest dir and decodes them in a pool of worker
+processes, so that consumers don't have to walk the store and parse the XML on their own. The store is
+read in the calling process and the records are sent to the workers in chunks, to keep the overhead of
+passing them between processes low. The results are yielded in store order, or as they become ready
+with `ordered=False`, which keeps the workers busy even if some chunks are slower than others.
+
+With `map_ids`, the workers read the records from the store themselves, so that reading and decompressing
+the records is spread over the workers too, and only the record ids are sent to them. That is the faster
+option when the calling process would otherwise be busy just reading the store.
+
+The functions run in the workers must be picklable, i.e. defined at module level (or `functools.partial`
+objects of those).
+"""
+from __future__ import annotations
+
+import logging
+import os
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, as_completed, wait
+from datetime import date
+from functools import partial
+from pathlib import Path
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple, TypeVar
+
+from lxml import etree  # type: ignore
+
+from seiso.common.harvest_store import HarvestStore, open_store
+from seiso.common.interfaces import NorafRecord
+from seiso.common.noraf_record import NorafXmlRecord
+from seiso.common.xml import XmlNode
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+C = TypeVar('C')
+
+MARCXCHANGE_NS = 'info:lc/xmlns/marcxchange-v1'
+
+# The fields of `NorafRecord` that can be extracted with `record_fields`
+RECORD_FIELDS = ['id', 'type', 'name', 'dates', 'alt_names', 'other_ids', 'created', 'modified', 'gender',
+                 'nationality', 'country_codes']
+
+_parser = etree.XMLParser(remove_blank_text=True)
+
+
+def parse_noraf_record(record_id: str, data: bytes, metadata_schema: str = MARCXCHANGE_NS) -> Optional[NorafRecord]:
+    """Parse a stored record. Returns None for records that are neither persons nor corporations, or
+    that can't be parsed."""
+    try:
+        return NorafXmlRecord.parse(XmlNode(etree.fromstring(data, _parser), metadata_schema))
+    except Exception as exc:  # Broken records shouldn't stop a bulk read
+        logger.warning('Failed to parse record %s: %s', record_id, exc)
+        return None
+
+
+def record_fields(record: NorafRecord, fields: Sequence[str]) -> Dict[str, object]:
+    """Selected fields of a record as JSON-serializable values."""
+    values: Dict[str, object] = {}
+    for name in fields:
+        value: object
+        if name == 'type':
+            value = type(record).__name__.replace('Noraf', '').replace('Record', '').lower()
+        else:
+            value = getattr(record, name, None)
+        if isinstance(value, date):
+            value = value.isoformat()
+        values[name] = value
+    return values
+
+
+def extract_record_fields(record_id: str, data: bytes, fields: Sequence[str],
+                          metadata_schema: str = MARCXCHANGE_NS) -> Optional[Dict[str, object]]:
+    record = parse_noraf_record(record_id, data, metadata_schema)
+    if record is None:
+        return None
+    return record_fields(record, fields)
+
+
+def _map_chunk(func: Callable[[str, bytes], Optional[T]], chunk: List[Tuple[str, bytes]]) -> List[T]:
+    results = []
+    for record_id, data in chunk:
+        result = func(record_id, data)
+        if result is not None:
+            results.append(result)
+    return results
+
+
+# Stores opened by `_map_stored_chunk`, one per process and harvest dir. The pid is part of the key, so that
+# a forked worker doesn't share the file handles of a store opened in its parent.
+_stores: Dict[Tuple[int, str], HarvestStore] = {}
+
+
+def _process_store(harvest_dir: str) -> HarvestStore:
+    key = (os.getpid(), harvest_dir)
+    if key not in _stores:
+        _stores[key] = open_store(Path(harvest_dir), readonly=True)
+    return _stores[key]
+
+
+def _map_stored_chunk(harvest_dir: str, func: Callable[[str, bytes], Optional[T]], record_ids: List[str]) -> List[T]:
+    """Read the records from the store and map them. Records missing from the store are skipped."""
+    store = _process_store(harvest_dir)
+    results = []
+    for record_id in record_ids:
+        data = store.get(record_id)
+        if data is None:
+            continue
+        result = func(record_id, data)
+        if result is not None:
+            results.append(result)
+    return results
+
+
+class HarvestReader:
+    """Reads the records of a harvest dir, decoding them in `workers` processes (default: one per CPU).
+    With `workers=0`, everything runs in the calling process."""
+
+    def __init__(self, harvest_dir: Path, metadata_schema: str = MARCXCHANGE_NS, workers: Optional[int] = None,
+                 chunk_size: int = 500, ordered: bool = True):
+        self.harvest_dir = Path(harvest_dir)
+        self.metadata_schema = metadata_schema
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.chunk_size = chunk_size
+        self.ordered = ordered
+
+    def raw(self) -> Iterator[Tuple[str, bytes]]:
+        """Yield (id, xml) for every record, without parsing."""
+        with open_store(self.harvest_dir, readonly=True) as store:
+            yield from store.scan()
+
+    def chunks(self) -> Iterator[List[Tuple[str, bytes]]]:
+        chunk: List[Tuple[str, bytes]] = []
+        for item in self.raw():
+            chunk.append(item)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def id_chunks(self, record_ids: Optional[Iterable[str]] = None) -> Iterator[List[str]]:
+        if record_ids is None:
+            with open_store(self.harvest_dir, readonly=True) as store:
+                record_ids = list(store.ids())
+        chunk: List[str] = []
+        for record_id in record_ids:
+            chunk.append(record_id)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def map(self, func: Callable[[str, bytes], Optional[T]]) -> Iterator[T]:
+        """Yield `func(id, xml)` for every record, skipping None results. `func` runs in the worker
+        processes, so it must be picklable."""
+        return self._map_chunks(partial(_map_chunk, func), self.chunks())
+
+    def map_ids(self, func: Callable[[str, bytes], Optional[T]],
+                record_ids: Optional[Iterable[str]] = None) -> Iterator[T]:
+        """Like `map`, but the workers read the records from the store, given chunks of record ids. Maps
+        the records with the given ids (skipping those not in the store), or all records."""
+        harvest_dir = str(self.harvest_dir)
+        try:
+            yield from self._map_chunks(partial(_map_stored_chunk, harvest_dir, func), self.id_chunks(record_ids))
+        finally:
+            # With workers=0 the store was opened in this process
+            store = _stores.pop((os.getpid(), harvest_dir), None)
+            if store is not None:
+                store.close()
+
+    def _map_chunks(self, work: Callable[[C], List[T]], chunks: Iterator[C]) -> Iterator[T]:
+        """Run `work` on every chunk in the worker processes, and yield the results."""
+        if self.workers <= 0:
+            for chunk in chunks:
+                yield from work(chunk)
+            return
+
+        # Bound the number of chunks in flight, so we don't read the whole store into memory when the
+        # workers or the consumer can't keep up
+        max_pending = self.workers * 2
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            if self.ordered:
+                queue: Deque[Future] = deque()
+                for chunk in chunks:
+                    queue.append(executor.submit(work, chunk))
+                    if len(queue) >= max_pending:
+                        yield from queue.popleft().result()
+                while queue:
+                    yield from queue.popleft().result()
+            else:
+                pending: Set[Future] = set()
+                for chunk in chunks:
+                    pending.add(executor.submit(work, chunk))
+                    if len(pending) >= max_pending:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            yield from future.result()
+                for future in as_completed(pending):
+                    yield from future.result()
+
+    def records(self) -> Iterator[NorafRecord]:
+        """Yield the parsed records, see `parse_noraf_record`."""
+        return self.map(partial(parse_noraf_record, metadata_schema=self.metadata_schema))
+
+    def fields(self, fields: Sequence[str]) -> Iterator[Dict[str, object]]:
+        """Yield selected fields of the parsed records, see `record_fields`. The fields are selected in the
+        workers, so only those are sent back to the calling process."""
+        return self.map(partial(extract_record_fields, fields=list(fields), metadata_schema=self.metadata_schema))
+
+    def __iter__(self) -> Iterator[NorafRecord]:
+        return self.records()
@@ -0,0 +1,230 @@
+"""
+Incremental scans of a harvest.
+
+Some tools find the records they need by reading the whole harvest and checking every record, e.g. for
+`>bibbi<`. `ScanCache` remembers which records matched, together with what is needed to tell whether a
+record may have changed since, so that the next scan only reads the records that did:
+
+* For a `FileStore`, the mtime of every shard dir, and the mtime and size of every record file. The store
+  replaces record files rather than rewriting them, so the dir mtime changes whenever a record in it is
+  added, changed or removed, and shards with an unchanged mtime are not even listed file by file. In a
+  changed shard, only files with a new mtime or size are read.
+* For a `SegmentStore`, how far each segment has been scanned and the offsets of the matching records in
+  it. The segments are append-only, so only the new end of each segment is read. Whether a match is still
+  the current version of the record is looked up in the segment index.
+
+Timestamps within `MTIME_SLACK` of the scan are not trusted, since a change in the same clock tick
+wouldn't change them. The cache is kept in SQLite, since it holds a row for every record file.
+"""
+from __future__ import annotations
+
+import inspect
+import logging
+import os
+import sqlite3
+from functools import partial
+from pathlib import Path
+from time import time_ns
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from seiso.common.harvest_reader import HarvestReader
+from seiso.common.harvest_store import SNAPSHOTS_DIR, FileStore, SegmentStore
+
+logger = logging.getLogger(__name__)
+
+MTIME_SLACK = 2 * 10 ** 9  # Nanoseconds
+
+
+def _matching_id(func: Callable[[str, bytes], Optional[object]], record_id: str, data: bytes) -> Optional[str]:
+    return record_id if func(record_id, data) is not None else None
+
+
+class ScanCache:
+    """Cache of the records in a harvest matching `func(record_id, data)`, i.e. for which it doesn't
+    return None. The cache is tied to the function, and starts over if it's used with another one. The
+    function is identified by its module and name, so lambdas, nested functions and `partial` objects,
+    which can't be told apart that way, need an explicit `key` for what they match.
+
+    The cached file stats are valid for both the live store and its snapshots, which share the files
+    through hard links, so the same cache can be used to scan either."""
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS dirs (
+            dir TEXT PRIMARY KEY,
+            mtime_ns INTEGER
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS files (
+            dir TEXT NOT NULL,
+            name TEXT NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            matched INTEGER NOT NULL,
+            PRIMARY KEY (dir, name)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS segments (
+            segment INTEGER PRIMARY KEY,
+            size INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS segment_matches (
+            segment INTEGER NOT NULL,
+            offset INTEGER NOT NULL,
+            PRIMARY KEY (segment, offset)
+        ) WITHOUT ROWID;
+    '''
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.path))
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(self.schema)
+        self.read = 0  # Records read by the last scan
+
+    def close(self) -> None:
+        self.db.commit()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def cache_key(func: Callable, key: Optional[str] = None) -> str:
+        if key is not None:
+            return key
+        if not inspect.isfunction(func) or '<' in func.__qualname__:
+            raise ValueError('The scan cache can only tell module-level functions apart by their name. '
+                             'Pass a key identifying what %r matches' % func)
+        return '%s.%s' % (func.__module__, func.__qualname__)
+
+    def _check_key(self, key: str) -> None:
+        rows = self.db.execute("SELECT value FROM meta WHERE key = 'func'").fetchall()
+        if rows and rows[0][0] == key:
+            return
+        if rows:
+            logger.info('The scan cache %s was made for another function, starting over', self.path)
+        for table in ('dirs', 'files', 'segments', 'segment_matches'):
+            self.db.execute('DELETE FROM %s' % table)
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('func', ?)", (key,))
+
+    def scan(self, reader: HarvestReader, func: Callable[[str, bytes], Optional[object]],
+             key: Optional[str] = None) -> List[str]:
+        """Ids of the records in the harvest read by `reader` matching `func`, sorted. For a file store, the
+        changed records are read with the reader, in its worker processes, so `func` must be picklable.
+        `key` identifies the function in the cache, and is required unless it's a module-level function;
+        change it when the function changes."""
+        self._check_key(self.cache_key(func, key))
+        self.read = 0
+        if SegmentStore.exists(reader.harvest_dir):
+            matched = self._scan_segments(reader.harvest_dir, func)
+        else:
+            matched = self._scan_files(reader, func)
+        self.db.commit()
+        logger.info('Scanned %d changed records, found %d matching records in total', self.read, len(matched))
+        return sorted(matched)
+
+    # ------------------------------------------------------------------------------------------------
+
+    def _scan_files(self, reader: HarvestReader, func: Callable) -> Set[str]:
+        root = str(reader.harvest_dir)
+        store = FileStore(reader.harvest_dir, readonly=True)
+        suffixes = tuple(store.suffixes)
+        started = time_ns()
+        cached_dirs: Dict[str, Optional[int]] = dict(self.db.execute('SELECT dir, mtime_ns FROM dirs'))
+        seen_dirs = set()
+        matched: Set[str] = set()
+        to_scan: Dict[str, Tuple[str, str, int, int]] = {}  # record id -> (dir, name, mtime, size)
+
+        for dirpath, dirnames, filenames in os.walk(root):
+            if dirpath == root and SNAPSHOTS_DIR in dirnames:
+                dirnames.remove(SNAPSHOTS_DIR)
+            names = [name for name in filenames if name.endswith(suffixes)]
+            if not names:
+                continue
+            rel_dir = os.path.relpath(dirpath, root)
+            seen_dirs.add(rel_dir)
+            dir_mtime = os.stat(dirpath).st_mtime_ns
+            trusted_mtime = dir_mtime if dir_mtime < started - MTIME_SLACK else None
+
+            if cached_dirs.get(rel_dir) is not None and cached_dirs[rel_dir] == dir_mtime:
+                matched.update(store.record_id(Path(name)) for (name,) in self.db.execute(
+                    'SELECT name FROM files WHERE dir = ? AND matched = 1', (rel_dir,)
+                ))
+                continue
+
+            cached_files = {
+                name: (mtime, size, was_matched) for name, mtime, size, was_matched in self.db.execute(
+                    'SELECT name, mtime_ns, size, matched FROM files WHERE dir = ?', (rel_dir,)
+                )
+            }
+            rows = []
+            for name in names:
+                try:
+                    stat = os.stat(os.path.join(dirpath, name))
+                except FileNotFoundError:
+                    continue
+                # A recent mtime is stored as -1, so the file is read again next time
+                mtime = stat.st_mtime_ns if stat.st_mtime_ns < started - MTIME_SLACK else -1
+                cached = cached_files.get(name)
+                if cached is not None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+                    rows.append((rel_dir, name, mtime, stat.st_size, cached[2]))
+                    if cached[2]:
+                        matched.add(store.record_id(Path(name)))
+                else:
+                    to_scan[store.record_id(Path(name))] = (rel_dir, name, mtime, stat.st_size)
+            self.db.execute('DELETE FROM files WHERE dir = ?', (rel_dir,))
+            self.db.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?)', rows)
+            self.db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)', (rel_dir, trusted_mtime))
+
+        for rel_dir in set(cached_dirs) - seen_dirs:
+            self.db.execute('DELETE FROM dirs WHERE dir = ?', (rel_dir,))
+            self.db.execute('DELETE FROM files WHERE dir = ?', (rel_dir,))
+
+        if to_scan:
+            new_matches = set(reader.map_ids(partial(_matching_id, func), list(to_scan)))
+            self.db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)', [
+                (rel_dir, name, mtime, size, int(record_id in new_matches))
+                for record_id, (rel_dir, name, mtime, size) in to_scan.items()
+            ])
+            matched.update(new_matches)
+            self.read = len(to_scan)
+        return matched
+
+    def _scan_segments(self, harvest_dir: Path, func: Callable) -> Set[str]:
+        store = SegmentStore(harvest_dir, readonly=True)
+        cached: Dict[int, int] = dict(self.db.execute('SELECT segment, size FROM segments'))
+        segments = store.segments()
+
+        for segment in set(cached) - set(segments):
+            # Removed by compaction
+            self.db.execute('DELETE FROM segments WHERE segment = ?', (segment,))
+            self.db.execute('DELETE FROM segment_matches WHERE segment = ?', (segment,))
+
+        for segment in segments:
+            size = store.segment_path(segment).stat().st_size
+            offset = cached.get(segment, 0)
+            if offset > size:
+                # Not the segment we scanned, e.g. the shorter copy in a snapshot
+                self.db.execute('DELETE FROM segment_matches WHERE segment = ?', (segment,))
+                offset = 0
+            if offset == size:
+                continue
+            rows = []
+            for record_id, data_offset, end_offset, data in store.read_segment(segment, offset):
+                self.read += 1
+                if func(record_id, data) is not None:
+                    rows.append((segment, data_offset))
+                offset = end_offset
+            self.db.executemany('INSERT OR REPLACE INTO segment_matches VALUES (?, ?)', rows)
+            self.db.execute('INSERT OR REPLACE INTO segments VALUES (?, ?)', (segment, offset))
+
+        matches = set(self.db.execute('SELECT segment, offset FROM segment_matches'))
+        return {
+            record_id for record_id, location in store.index.items() if (location[0], location[1]) in matches
+        }
@@ -0,0 +1,291 @@
+"""
+Snapshot generations of a harvest store.
+
+A harvest updates the store in place, so a reader running at the same time sees a mix of old and new
+records. A snapshot is a frozen, read-only copy of the store in `<harvest dir>/snapshots/<generation>`
+that a reader can pin while the next harvest proceeds:
+
+    with pin_snapshot(harvest_dir) as snapshot:
+        for record_id, data in snapshot.store.scan():
+            ...
+
+Snapshots are cheap, since they share the record data with the live store through hard links:
+
+* For a `FileStore`, every record file is hard-linked. The store replaces files instead of rewriting
+  them, so the links keep pointing to the old versions.
+* For a `SegmentStore`, the segments are append-only, so all but the last segment are hard-linked. The
+  last segment is still being appended to, so it is copied up to the position covered by the saved index.
+
+A snapshot must be taken while no harvest is writing to the store, which is why the harvest takes one
+itself when it ends (`OaiPmhSettings.snapshots`). The snapshot also records the size of the journal, so
+that a journal consumer can stop at the same point as the snapshot.
+
+Readers pin a snapshot with a pin file in `<snapshot>/pins`, and `prune_snapshots` only removes old
+generations that are not pinned. Pins left behind by crashed readers are ignored after `max_pin_age`.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import shutil
+import uuid
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from time import time
+from typing import List, Optional
+
+from seiso.common.compression import dictionary_dir
+from seiso.common.harvest_journal import journal_path
+from seiso.common.harvest_store import SNAPSHOTS_DIR, STORE_FILES, STORE_SEGMENTS, FileStore, HarvestStore, \
+    MappedIndex, SegmentStore, open_store
+
+logger = logging.getLogger(__name__)
+
+MAX_PIN_AGE = 7 * 24 * 3600.0
+
+
+def snapshots_dir(harvest_dir: Path) -> Path:
+    return Path(harvest_dir).joinpath(SNAPSHOTS_DIR)
+
+
+@dataclass
+class Snapshot:
+    generation: int
+    path: Path
+    created: datetime
+    kind: str
+    journal_offset: int = 0  # Size of the journal when the snapshot was taken
+
+    @classmethod
+    def load(cls, path: Path) -> Snapshot:
+        with path.joinpath('snapshot.json').open('r', encoding='utf-8') as fp:
+            data = json.load(fp)
+        return cls(
+            generation=data['generation'],
+            path=path,
+            created=datetime.fromisoformat(data['created']),
+            kind=data['kind'],
+            journal_offset=data.get('journal_offset', 0),
+        )
+
+    def serialize(self) -> dict:
+        return {
+            'generation': self.generation,
+            'created': self.created.isoformat(),
+            'kind': self.kind,
+            'journal_offset': self.journal_offset,
+        }
+
+    def open_store(self) -> HarvestStore:
+        return open_store(self.path, self.kind, readonly=True)
+
+    def pins(self) -> List[Path]:
+        pin_dir = self.path.joinpath('pins')
+        return list(pin_dir.glob('*.pin')) if pin_dir.is_dir() else []
+
+    def pinned(self, max_pin_age: float = MAX_PIN_AGE) -> bool:
+        now = time()
+        for pin in self.pins():
+            try:
+                if now - pin.stat().st_mtime < max_pin_age:
+                    return True
+            except FileNotFoundError:
+                pass
+        return False
+
+
+def list_snapshots(harvest_dir: Path) -> List[Snapshot]:
+    """The complete snapshots of a harvest, oldest first."""
+    root = snapshots_dir(harvest_dir)
+    if not root.is_dir():
+        return []
+    snapshots = []
+    for path in root.iterdir():
+        if path.name.isdigit() and path.joinpath('snapshot.json').exists():
+            snapshots.append(Snapshot.load(path))
+    return sorted(snapshots, key=lambda snapshot: snapshot.generation)
+
+
+def latest_snapshot(harvest_dir: Path) -> Optional[Snapshot]:
+    snapshots = list_snapshots(harvest_dir)
+    return snapshots[-1] if snapshots else None
+
+
+def _link(src: Path, dest: Path) -> None:
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    os.link(src, dest)
+
+
+def _copy_prefix(src: Path, dest: Path, length: int) -> None:
+    """Copy the first `length` bytes of `src`."""
+    with src.open('rb') as fp_in, dest.open('wb') as fp_out:
+        remaining = length
+        while remaining > 0:
+            chunk = fp_in.read(min(remaining, 16 * 1024 * 1024))
+            if not chunk:
+                raise IOError('%s is shorter than %d bytes' % (src, length))
+            fp_out.write(chunk)
+            remaining -= len(chunk)
+        fp_out.flush()
+        os.fsync(fp_out.fileno())
+
+
+def _snapshot_segments(harvest_dir: Path, dest: Path) -> None:
+    """Snapshot a segment store from the index saved on disk, which covers the segments up to its position."""
+    segment_dir = harvest_dir.joinpath('segments')
+    index_file = segment_dir.joinpath('index.json')
+    with index_file.open('r', encoding='utf-8') as fp:
+        last_segment, last_offset = json.load(fp)['position']
+    dest.joinpath('segments').mkdir(parents=True)
+    for path in sorted(segment_dir.glob('*.seg')):
+        segment = int(path.stem)
+        if segment < last_segment:
+            _link(path, dest.joinpath('segments', path.name))
+        elif segment == last_segment:
+            _copy_prefix(path, dest.joinpath('segments', path.name), last_offset)
+    shutil.copyfile(index_file, dest.joinpath('segments', index_file.name))
+    mapped_index_file = segment_dir.joinpath('index.bin')
+    try:
+        mapped = MappedIndex(mapped_index_file)
+    except (FileNotFoundError, ValueError):
+        return
+    mapped.close()
+    if mapped.position == (last_segment, last_offset):
+        shutil.copyfile(mapped_index_file, dest.joinpath('segments', mapped_index_file.name))
+
+
+def _snapshot_files(harvest_dir: Path, dest: Path) -> int:
+    store = FileStore(harvest_dir, readonly=True)
+    count = 0
+    for path in store.files():
+        _link(path, dest.joinpath(path.relative_to(harvest_dir)))
+        count += 1
+    return count
+
+
+def create_snapshot(harvest_dir: Path, store: Optional[HarvestStore] = None) -> Snapshot:
+    """Take a snapshot of the store in `harvest_dir`, which must not be written to at the same time.
+    If the store is open, pass it as `store`, so that the segment index is saved first.
+
+    The snapshot is built in a temporary dir that is renamed into place when it's complete, so readers
+    never see a partial snapshot."""
+    harvest_dir = Path(harvest_dir)
+    if isinstance(store, SegmentStore):
+        store.save_index()
+    root = snapshots_dir(harvest_dir)
+    root.mkdir(exist_ok=True)
+    existing = list_snapshots(harvest_dir)
+    generation = existing[-1].generation + 1 if existing else 1
+    tmp_dir = root.joinpath('.tmp-%06d' % generation)
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir()
+
+    kind = STORE_SEGMENTS if SegmentStore.exists(harvest_dir) else STORE_FILES
+    journal = journal_path(harvest_dir)
+    snapshot = Snapshot(
+        generation=generation,
+        path=root.joinpath('%06d' % generation),
+        created=datetime.now(),
+        kind=kind,
+        journal_offset=journal.stat().st_size if journal.exists() else 0,
+    )
+    if kind == STORE_SEGMENTS:
+        _snapshot_segments(harvest_dir, tmp_dir)
+    else:
+        _snapshot_files(harvest_dir, tmp_dir)
+
+    # The codec settings and dictionaries are needed to read compressed records
+    store_settings = harvest_dir.joinpath('store.json')
+    if store_settings.exists():
+        shutil.copyfile(store_settings, tmp_dir.joinpath(store_settings.name))
+    if dictionary_dir(harvest_dir).is_dir():
+        for path in dictionary_dir(harvest_dir).iterdir():
+            _link(path, dictionary_dir(tmp_dir).joinpath(path.name))
+
+    with tmp_dir.joinpath('snapshot.json').open('w', encoding='utf-8') as fp:
+        json.dump(snapshot.serialize(), fp, indent=2)
+    os.rename(tmp_dir, snapshot.path)
+    logger.info('Created snapshot %d of %s', generation, harvest_dir)
+    return snapshot
+
+
+def prune_snapshots(harvest_dir: Path, keep: int, max_pin_age: float = MAX_PIN_AGE) -> List[int]:
+    """Remove all but the `keep` newest snapshots, except those that are pinned. Returns the removed
+    generations."""
+    removed = []
+    snapshots = list_snapshots(harvest_dir)
+    for snapshot in snapshots[:max(0, len(snapshots) - keep)]:
+        if snapshot.pinned(max_pin_age):
+            logger.info('Keeping snapshot %d, which is pinned by %d readers', snapshot.generation,
+                        len(snapshot.pins()))
+            continue
+        # Rename first, so the snapshot disappears atomically for readers listing the snapshots
+        trash = snapshot.path.with_name('.trash-%06d' % snapshot.generation)
+        os.rename(snapshot.path, trash)
+        if Snapshot.load(trash).pinned(max_pin_age):
+            # A reader pinned it while we were checking
+            os.rename(trash, snapshot.path)
+            continue
+        shutil.rmtree(trash)
+        removed.append(snapshot.generation)
+    if removed:
+        logger.info('Removed snapshots: %s', ', '.join(str(generation) for generation in removed))
+    return removed
+
+
+class PinnedSnapshot:
+    """A snapshot pinned by this process until `release` is called."""
+
+    def __init__(self, snapshot: Snapshot):
+        self.snapshot = snapshot
+        self.pin_file = snapshot.path.joinpath('pins', '%d-%s.pin' % (os.getpid(), uuid.uuid4().hex[:8]))
+        self.pin_file.parent.mkdir(exist_ok=True)
+        self.pin_file.write_text(datetime.now().isoformat(), encoding='utf-8')
+        if not self.pin_file.exists():
+            # The snapshot was moved away by `prune_snapshots` while we pinned it
+            raise FileNotFoundError(self.pin_file)
+        self._store: Optional[HarvestStore] = None
+
+    @property
+    def store(self) -> HarvestStore:
+        if self._store is None:
+            self._store = self.snapshot.open_store()
+        return self._store
+
+    def refresh(self) -> None:
+        """Renew the pin, for readers running longer than the max pin age."""
+        os.utime(self.pin_file)
+
+    def release(self) -> None:
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+        try:
+            self.pin_file.unlink()
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def pin_snapshot(harvest_dir: Path, generation: Optional[int] = None) -> Optional[PinnedSnapshot]:
+    """Pin the latest snapshot, or the given generation. Returns None if there is no such snapshot."""
+    for _ in range(3):
+        snapshots = list_snapshots(harvest_dir)
+        if generation is not None:
+            snapshots = [snapshot for snapshot in snapshots if snapshot.generation == generation]
+        if not snapshots:
+            return None
+        try:
+            return PinnedSnapshot(snapshots[-1])
+        except FileNotFoundError:
+            # Pruned between listing and pinning
+            continue
+    return None
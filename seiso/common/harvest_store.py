@@ -0,0 +1,663 @@
+"""
+Storage backends for OAI-PMH harvests.
+
+`FileStore` is the original layout with one file per record, `<md5[:2]>/<id>.xml`. `SegmentStore` appends
+records to large segment files and keeps an offset index keyed by record id, so that a full scan becomes
+a few large sequential reads rather than millions of opens. Use `open_store` to open whichever
+layout a harvest directory uses.
+
+Both layouts can compress the records (see `seiso.common.compression`). The codec used for new records is
+saved in `store.json`, while reading detects the codec of each record, so stores can be converted gradually.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections.abc import MutableMapping
+from hashlib import blake2b, md5
+from pathlib import Path
+from time import time
+from typing import BinaryIO, Dict, Generator, Iterable, Iterator, List, Mapping, Optional, Tuple
+
+from seiso.common.compression import CODEC_NONE, SUFFIXES, Codec
+
+logger = logging.getLogger(__name__)
+
+STORE_FILES = 'files'
+STORE_SEGMENTS = 'segments'
+
+# Snapshots of the store are kept here, see `seiso.common.harvest_snapshots`
+SNAPSHOTS_DIR = 'snapshots'
+
+
+class StoreError(IOError):
+    pass
+
+
+def content_digest(data: bytes) -> str:
+    """Short content hash used to detect unchanged records."""
+    return blake2b(data, digest_size=8).hexdigest()
+
+
+class HarvestStore(ABC):
+    """A key-value store for harvested records, keyed by record id."""
+
+    def __init__(self, path: Path, readonly: bool = False, compression: Optional[str] = None):
+        self.path = Path(path)
+        self.readonly = readonly
+        self.settings_file = self.path.joinpath('store.json')
+        if compression is None:
+            compression = self._load_settings().get('compression', CODEC_NONE)
+        elif not readonly and compression != self._load_settings().get('compression', CODEC_NONE):
+            self._save_settings({'compression': compression})
+        self.codec = Codec(self.path, compression)
+
+    def _load_settings(self) -> dict:
+        try:
+            with self.settings_file.open('r', encoding='utf-8') as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return {}
+
+    def _save_settings(self, settings: dict) -> None:
+        self.path.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.settings_file.with_suffix('.tmp')
+        with tmp_file.open('w', encoding='utf-8') as fp:
+            json.dump(settings, fp)
+        os.replace(tmp_file, self.settings_file)
+
+    @abstractmethod
+    def put(self, record_id: str, data: bytes) -> bool:
+        """Store a record, replacing any previous version. If the stored version has the same content,
+        nothing is written. Returns True if the record was written."""
+
+    @abstractmethod
+    def delete(self, record_id: str) -> bool:
+        """Delete a record. Returns True if the record existed."""
+
+    @abstractmethod
+    def get(self, record_id: str) -> Optional[bytes]:
+        """Get a record, or None if it doesn't exist."""
+
+    @abstractmethod
+    def ids(self) -> Iterable[str]:
+        """Iterate over the ids of all stored records."""
+
+    @abstractmethod
+    def scan(self) -> Generator[Tuple[str, bytes], None, None]:
+        """Iterate over (record id, data) for all stored records, in storage order."""
+
+    def flush(self) -> None:
+        """Make sure all records stored so far are written to disk."""
+
+    def close(self) -> None:
+        self.flush()
+
+    @abstractmethod
+    def compact(self) -> Tuple[int, int]:
+        """Rewrite the stored records with the current codec and drop any garbage.
+        Returns the number of bytes before and after."""
+
+    def __contains__(self, record_id: str) -> bool:
+        return self.get(record_id) is not None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FileStore(HarvestStore):
+    """One file per record. We use md5 just to get a slightly more uniform distribution of files in the
+    shard directories, since the prefixes and suffixes of the ids are often very non-uniform.
+
+    Compressed records get the suffix of the codec, e.g. `<id>.xml.zst`.
+
+    Records are written to a temporary file that replaces the old one, rather than rewritten in place, so
+    that hard-linked snapshots of the store keep the old version."""
+
+    suffixes = ['.xml' + suffix for suffix in SUFFIXES.values()]
+
+    def record_path(self, record_id: str) -> Path:
+        file_dir = self.path.joinpath(md5(record_id.encode('utf-8')).hexdigest()[:2])
+        return file_dir.joinpath('%s.xml%s' % (record_id, self.codec.suffix))
+
+    def _existing_path(self, record_id: str) -> Optional[Path]:
+        """Path of the stored record, which may have been written with another codec."""
+        path = self.record_path(record_id)
+        if path.exists():
+            return path
+        for suffix in self.suffixes:
+            other = path.parent.joinpath(record_id + suffix)
+            if other.exists():
+                return other
+        return None
+
+    def put(self, record_id: str, data: bytes) -> bool:
+        # Comparing with the existing file costs a small read, but saves rewriting the file
+        existing = self._existing_path(record_id)
+        if existing is not None:
+            with existing.open('rb') as fp:
+                if self.codec.decompress(fp.read()) == data:
+                    return False
+        filename = self.record_path(record_id)
+        filename.parent.mkdir(exist_ok=True)
+        tmp_file = filename.with_name('%s.%d.tmp' % (filename.name, threading.get_ident()))
+        with tmp_file.open('wb') as fp:
+            fp.write(self.codec.compress(data))
+        os.replace(tmp_file, filename)
+        if existing is not None and existing != filename:
+            os.remove(str(existing))
+        return True
+
+    def delete(self, record_id: str) -> bool:
+        filename = self._existing_path(record_id)
+        if filename is None:
+            return False
+        os.remove(str(filename))
+        return True
+
+    def get(self, record_id: str) -> Optional[bytes]:
+        filename = self._existing_path(record_id)
+        if filename is None:
+            return None
+        with filename.open('rb') as fp:
+            return self.codec.decompress(fp.read())
+
+    def __contains__(self, record_id: str) -> bool:
+        return self._existing_path(record_id) is not None
+
+    @staticmethod
+    def record_id(path: Path) -> str:
+        return path.name.split('.xml', 1)[0]
+
+    def files(self) -> Generator[Path, None, None]:
+        for dirpath, dirnames, filenames in os.walk(str(self.path)):
+            if dirpath == str(self.path) and SNAPSHOTS_DIR in dirnames:
+                dirnames.remove(SNAPSHOTS_DIR)
+            for filename in filenames:
+                if filename.endswith(tuple(self.suffixes)):
+                    yield Path(dirpath).joinpath(filename)
+
+    def ids(self) -> Generator[str, None, None]:
+        for path in self.files():
+            yield self.record_id(path)
+
+    def scan(self) -> Generator[Tuple[str, bytes], None, None]:
+        for path in self.files():
+            with path.open('rb') as fp:
+                yield self.record_id(path), self.codec.decompress(fp.read())
+
+    def compact(self) -> Tuple[int, int]:
+        """Rewrite records stored with another codec than the current one."""
+        size_before = size_after = rewritten = 0
+        for path in list(self.files()):
+            size = path.stat().st_size
+            size_before += size
+            if path.name.endswith('.xml' + self.codec.suffix):
+                size_after += size
+                continue
+            record_id = self.record_id(path)
+            with path.open('rb') as fp:
+                data = self.codec.decompress(fp.read())
+            filename = self.record_path(record_id)
+            with filename.open('wb') as fp:
+                fp.write(self.codec.compress(data))
+            os.remove(str(path))
+            size_after += filename.stat().st_size
+            rewritten += 1
+        logger.info('Rewrote %d records as %s (%d bytes -> %d bytes)',
+                    rewritten, self.codec.codec, size_before, size_after)
+        return size_before, size_after
+
+
+# Each entry in a segment is a header followed by the record id and the record data.
+# The header holds the operation, the id length, the data length and a CRC32 of the id and data,
+# so that a torn write at the end of a segment can be detected and discarded.
+_entry_header = struct.Struct('>cHII')
+OP_PUT = b'P'
+OP_DELETE = b'D'
+
+# (segment number, offset of the data, length of the data, content digest)
+Location = Tuple[int, int, int, Optional[str]]
+
+# The mapped index, `index.bin`, holds the same entries as `index.json`, sorted by id in fixed-width records:
+# the id padded with NUL bytes to the length of the longest id, then the segment, the data offset, the data
+# length, the content digest and flags. The header holds a magic number, the id width, the segment position
+# the index covers and the number of records.
+_mapped_header = struct.Struct('<8sIIQQ')
+_mapped_entry = struct.Struct('<IQI8sB')
+MAPPED_INDEX_MAGIC = b'SEGIDX\x00\x01'
+FLAG_DIGEST = 1
+
+
+def write_mapped_index(path: Path, index: Mapping[str, Location], position: Tuple[int, int]) -> None:
+    keys = sorted((record_id.encode('utf-8'), record_id) for record_id in index)
+    width = max((len(key) for key, _ in keys), default=0)
+    tmp_file = path.with_name(path.name + '.tmp')
+    with tmp_file.open('wb', buffering=1024 * 1024) as fp:
+        fp.write(_mapped_header.pack(MAPPED_INDEX_MAGIC, width, position[0], position[1], len(keys)))
+        entry = struct.Struct('<%ds' % width + _mapped_entry.format[1:])  # The id, NUL-padded, and the entry
+        for key, record_id in keys:
+            segment, offset, length, digest = index[record_id]
+            fp.write(entry.pack(key, segment, offset, length, bytes.fromhex(digest) if digest else b'',
+                                FLAG_DIGEST if digest else 0))
+        fp.flush()
+        os.fsync(fp.fileno())
+    try:
+        os.replace(tmp_file, path)
+    except OSError:
+        tmp_file.unlink()
+        raise
+
+
+class MappedIndex(MutableMapping):
+    """The segment index from `index.bin`, memory-mapped and searched with bisect, so that read-only stores
+    don't have to load the whole index, and processes opening the same store share the pages. Changes,
+    e.g. entries replayed from after the position of the index, are kept in a dict on top."""
+
+    def __init__(self, path: Path):
+        with Path(path).open('rb') as fp:
+            self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mm) < _mapped_header.size or self._mm[:8] != MAPPED_INDEX_MAGIC:
+            self._mm.close()
+            raise ValueError('Not a mapped segment index: %s' % path)
+        magic, self.width, segment, offset, self.count = _mapped_header.unpack_from(self._mm, 0)
+        self.entry_size = self.width + _mapped_entry.size
+        if len(self._mm) != _mapped_header.size + self.count * self.entry_size:
+            self._mm.close()
+            raise ValueError('Incomplete mapped segment index: %s' % path)
+        self.position = (segment, offset)
+        self._changes: Dict[str, Optional[Location]] = {}  # None for deleted records
+        self._len = self.count
+
+    def close(self) -> None:
+        self._mm.close()
+
+    def _key(self, i: int) -> bytes:
+        start = _mapped_header.size + i * self.entry_size
+        return self._mm[start:start + self.width]
+
+    def _location(self, i: int) -> Location:
+        segment, offset, length, digest, flags = _mapped_entry.unpack_from(
+            self._mm, _mapped_header.size + i * self.entry_size + self.width
+        )
+        return segment, offset, length, digest.hex() if flags & FLAG_DIGEST else None
+
+    def _find(self, record_id: str) -> Optional[int]:
+        key = record_id.encode('utf-8')
+        if len(key) > self.width:
+            return None
+        key = key.ljust(self.width, b'\x00')
+        i = bisect_left(range(self.count), key, key=self._key)
+        return i if i < self.count and self._key(i) == key else None
+
+    def __getitem__(self, record_id: str) -> Location:
+        if record_id in self._changes:
+            location = self._changes[record_id]
+        else:
+            i = self._find(record_id)
+            location = self._location(i) if i is not None else None
+        if location is None:
+            raise KeyError(record_id)
+        return location
+
+    def __setitem__(self, record_id: str, location: Location) -> None:
+        if record_id not in self:
+            self._len += 1
+        self._changes[record_id] = location
+
+    def __delitem__(self, record_id: str) -> None:
+        if record_id not in self:
+            raise KeyError(record_id)
+        self._changes[record_id] = None
+        self._len -= 1
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self) -> Iterator[str]:
+        for record_id, _ in self.items():
+            yield record_id
+
+    def items(self) -> Iterator[Tuple[str, Location]]:  # type: ignore
+        """All (record id, location) pairs, read sequentially rather than searched for one by one."""
+        for i in range(self.count):
+            record_id = self._key(i).rstrip(b'\x00').decode('utf-8')
+            if record_id not in self._changes:
+                yield record_id, self._location(i)
+        for record_id, location in self._changes.items():
+            if location is not None:
+                yield record_id, location
+
+
+class SegmentStore(HarvestStore):
+    """Append-only segment store.
+
+    Records are appended to numbered segment files in `<path>/segments`. Deletes are appended as tombstones.
+    The offset index is kept in memory and saved to `index.json` together with the segment position it covers.
+    When the store is opened, any entries written after that position are replayed, so the index only needs to
+    be saved now and then, and the segment data is the single source of truth. The index also holds a content
+    digest for each record, so that unchanged records are not appended again.
+
+    The index is also saved as `index.bin` (see `MappedIndex`), which read-only stores memory-map instead of
+    loading `index.json`, so that e.g. the worker processes of a `HarvestReader` start at once and share
+    the index instead of each holding a copy of it.
+
+    Superseded versions and tombstones are only removed by `compact`.
+    """
+
+    def __init__(self, path: Path, readonly: bool = False, compression: Optional[str] = None,
+                 segment_size: int = 256 * 1024 * 1024, index_interval: float = 300.0):
+        super().__init__(path, readonly, compression)
+        self.segment_dir = self.path.joinpath('segments')
+        self.index_file = self.segment_dir.joinpath('index.json')
+        self.mapped_index_file = self.segment_dir.joinpath('index.bin')
+        self.segment_size = segment_size
+        self.index_interval = index_interval
+        self.index: MutableMapping[str, Location] = {}
+        self.lock = threading.RLock()
+        self._writer: Optional[BinaryIO] = None
+        self._writer_segment = 0
+        self._index_saved = time()
+        if not readonly:
+            self.segment_dir.mkdir(parents=True, exist_ok=True)
+        self._load_index()
+
+    @staticmethod
+    def exists(path: Path) -> bool:
+        return Path(path).joinpath('segments').is_dir()
+
+    def segment_path(self, segment: int) -> Path:
+        return self.segment_dir.joinpath('%08d.seg' % segment)
+
+    def segments(self) -> List[int]:
+        if not self.segment_dir.is_dir():
+            return []
+        return sorted(int(path.stem) for path in self.segment_dir.glob('*.seg'))
+
+    # ------------------------------------------------------------------------------------------------
+    # Index
+
+    def _load_index(self) -> None:
+        if self.readonly:
+            mapped = self._open_mapped_index()
+            if mapped is not None:
+                self.index = mapped
+                self._replay(mapped.position)
+                return
+        position = (0, 0)
+        try:
+            with self.index_file.open('r', encoding='utf-8') as fp:
+                data = json.load(fp)
+            # Indexes saved before content digests were added have no digest
+            self.index = {
+                record_id: (loc[0], loc[1], loc[2], loc[3] if len(loc) > 3 else None)
+                for record_id, loc in data['records'].items()
+            }
+            position = tuple(data['position'])  # type: ignore
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError):
+            logger.warning('Invalid segment index, rebuilding it from the segments: %s', self.index_file)
+            self.index = {}
+        self._replay(position)
+
+    def _open_mapped_index(self) -> Optional[MappedIndex]:
+        try:
+            mapped = MappedIndex(self.mapped_index_file)
+        except FileNotFoundError:
+            return None
+        except ValueError as err:
+            logger.warning('%s, loading %s instead', err, self.index_file.name)
+            return None
+        if mapped.position != (0, 0) and mapped.position[0] not in self.segments():
+            # Left behind by a compaction that didn't save it
+            logger.warning('The mapped segment index is out of date, loading %s instead', self.index_file.name)
+            mapped.close()
+            return None
+        return mapped
+
+    def _replay(self, position: Tuple[int, int]) -> None:
+        """Apply all entries written after `position` to the index."""
+        start_segment, start_offset = position
+        replayed = 0
+        for segment in self.segments():
+            if segment < start_segment:
+                continue
+            offset = start_offset if segment == start_segment else 0
+            for op, record_id, data_offset, data in self._read_entries(segment, offset):
+                if op == OP_PUT:
+                    digest = content_digest(self.codec.decompress(data))
+                    self.index[record_id] = (segment, data_offset, len(data), digest)
+                else:
+                    self.index.pop(record_id, None)
+                replayed += 1
+        if replayed > 0:
+            logger.info('Replayed %d entries not covered by the segment index', replayed)
+
+    def save_index(self) -> None:
+        if self.readonly:
+            return
+        with self.lock:
+            if self._writer is not None:
+                self._writer.flush()
+                os.fsync(self._writer.fileno())
+            segments = self.segments()
+            position = (segments[-1], self.segment_path(segments[-1]).stat().st_size) if segments else (0, 0)
+            tmp_file = self.index_file.with_suffix('.tmp')
+            with tmp_file.open('w', encoding='utf-8') as fp:
+                json.dump({'position': position, 'records': self.index}, fp)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmp_file, self.index_file)
+            try:
+                write_mapped_index(self.mapped_index_file, self.index, position)
+            except OSError as err:
+                # On Windows, the file can't be replaced while a reader has it mapped. Readers replay the
+                # entries written after the position of the old one, so it can be kept until next time.
+                logger.warning('Could not save the mapped segment index: %s', err)
+            self._index_saved = time()
+
+    # ------------------------------------------------------------------------------------------------
+    # Reading
+
+    def _read_entries(self, segment: int, offset: int = 0) -> Generator[Tuple[bytes, str, int, bytes], None, None]:
+        """Read entries from a segment sequentially. Yields (op, record id, data offset, data).
+
+        A torn entry at the end of the segment is truncated away, unless the store is read-only."""
+        path = self.segment_path(segment)
+        with path.open('rb', buffering=1024 * 1024) as fp:
+            fp.seek(offset)
+            while True:
+                header = fp.read(_entry_header.size)
+                if len(header) == 0:
+                    return
+                if len(header) == _entry_header.size:
+                    op, id_length, data_length, crc = _entry_header.unpack(header)
+                    body = fp.read(id_length + data_length)
+                    if len(body) == id_length + data_length and zlib.crc32(body) == crc:
+                        record_id = body[:id_length].decode('utf-8')
+                        data_offset = offset + _entry_header.size + id_length
+                        yield op, record_id, data_offset, body[id_length:]
+                        offset = data_offset + data_length
+                        continue
+                self._truncate(segment, offset)
+                return
+
+    def _truncate(self, segment: int, offset: int) -> None:
+        if self.readonly:
+            logger.warning('Ignoring incomplete entry at the end of segment %d (offset %d)', segment, offset)
+            return
+        logger.warning('Truncating incomplete entry at the end of segment %d (offset %d)', segment, offset)
+        with self.segment_path(segment).open('r+b') as fp:
+            fp.truncate(offset)
+
+    def read_segment(self, segment: int, offset: int = 0) -> Generator[Tuple[str, int, int, bytes], None, None]:
+        """Read the records put in a segment from `offset`, including superseded versions. Yields
+        (record id, data offset, end offset, data), where the end offset is where the next entry starts."""
+        for op, record_id, data_offset, data in self._read_entries(segment, offset):
+            if op == OP_PUT:
+                yield record_id, data_offset, data_offset + len(data), self.codec.decompress(data)
+
+    def get(self, record_id: str) -> Optional[bytes]:
+        with self.lock:
+            location = self.index.get(record_id)
+            if location is None:
+                return None
+            if self._writer is not None and location[0] == self._writer_segment:
+                self._writer.flush()
+        segment, offset, length, digest = location
+        with self.segment_path(segment).open('rb') as fp:
+            fp.seek(offset)
+            return self.codec.decompress(fp.read(length))
+
+    def __contains__(self, record_id: str) -> bool:
+        return record_id in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def ids(self) -> Iterable[str]:
+        return list(self.index.keys())
+
+    def scan(self) -> Generator[Tuple[str, bytes], None, None]:
+        """Read all live records segment by segment. Superseded versions and deleted records are skipped."""
+        self.flush()
+        return self._scan_segments(self.segments())
+
+    def _scan_segments(self, segments: List[int]) -> Generator[Tuple[str, bytes], None, None]:
+        for segment in segments:
+            for op, record_id, data_offset, data in self._read_entries(segment):
+                if op != OP_PUT:
+                    continue
+                location = self.index.get(record_id)
+                if location is not None and location[0] == segment and location[1] == data_offset:
+                    yield record_id, self.codec.decompress(data)
+
+    # ------------------------------------------------------------------------------------------------
+    # Writing
+
+    def _append(self, op: bytes, record_id: str, data: bytes, digest: Optional[str] = None) -> Location:
+        """Append an entry. `data` is the stored (possibly compressed) data,
+        `digest` the content digest of the uncompressed data."""
+        if self.readonly:
+            raise StoreError('Store is opened in read-only mode: %s' % self.path)
+        writer = self._writer
+        if writer is None or writer.tell() >= self.segment_size:
+            writer = self._open_writer()
+        id_bytes = record_id.encode('utf-8')
+        offset = writer.tell()
+        writer.write(_entry_header.pack(op, len(id_bytes), len(data), zlib.crc32(id_bytes + data)))
+        writer.write(id_bytes)
+        writer.write(data)
+        return self._writer_segment, offset + _entry_header.size + len(id_bytes), len(data), digest
+
+    def _open_writer(self) -> BinaryIO:
+        if self._writer is not None:
+            self._writer.close()
+        segments = self.segments()
+        segment = segments[-1] if segments else 1
+        if segments and self.segment_path(segment).stat().st_size >= self.segment_size:
+            segment += 1
+        self._writer = self.segment_path(segment).open('ab')
+        self._writer_segment = segment
+        return self._writer
+
+    def put(self, record_id: str, data: bytes) -> bool:
+        digest = content_digest(data)
+        location = self.index.get(record_id)
+        if location is not None and location[3] == digest:
+            return False
+        # Compress outside the lock, so that several workers can compress at the same time
+        stored = self.codec.compress(data)
+        with self.lock:
+            self.index[record_id] = self._append(OP_PUT, record_id, stored, digest)
+            return True
+
+    def delete(self, record_id: str) -> bool:
+        with self.lock:
+            if record_id not in self.index:
+                return False
+            self._append(OP_DELETE, record_id, b'')
+            del self.index[record_id]
+            return True
+
+    def flush(self) -> None:
+        with self.lock:
+            writer = self._writer
+            if writer is None:
+                return
+            writer.flush()
+            os.fsync(writer.fileno())
+            if time() - self._index_saved > self.index_interval:
+                self.save_index()
+
+    def close(self) -> None:
+        with self.lock:
+            if self._writer is not None:
+                self.flush()
+                self._writer.close()
+                self._writer = None
+                self.save_index()
+            if isinstance(self.index, MappedIndex):
+                self.index.close()
+                self.index = {}
+
+    def compact(self) -> Tuple[int, int]:
+        """Rewrite all live records into new segments, using the current codec, and remove the old ones.
+
+        The new segments are numbered after the existing ones, and the old segments are only removed
+        once the index pointing to the new segments has been saved, so an interrupted compaction only
+        leaves some extra segments behind. Returns the number of bytes before and after.
+        """
+        with self.lock:
+            self.flush()
+            old_segments = self.segments()
+            size_before = sum(self.segment_path(segment).stat().st_size for segment in old_segments)
+
+            if self._writer is not None:
+                self._writer.close()
+            first_new = (old_segments[-1] + 1) if old_segments else 1
+            self._writer = self.segment_path(first_new).open('ab')
+            self._writer_segment = first_new
+
+            new_index: Dict[str, Location] = {}
+            for record_id, data in self._scan_segments(old_segments):
+                new_index[record_id] = self._append(OP_PUT, record_id, self.codec.compress(data),
+                                                    self.index[record_id][3] or content_digest(data))
+
+            writer = self._writer
+            writer.flush()
+            os.fsync(writer.fileno())
+            self.index = new_index
+            self.save_index()
+
+            for segment in old_segments:
+                os.remove(self.segment_path(segment))
+
+            size_after = sum(self.segment_path(segment).stat().st_size for segment in self.segments())
+            logger.info('Compacted %d segments (%d bytes) into %d segments (%d bytes)',
+                        len(old_segments), size_before, len(self.segments()), size_after)
+            return size_before, size_after
+
+
+def open_store(path: Path, kind: Optional[str] = None, readonly: bool = False,
+               compression: Optional[str] = None) -> HarvestStore:
+    """Open the harvest store in `path`. If `kind` is not given, the layout is detected from the directory.
+    If `compression` is not given, new records are written with the codec the store was last opened with."""
+    if kind is None:
+        kind = STORE_SEGMENTS if SegmentStore.exists(path) else STORE_FILES
+    if kind == STORE_SEGMENTS:
+        return SegmentStore(path, readonly=readonly, compression=compression)
+    if kind == STORE_FILES:
+        return FileStore(path, readonly=readonly, compression=compression)
+    raise ValueError('Unknown store type: %s' % kind)
@@ -0,0 +1,281 @@
+"""
+A small local OAI-PMH server standing in for a real endpoint, to test and benchmark the harvester offline.
+
+The server serves a fixed list of records, either synthetic (`synthetic_records`) or replayed from an
+existing harvest (`stored_records`), and supports Identify, ListRecords, ListIdentifiers and GetRecord.
+To exercise the error handling of the harvester, it can add latency to every response, answer a share of
+the requests with 503 or cut a share of the list responses off halfway, and expire resumption tokens.
+"""
+from __future__ import annotations
+
+import logging
+import random
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from time import sleep, time
+from typing import List, Optional
+from urllib.parse import parse_qs, urlparse
+from xml.sax.saxutils import escape
+
+from seiso.common.harvest_store import open_store
+
+logger = logging.getLogger(__name__)
+
+OAI_NS = 'http://www.openarchives.org/OAI/2.0/'
+MARCXCHANGE_NS = 'info:lc/xmlns/marcxchange-v1'
+
+
+@dataclass
+class ServedRecord:
+    record_id: str
+    datestamp: str
+    metadata: Optional[bytes] = None  # None for deleted records
+
+    @property
+    def deleted(self) -> bool:
+        return self.metadata is None
+
+
+@dataclass
+class OaiServerSettings:
+    page_size: int = 100
+    latency: float = 0.0  # Seconds to wait before each response
+    error_rate: float = 0.0  # Share of the requests answered with 503 Service Unavailable
+    truncate_rate: float = 0.0  # Share of the list and GetRecord responses cut off halfway
+    retry_after: int = 0  # Retry-After for the 503 responses
+    token_expiry: Optional[float] = None  # Seconds before a resumption token expires
+    identifier_prefix: str = 'oai:example:'
+    seed: Optional[int] = None
+
+
+def synthetic_records(count: int, deleted_share: float = 0.02, seed: Optional[int] = 0) -> List[ServedRecord]:
+    """Generate Noraf-like person records."""
+    rng = random.Random(seed)
+    records = []
+    for n in range(count):
+        record_id = str(90000000 + n)
+        datestamp = '2024-%02d-%02dT12:00:00Z' % (1 + n * 12 // max(count, 1), 1 + n % 28)
+        if rng.random() < deleted_share:
+            records.append(ServedRecord(record_id, datestamp))
+            continue
+        references = ''.join(
+            f'<marc:datafield tag="400" ind1="1" ind2=" "><marc:subfield code="a">Navn {n}-{i}, Person</marc:subfield>'
+            f'</marc:datafield>' for i in range(rng.randint(0, 4))
+        )
+        metadata = (
+            f'<marc:record xmlns:marc="{MARCXCHANGE_NS}" format="MARC21" type="Authority">'
+            f'<marc:leader>99999nz  a2299999n  4500</marc:leader>'
+            f'<marc:controlfield tag="001">{record_id}</marc:controlfield>'
+            f'<marc:controlfield tag="005">20240101120000.0</marc:controlfield>'
+            f'<marc:controlfield tag="008">240101n| adznnaabn          |a aaa      </marc:controlfield>'
+            f'<marc:datafield tag="024" ind1="7" ind2=" "><marc:subfield code="a">https://id.bs.no/bibbi/{n}'
+            f'</marc:subfield><marc:subfield code="2">bibbi</marc:subfield></marc:datafield>'
+            f'<marc:datafield tag="100" ind1="1" ind2=" "><marc:subfield code="a">Etternavn {n}, Fornavn'
+            f'</marc:subfield><marc:subfield code="d">{1900 + n % 100}-</marc:subfield></marc:datafield>'
+            f'{references}'
+            f'</marc:record>'
+        ).encode('utf-8')
+        records.append(ServedRecord(record_id, datestamp, metadata))
+    return records
+
+
+def stored_records(harvest_dir: Path) -> List[ServedRecord]:
+    """Replay the records of an existing harvest."""
+    datestamp = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    records = []
+    with open_store(harvest_dir, readonly=True) as store:
+        for record_id, data in store.scan():
+            if data.startswith(b'<?xml'):
+                data = data[data.index(b'?>') + 2:].lstrip()
+            records.append(ServedRecord(record_id, datestamp, data))
+    return records
+
+
+class OaiServer:
+    """Serves `records` on `http://host:port/oai` from a background thread. Use port 0 to pick a free port."""
+
+    def __init__(self, records: List[ServedRecord], settings: Optional[OaiServerSettings] = None,
+                 host: str = '127.0.0.1', port: int = 0):
+        self.records = records
+        self.settings = settings or OaiServerSettings()
+        self.index = {record.record_id: record for record in records}
+        self.rng = random.Random(self.settings.seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        if isinstance(host, bytes):
+            host = host.decode('ascii')
+        return 'http://%s:%d/oai' % (host, port)
+
+    def start(self) -> OaiServer:
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='oai-server', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # ------------------------------------------------------------------------------------------------
+
+    def _chance(self, rate: float) -> bool:
+        with self.lock:
+            return rate > 0 and self.rng.random() < rate
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                server._handle(self, parse_qs(urlparse(self.path).query))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+                server._handle(self, parse_qs(body))
+
+            def log_message(self, fmt, *args):
+                logger.debug(fmt, *args)
+
+        return Handler
+
+    def _handle(self, handler: BaseHTTPRequestHandler, query: dict):
+        params = {key: values[0] for key, values in query.items()}
+        with self.lock:
+            self.requests += 1
+        if self.settings.latency:
+            sleep(self.settings.latency)
+        if self._chance(self.settings.error_rate):
+            with self.lock:
+                self.errors += 1
+            handler.send_response(503)
+            handler.send_header('Retry-After', str(self.settings.retry_after))
+            handler.send_header('Content-Length', '0')
+            handler.end_headers()
+            return
+
+        verb = params.get('verb')
+        if verb in ('ListRecords', 'ListIdentifiers'):
+            body = self._list(verb, params)
+        elif verb == 'GetRecord':
+            body = self._get_record(params)
+        elif verb == 'Identify':
+            earliest = min((record.datestamp for record in self.records), default='1970-01-01T00:00:00Z')
+            body = self._response(verb, '<repositoryName>Local OAI-PMH server</repositoryName>'
+                                        f'<baseURL>{self.url}</baseURL><protocolVersion>2.0</protocolVersion>'
+                                        f'<earliestDatestamp>{earliest}</earliestDatestamp>'
+                                        '<deletedRecord>persistent</deletedRecord>'
+                                        '<granularity>YYYY-MM-DDThh:mm:ssZ</granularity>')
+        else:
+            body = self._error('badVerb', 'Illegal verb: %s' % verb)
+
+        truncate = verb in ('ListRecords', 'ListIdentifiers', 'GetRecord') and self._chance(self.settings.truncate_rate)
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/xml; charset=utf-8')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        if truncate:
+            # Promise the full body, but close the connection halfway, like a dropped connection
+            with self.lock:
+                self.errors += 1
+            handler.wfile.write(body[:len(body) // 2])
+            handler.close_connection = True
+            return
+        handler.wfile.write(body)
+
+    def _response(self, verb: str, content: str) -> bytes:
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            f'<OAI-PMH xmlns="{OAI_NS}"><responseDate>{datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")}'
+            f'</responseDate><request verb="{verb}">{self.url}</request><{verb}>{content}</{verb}></OAI-PMH>'
+        ).encode('utf-8')
+
+    def _error(self, code: str, message: str) -> bytes:
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            f'<OAI-PMH xmlns="{OAI_NS}"><responseDate>{datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")}'
+            f'</responseDate><request>{self.url}</request><error code="{code}">{escape(message)}</error></OAI-PMH>'
+        ).encode('utf-8')
+
+    def _header(self, record: ServedRecord) -> str:
+        status = ' status="deleted"' if record.deleted else ''
+        return f'<header{status}><identifier>{self.settings.identifier_prefix}{record.record_id}</identifier>' \
+               f'<datestamp>{record.datestamp}</datestamp></header>'
+
+    def _record(self, record: ServedRecord) -> str:
+        if record.metadata is None:
+            return f'<record>{self._header(record)}</record>'
+        return f'<record>{self._header(record)}<metadata>{record.metadata.decode("utf-8")}</metadata></record>'
+
+    def _list(self, verb: str, params: dict) -> bytes:
+        # The token holds everything needed to continue the list: offset|from|until|issued
+        if 'resumptionToken' in params:
+            try:
+                offset, from_date, until_date, issued = params['resumptionToken'].split('|')
+                offset, issued = int(offset), float(issued)
+            except ValueError:
+                return self._error('badResumptionToken', 'Invalid resumption token')
+            if self.settings.token_expiry is not None and time() - issued > self.settings.token_expiry:
+                return self._error('badResumptionToken', 'The resumption token has expired')
+        else:
+            offset, from_date, until_date = 0, params.get('from', ''), params.get('until', '')
+
+        records = [
+            record for record in self.records
+            if (not from_date or record.datestamp[:len(from_date)] >= from_date)
+            and (not until_date or record.datestamp[:len(until_date)] <= until_date)
+        ]
+        if not records:
+            return self._error('noRecordsMatch', 'No records match')
+
+        page = records[offset:offset + self.settings.page_size]
+        render = self._record if verb == 'ListRecords' else self._header
+        content = ''.join(render(record) for record in page)
+        next_offset = offset + len(page)
+        if next_offset < len(records):
+            token = '%d|%s|%s|%f' % (next_offset, from_date, until_date, time())
+            content += f'<resumptionToken completeListSize="{len(records)}" cursor="{offset}">{escape(token)}' \
+                       f'</resumptionToken>'
+        elif offset > 0:
+            content += f'<resumptionToken completeListSize="{len(records)}" cursor="{offset}"/>'
+        return self._response(verb, content)
+
+    def _get_record(self, params: dict) -> bytes:
+        identifier = params.get('identifier', '')
+        record = self.index.get(identifier[len(self.settings.identifier_prefix):])
+        if record is None or not identifier.startswith(self.settings.identifier_prefix):
+            return self._error('idDoesNotExist', 'No such record: %s' % identifier)
+        return self._response('GetRecord', self._record(record))
+
+
+def serve(records: List[ServedRecord], settings: OaiServerSettings, host: str = '127.0.0.1', port: int = 8000,
+          ready=None):
+    """Run a server in the foreground. If `ready` is a connection, the URL is sent to it once the server
+    is listening, e.g. to run the server in a child process."""
+    server = OaiServer(records, settings, host, port)
+    logger.info('Serving %d records on %s', len(records), server.url)
+    if ready is not None:
+        ready.send(server.url)
+    try:
+        server.serve_forever()
+    finally:
+        server.httpd.server_close()
@@ -0,0 +1,204 @@
+"""
+Adaptive request throttling.
+
+`AdaptiveThrottle` wraps requests to a single server and
+
+* retries failed requests (timeouts, connection errors, responses cut off halfway and 429/5xx responses)
+  with exponential backoff and full jitter, or after the delay given in a `Retry-After` header,
+* pauses all requests to the server, not just the failed one, when the server asks us to back off,
+* limits the number of requests in flight, increasing the limit by one step per successful window and
+  halving it when the server is overloaded or the latency rises well above the best latency seen so far
+  (AIMD, as in TCP congestion control),
+* optionally spaces requests to stay below a fixed rate limit,
+* derives the request timeout from the observed latency (smoothed mean + 4 * mean deviation, as for the
+  TCP retransmission timeout), so slow pages don't time out while a hanging server is detected quickly.
+"""
+from __future__ import annotations
+
+import logging
+import random
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from time import monotonic, sleep
+from typing import Callable, Optional, TypeVar
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+RETRY_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+# Errors without a response worth retrying. The last two are raised when the connection drops while the
+# body is being read.
+RETRY_EXCEPTIONS = (requests.Timeout, requests.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.ContentDecodingError)
+# Responses that mean the server is overloaded, so we should also reduce the concurrency
+OVERLOAD_STATUS_CODES = frozenset([429, 503])
+
+
+class RetriesExhausted(requests.RequestException):
+    pass
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header, which is either a number of seconds or an HTTP date."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        until = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if until.tzinfo is None:
+        until = until.replace(tzinfo=timezone.utc)
+    return max(0.0, (until - datetime.now(timezone.utc)).total_seconds())
+
+
+@dataclass
+class AdaptiveThrottle:
+    max_concurrency: int = 1
+    min_concurrency: int = 1
+    max_retries: int = 8
+    base_delay: float = 1.0  # Backoff for the first retry
+    max_delay: float = 300.0  # Max backoff, and max delay we accept from Retry-After
+    initial_timeout: float = 30.0
+    min_timeout: float = 10.0
+    max_timeout: float = 180.0
+    latency_tolerance: float = 2.0  # Back off if the latency is this many times the best latency seen,
+    min_latency_increase: float = 1.0  # and at least this many seconds more, to ignore noise on fast requests
+    rate_limit: Optional[float] = None  # Max requests per second
+
+    limit: float = field(init=False)
+    in_flight: int = field(default=0, init=False)
+    srtt: Optional[float] = field(default=None, init=False)  # Smoothed latency
+    rttvar: float = field(default=0.0, init=False)  # Smoothed mean deviation of the latency
+    best_srtt: Optional[float] = field(default=None, init=False)
+    paused_until: float = field(default=0.0, init=False)
+    next_request: float = field(default=0.0, init=False)  # Earliest start of the next request under the rate limit
+    retries: int = field(default=0, init=False)
+    condition: threading.Condition = field(default_factory=threading.Condition, init=False, repr=False)
+
+    def __post_init__(self):
+        self.limit = float(self.max_concurrency)
+
+    @property
+    def timeout(self) -> float:
+        if self.srtt is None:
+            return self.initial_timeout
+        return min(self.max_timeout, max(self.min_timeout, self.srtt + 4 * self.rttvar))
+
+    def set_max_concurrency(self, max_concurrency: int):
+        with self.condition:
+            self.max_concurrency = max(self.min_concurrency, max_concurrency)
+            self.limit = float(self.max_concurrency)
+            self.condition.notify_all()
+
+    # ------------------------------------------------------------------------------------------------
+
+    def _acquire(self):
+        with self.condition:
+            while True:
+                now = monotonic()
+                wait = max(self.paused_until, self.next_request) - now
+                if wait <= 0 and self.in_flight < max(self.min_concurrency, int(self.limit)):
+                    self.in_flight += 1
+                    if self.rate_limit:
+                        self.next_request = now + 1 / self.rate_limit
+                    return
+                self.condition.wait(timeout=wait if wait > 0 else 1.0)
+
+    def _release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def _on_success(self, latency: float):
+        with self.condition:
+            if self.srtt is None:
+                self.srtt, self.rttvar = latency, latency / 2
+            else:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - latency)
+                self.srtt = 0.875 * self.srtt + 0.125 * latency
+            if self.best_srtt is None or self.srtt < self.best_srtt:
+                self.best_srtt = self.srtt
+
+            if self.srtt > max(self.latency_tolerance * self.best_srtt, self.best_srtt + self.min_latency_increase) \
+                    and self.limit > self.min_concurrency:
+                self._decrease('latency rose to %.1fs (best %.1fs)' % (self.srtt, self.best_srtt))
+                # Give the server a chance to recover before we judge it again
+                self.best_srtt = self.srtt / self.latency_tolerance * 1.5
+            elif self.limit < self.max_concurrency:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+                self.condition.notify_all()
+
+    def _decrease(self, reason: str):
+        new_limit = max(float(self.min_concurrency), self.limit / 2)
+        if int(new_limit) < int(self.limit):
+            logger.info('Reducing concurrency from %d to %d: %s', int(self.limit), int(new_limit), reason)
+        self.limit = new_limit
+
+    def _on_failure(self, attempt: int, retry_after: Optional[float], overloaded: bool) -> float:
+        """Register a failed attempt and return the delay before the next one."""
+        with self.condition:
+            self.retries += 1
+            if overloaded:
+                self._decrease('server is overloaded')
+            if retry_after is not None:
+                delay = min(self.max_delay, retry_after)
+                # The server asked us to back off, so pause all requests, not just this one
+                self.paused_until = max(self.paused_until, monotonic() + delay)
+            else:
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+            return delay
+
+    # ------------------------------------------------------------------------------------------------
+
+    def call(self, request: Callable[[float], T],
+             on_retry: Optional[Callable[[int, float, str], None]] = None) -> T:
+        """Call `request(timeout)` with retries. `request` should raise `requests.HTTPError` for error
+        responses, e.g. by calling `raise_for_status`. `on_retry(attempt, delay, reason)` is called before
+        each retry."""
+        attempt = 0
+        error: requests.RequestException
+        while True:
+            self._acquire()
+            t0 = monotonic()
+            try:
+                result = request(self.timeout)
+            except requests.HTTPError as exc:
+                response = exc.response
+                if response is None or response.status_code not in RETRY_STATUS_CODES:
+                    raise
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                delay = self._on_failure(attempt, retry_after, response.status_code in OVERLOAD_STATUS_CODES)
+                reason = 'HTTP %d' % response.status_code
+                error = exc
+            except RETRY_EXCEPTIONS as exc:
+                # A timeout may also mean that the server is overloaded
+                delay = self._on_failure(attempt, None, isinstance(exc, requests.Timeout))
+                reason = '%s: %s' % (type(exc).__name__, exc)
+                error = exc
+            else:
+                self._on_success(monotonic() - t0)
+                return result
+            finally:
+                self._release()
+
+            attempt += 1
+            if attempt > self.max_retries:
+                raise RetriesExhausted('Giving up after %d retries: %s' % (self.max_retries, reason)) from error
+            logger.warning('Request failed (%s), retrying in %.1f seconds (attempt %d of %d)',
+                           reason, delay, attempt, self.max_retries)
+            if on_retry is not None:
+                on_retry(attempt, delay, reason)
+            sleep(delay)
+
+    def backoff(self, attempt: int) -> float:
+        """Register a failure outside of `call`, e.g. while reading a streamed response, and return
+        the delay before the next attempt."""
+        return self._on_failure(attempt, None, False)
@@ -1,10 +1,20 @@
 import argparse
+import csv
+import json
 import logging
 import os
+import sys
 from pathlib import Path
 
 from dotenv import load_dotenv
-from seiso.services.oai import OaiPmh, OaiPmhSettings
+from seiso.services.oai import OaiPmh, OaiPmhSettings, harvest_concurrently
+from seiso.common.compression import CODECS, train_dictionary
+from seiso.common.harvest_benchmark import HARVEST_METHODS, run_benchmark
+from seiso.common.harvest_extractors import EXTRACTORS, build_extractors, open_extractors
+from seiso.common.harvest_reader import RECORD_FIELDS, HarvestReader
+from seiso.common.harvest_snapshots import create_snapshot, prune_snapshots
+from seiso.common.harvest_store import STORE_FILES, STORE_SEGMENTS, open_store
+from seiso.common.oai_server import OaiServerSettings, serve, stored_records, synthetic_records
 
 from seiso.common.logging import setup_logging
 from seiso.console.helpers import storage_path
@@ -28,6 +38,48 @@ def harvest_action(noraf: Noraf, args: argparse.Namespace) -> None:
     noraf.oai_harvest(args.destination_dir)
 
 
+ALL_SOURCES = ['noraf', 'bibbi', 'alma']
+
+
+def source_settings(source: str, storage_dir: Path) -> OaiPmhSettings:
+    if source == 'bibbi':
+        user, password = os.getenv('BIBBI_OAI_USER'), os.getenv('BIBBI_OAI_PASSWORD')
+        if not user or not password:
+            raise Exception('BIBBI_OAI_USER and/or BIBBI_OAI_PASSWORD not configured')
+        settings = OaiPmhSettings(
+            endpoint='https://oai.aja.bs.no/bibbi',
+            metadata_prefix="marc21",
+            metadata_schema="info:lc/xmlns/marcxchange-v1",
+            storage_dir=storage_dir,
+            extractors=['bibbi'],
+            request_args={'auth': (
+                user.encode('utf-8'),
+                password.encode('utf-8')
+            )},
+        )
+
+    elif source == 'alma':
+        settings = OaiPmhSettings(
+            endpoint='http://eu01.alma.exlibrisgroup.com/view/oai/47BIBSYS_NETWORK/request',
+            metadata_prefix="marc21",
+            metadata_schema="http://www.loc.gov/MARC21/slim",
+            oai_set="oai_komplett",
+            storage_dir=storage_dir,
+        )
+    elif source == 'noraf':
+        settings = OaiPmhSettings(
+            endpoint='https://authority.bibsys.no/authority/rest/oai',
+            metadata_prefix="marcxchange",
+            metadata_schema="info:lc/xmlns/marcxchange-v1",
+            oai_set="bibsys_authorities",
+            storage_dir=storage_dir,
+            extractors=['vocabularies', 'names', 'identifiers'],
+        )
+    else:
+        raise Exception('Unknown source')
+    return settings
+
+
 def main():
     """
     Scriptet oppdaterer personposter i Bibbi (via SQL) og Noraf (via REST-API) basert på inputt
@@ -47,8 +99,21 @@ def main():
     parser_harvest = subparsers.add_parser('harvest', help='Harvest records')
     parser_harvest.add_argument(
         'source',
+        nargs='?',
         help='alma, noraf or bibbi'
     )
+    parser_harvest.add_argument(
+        '--all',
+        action='store_true',
+        help='harvest all configured sources (%s) concurrently, into --harvest-root' % ', '.join(ALL_SOURCES)
+    )
+    parser_harvest.add_argument(
+        '--harvest-root',
+        action=WritableDir,
+        default=default_destination_dir,
+        help='with --all, the dir to harvest into, with a subdir for each source (default: %s)'
+             % default_destination_dir
+    )
     parser_harvest.add_argument(
         'destination_dir',
         nargs='?',
@@ -56,11 +121,266 @@ def main():
         default=default_destination_dir,
         help='destination dir for the xml files'
     )
+    parser_harvest.add_argument(
+        '--pipeline',
+        action='store_true',
+        help='fetch pages in a separate thread while a pool of workers parses and stores the records'
+    )
+    parser_harvest.add_argument(
+        '--workers',
+        type=int,
+        default=4,
+        help='number of parse/write workers in pipeline mode (default: 4)'
+    )
+    parser_harvest.add_argument(
+        '--queue-size',
+        type=int,
+        default=8,
+        help='max number of fetched pages waiting to be parsed in pipeline mode (default: 8)'
+    )
 
-    parser_extract = subparsers.add_parser('extract', help='Extract data')
+    parser_harvest.add_argument(
+        '--partitions',
+        type=int,
+        help='split the datestamp range into this many windows and harvest them concurrently'
+    )
+    parser_harvest.add_argument(
+        '--sets',
+        help='comma-separated list of sets to harvest concurrently, or "all" for all sets from ListSets'
+    )
+    parser_harvest.add_argument(
+        '--store',
+        choices=[STORE_FILES, STORE_SEGMENTS],
+        help='storage layout for a new harvest: one file per record, or append-only segment files. '
+             'Detected from the destination dir if not set.'
+    )
+    parser_harvest.add_argument(
+        '--compression',
+        choices=CODECS,
+        help='compress new records. Defaults to the compression used by the last harvest into the same dir.'
+    )
+    parser_harvest.add_argument(
+        '--max-retries',
+        type=int,
+        default=8,
+        help='number of times to retry a failed request before giving up (default: 8)'
+    )
+    parser_harvest.add_argument(
+        '--rate-limit',
+        type=float,
+        help='max requests per second to each endpoint'
+    )
+    parser_harvest.add_argument(
+        '--extractors',
+        help='comma-separated list of indexes to update from the records during the harvest: %s. Defaults to '
+             'bibbi for the bibbi source and vocabularies,names,identifiers for the noraf source.'
+             % ', '.join(EXTRACTORS)
+    )
+    parser_harvest.add_argument(
+        '--snapshots',
+        type=int,
+        default=0,
+        help='take a snapshot of the store for readers at the end of the harvest, keeping this many '
+             'snapshot generations (default: 0, no snapshots)'
+    )
+    parser_harvest.add_argument(
+        '--report-interval',
+        type=float,
+        default=60,
+        help='seconds between the combined progress reports with --all (default: 60)'
+    )
+    parser_harvest.add_argument(
+        '--prometheus-textfile',
+        type=Path,
+        help='also write the harvest metrics to this file in Prometheus text format, '
+             'e.g. in the node_exporter textfile collector dir'
+    )
+
+    parser_sets = subparsers.add_parser('sets', help='List the sets exposed by the endpoint')
+    parser_sets.add_argument(
+        'source',
+        help='alma, noraf or bibbi'
+    )
+    parser_sets.set_defaults(destination_dir=default_destination_dir)
+
+    parser_compact = subparsers.add_parser(
+        'compact',
+        help='Rewrite the stored records, dropping old versions from segment stores and converting '
+             'all records to the current compression'
+    )
+    parser_compact.add_argument(
+        'source',
+        help='alma, noraf or bibbi'
+    )
+    parser_compact.add_argument(
+        'destination_dir',
+        nargs='?',
+        action=WritableDir,
+        default=default_destination_dir,
+        help='harvest dir'
+    )
+    parser_compact.add_argument(
+        '--compression',
+        choices=CODECS,
+        help='compression to convert the records to'
+    )
+    parser_compact.add_argument(
+        '--train-dictionary',
+        action='store_true',
+        help='train a new zstd dictionary on the stored records before rewriting them'
+    )
+
+    parser_index = subparsers.add_parser('index', help='Build indexes from the records already harvested')
+    parser_index.add_argument(
+        'source',
+        help='alma, noraf or bibbi'
+    )
+    parser_index.add_argument(
+        'destination_dir',
+        nargs='?',
+        action=WritableDir,
+        default=default_destination_dir,
+        help='harvest dir'
+    )
+    parser_index.add_argument(
+        '--extractors',
+        default=','.join(EXTRACTORS),
+        help='comma-separated list of indexes to build (default: all): %s' % ', '.join(EXTRACTORS)
+    )
+
+    parser_reconcile = subparsers.add_parser(
+        'reconcile',
+        help='Compare the harvest with the headers from ListIdentifiers, and fetch missing and stale records '
+             'and apply deletes, instead of a full harvest'
+    )
+    parser_reconcile.add_argument(
+        'source',
+        help='alma, noraf or bibbi'
+    )
+    parser_reconcile.add_argument(
+        'destination_dir',
+        nargs='?',
+        action=WritableDir,
+        default=default_destination_dir,
+        help='harvest dir'
+    )
+    parser_reconcile.add_argument(
+        '--workers',
+        type=int,
+        help='max concurrent GetRecord requests (default: 8)'
+    )
+    parser_reconcile.add_argument(
+        '--max-orphaned',
+        type=float,
+        default=0.1,
+        help='max share of the records in the store that may be deleted because the server no longer lists '
+             'them, as a fraction. Reconcile stops without changes if more are missing (default: 0.1)'
+    )
+
+    parser_snapshot = subparsers.add_parser(
+        'snapshot',
+        help='Take a snapshot of the store for readers. Must not run at the same time as a harvest.'
+    )
+    parser_snapshot.add_argument(
+        'source',
+        help='alma, noraf or bibbi'
+    )
+    parser_snapshot.add_argument(
+        'destination_dir',
+        nargs='?',
+        action=WritableDir,
+        default=default_destination_dir,
+        help='harvest dir'
+    )
+    parser_snapshot.add_argument(
+        '--keep',
+        type=int,
+        default=2,
+        help='snapshot generations to keep, pinned snapshots are always kept (default: 2)'
+    )
+
+    parser_serve = subparsers.add_parser(
+        'serve',
+        help='Run a local OAI-PMH server with synthetic or previously harvested records, for testing'
+    )
+    add_server_arguments(parser_serve)
+    parser_serve.add_argument(
+        '--port',
+        type=int,
+        default=8000,
+        help='port to listen on (default: 8000)'
+    )
+
+    parser_benchmark = subparsers.add_parser(
+        'benchmark',
+        help='Harvest from a local OAI-PMH server and report records/sec, CPU time and peak RSS'
+    )
+    add_server_arguments(parser_benchmark)
+    parser_benchmark.add_argument(
+        '--method',
+        choices=list(HARVEST_METHODS),
+        default='harvest',
+        help='harvest method to benchmark (default: harvest)'
+    )
+    parser_benchmark.add_argument(
+        '--workers',
+        type=int,
+        default=4,
+        help='workers for the pipelined harvest, or windows for the partitioned harvest (default: 4)'
+    )
+    parser_benchmark.add_argument(
+        '--store',
+        choices=[STORE_FILES, STORE_SEGMENTS],
+        help='store the records as one file per record (default) or in segment files'
+    )
+    parser_benchmark.add_argument(
+        '--compression',
+        choices=CODECS,
+        help='compression of the stored records'
+    )
+    parser_benchmark.add_argument(
+        '--json',
+        type=Path,
+        help='also write the result to this file as JSON'
+    )
+
+    parser_extract = subparsers.add_parser('extract', help='Extract fields from the harvested records')
+    parser_extract.add_argument(
+        'source',
+        help='alma, noraf or bibbi'
+    )
+    parser_extract.add_argument(
+        'destination_dir',
+        nargs='?',
+        action=WritableDir,
+        default=default_destination_dir,
+        help='harvest dir'
+    )
     parser_extract.add_argument(
-        'dir',
-        help='Source dir for the xml files'
+        '--fields',
+        default='id,type,name,dates',
+        help='comma-separated list of fields to extract (default: id,type,name,dates): %s' % ', '.join(RECORD_FIELDS)
+    )
+    parser_extract.add_argument(
+        '--format',
+        choices=['jsonl', 'csv'],
+        default='jsonl',
+        help='output format (default: jsonl)'
+    )
+    parser_extract.add_argument(
+        '-o', '--output',
+        type=Path,
+        help='output file (default: stdout)'
+    )
+    parser_extract.add_argument(
+        '--workers',
+        type=int,
+        help='number of processes decoding the records (default: one per CPU)'
+    )
+    parser_extract.add_argument(
+        '--unordered',
+        action='store_true',
+        help='write the records as they are decoded instead of in store order, which is faster'
     )
 
     args = parser.parse_args()
@@ -73,45 +393,212 @@ def main():
     else:
         logger.setLevel(logging.INFO)
 
+    if args.cmd in ('serve', 'benchmark'):
+        records = stored_records(args.records_from) if args.records_from else synthetic_records(args.records)
+        server_settings = OaiServerSettings(
+            page_size=args.page_size,
+            latency=args.latency,
+            error_rate=args.error_rate,
+            truncate_rate=args.truncate_rate,
+            token_expiry=args.token_expiry,
+            seed=args.seed,
+        )
+        if args.cmd == 'serve':
+            return serve(records, server_settings, port=args.port)
+        result = run_benchmark(records, server_settings, method=args.method, workers=args.workers,
+                               store=args.store, compression=args.compression)
+        logger.info(str(result))
+        if args.json:
+            with args.json.open('w', encoding='utf-8') as fp:
+                json.dump(result.serialize(), fp, indent=2)
+        return
+
     if not args.destination_dir:
         print("ERR: Destination dir not set")
 
+    if args.cmd == 'harvest' and args.all:
+        if args.source is not None:
+            parser.error('--all harvests every source, give the destination dir with --harvest-root')
+        return harvest_all(args)
+    if args.source is None:
+        parser.error('source is required')
+
     storage_dir: Path = args.destination_dir.joinpath(args.source)
     storage_dir.mkdir(exist_ok=True)
 
-    if args.source == 'bibbi':
-        if not os.getenv('BIBBI_OAI_USER') or not os.getenv('BIBBI_OAI_PASSWORD'):
-            raise Exception('BIBBI_OAI_USER and/or BIBBI_OAI_PASSWORD not configured')
-        settings = OaiPmhSettings(
-            endpoint='https://oai.aja.bs.no/bibbi',
-            metadata_prefix="marc21",
-            metadata_schema="info:lc/xmlns/marcxchange-v1",
-            storage_dir=storage_dir,
-            request_args={'auth': (
-                os.getenv('BIBBI_OAI_USER').encode('utf-8'),
-                os.getenv('BIBBI_OAI_PASSWORD').encode('utf-8')
-            )},
-        )
+    if args.cmd == 'compact':
+        if args.train_dictionary:
+            with open_store(storage_dir, readonly=True) as store:
+                train_dictionary(storage_dir, (data for record_id, data in store.scan()))
+        store = open_store(storage_dir, compression=args.compression)
+        size_before, size_after = store.compact()
+        store.close()
+        logger.info('Compacted %s: %d MB -> %d MB', storage_dir, size_before // 1024 ** 2, size_after // 1024 ** 2)
+        return
 
-    elif args.source == 'alma':
-        settings = OaiPmhSettings(
-            endpoint='http://eu01.alma.exlibrisgroup.com/view/oai/47BIBSYS_NETWORK/request',
-            metadata_prefix="marc21",
-            metadata_schema="http://www.loc.gov/MARC21/slim",
-            oai_set="oai_komplett",
-            storage_dir=storage_dir,
-        )
-    elif args.source == 'noraf':
-        settings = OaiPmhSettings(
-            endpoint='https://authority.bibsys.no/authority/rest/oai',
-            metadata_prefix="marcxchange",
-            metadata_schema="info:lc/xmlns/marcxchange-v1",
-            oai_set="bibsys_authorities",
-            storage_dir=storage_dir,
-        )
+    if args.cmd == 'snapshot':
+        with open_store(storage_dir) as store:
+            create_snapshot(storage_dir, store)
+        prune_snapshots(storage_dir, args.keep)
+        return
+
+    settings = source_settings(args.source, storage_dir)
+
+    if args.cmd == 'index':
+        extractors = open_extractors(storage_dir, args.extractors.split(','))
+        with open_store(storage_dir, readonly=True) as store:
+            count = build_extractors(store, extractors, settings.metadata_schema)
+        for extractor in extractors:
+            extractor.close()
+        logger.info('Indexed %d records', count)
+        return
+
+    if args.cmd == 'extract':
+        count = extract(HarvestReader(storage_dir, settings.metadata_schema, workers=args.workers,
+                                      ordered=not args.unordered), args)
+        logger.info('Extracted %d records', count)
+        return
+
+    if args.cmd == 'reconcile':
+        OaiPmh(settings).reconcile(workers=args.workers, dry_run=args.dry_run, max_orphaned=args.max_orphaned)
+        return
+
+    if args.cmd == 'sets':
+        for spec, name in OaiPmh(settings).list_sets():
+            print('%s\t%s' % (spec, name))
+        return
+
+    provider = OaiPmh(harvest_settings(settings, args))
+    run_harvest(provider, args)
+
+
+def add_server_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        '--records',
+        type=int,
+        default=10000,
+        help='number of synthetic records to serve (default: 10000)'
+    )
+    parser.add_argument(
+        '--records-from',
+        type=Path,
+        help='serve the records of this harvest dir instead of synthetic records'
+    )
+    parser.add_argument(
+        '--page-size',
+        type=int,
+        default=100,
+        help='records per page (default: 100)'
+    )
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=0.0,
+        help='seconds to wait before each response'
+    )
+    parser.add_argument(
+        '--error-rate',
+        type=float,
+        default=0.0,
+        help='share of the requests to answer with 503'
+    )
+    parser.add_argument(
+        '--truncate-rate',
+        type=float,
+        default=0.0,
+        help='share of the pages and GetRecord responses to cut off halfway'
+    )
+    parser.add_argument(
+        '--token-expiry',
+        type=float,
+        help='seconds before a resumption token expires'
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        help='seed for the error injection'
+    )
+
+
+def extract(reader: HarvestReader, args: argparse.Namespace) -> int:
+    fields = args.fields.split(',')
+    for name in fields:
+        if name not in RECORD_FIELDS:
+            raise ValueError('Unknown field: %s. Available: %s' % (name, ', '.join(RECORD_FIELDS)))
+    fp = args.output.open('w', encoding='utf-8', newline='') if args.output else sys.stdout
+    count = 0
+    try:
+        if args.format == 'csv':
+            writer = csv.DictWriter(fp, fieldnames=fields)
+            writer.writeheader()
+            for values in reader.fields(fields):
+                writer.writerow({name: csv_value(value) for name, value in values.items()})
+                count += 1
+        else:
+            for values in reader.fields(fields):
+                fp.write(json.dumps(values, ensure_ascii=False) + '\n')
+                count += 1
+    finally:
+        if fp is not sys.stdout:
+            fp.close()
+    return count
+
+
+def csv_value(value) -> str:
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        return ' || '.join(value)
+    if isinstance(value, dict):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+
+def harvest_settings(settings: OaiPmhSettings, args: argparse.Namespace) -> OaiPmhSettings:
+    settings.store = args.store
+    settings.compression = args.compression
+    settings.prometheus_textfile = args.prometheus_textfile
+    settings.max_retries = args.max_retries
+    settings.rate_limit = args.rate_limit
+    if args.extractors:
+        settings.extractors = args.extractors.split(',')
+    settings.snapshots = args.snapshots
+    return settings
+
+
+def run_harvest(provider: OaiPmh, args: argparse.Namespace) -> None:
+    if args.sets == 'all':
+        provider.harvest_sets([spec for spec, name in provider.list_sets()])
+    elif args.sets:
+        provider.harvest_sets(args.sets.split(','))
+    elif args.partitions:
+        provider.harvest_partitioned(args.partitions)
+    elif args.pipeline:
+        provider.harvest_pipelined(workers=args.workers, queue_size=args.queue_size)
     else:
-        raise Exception('Unknown source')
+        provider.harvest()
+
 
-    provider = OaiPmh(settings)
-    provider.harvest()
+def harvest_all(args: argparse.Namespace) -> None:
+    """Harvest all configured sources concurrently, each into its own dir under the harvest root."""
+    args.harvest_root.mkdir(parents=True, exist_ok=True)
+    providers = {}
+    for source in ALL_SOURCES:
+        storage_dir = args.harvest_root.joinpath(source)
+        try:
+            settings = source_settings(source, storage_dir)
+        except Exception as exc:
+            logger.warning('Skipping %s: %s', source, exc)
+            continue
+        storage_dir.mkdir(exist_ok=True)
+        settings = harvest_settings(settings, args)
+        if settings.prometheus_textfile is not None:
+            # One textfile per source, since each file is replaced as a whole
+            settings.prometheus_textfile = settings.prometheus_textfile.with_name(
+                '%s_%s' % (source, settings.prometheus_textfile.name))
+        providers[source] = OaiPmh(settings)
 
+    errors = harvest_concurrently(providers, lambda provider: run_harvest(provider, args), args.report_interval)
+    failed = [source for source, error in errors.items() if error is not None]
+    if failed:
+        raise SystemExit('Harvest failed for: %s' % ', '.join(failed))
@@ -9,15 +9,17 @@ import time
 import pickle
 from pathlib import Path
 from textwrap import dedent
-from typing import List
+from typing import List, Optional
 
 from dotenv import load_dotenv
 
+from seiso.common.harvest_extractors import IdentifierIndex, StatusIndex, index_dir
 from seiso.common.noraf_record import NorafJsonRecord
 from seiso.common.logging import setup_logging
 from seiso.console.helpers import Report, ReportHeader, storage_path
 from seiso.services.noraf import Noraf, TYPE_PERSON, NorafRecordNotFound, NorafUpdateFailed, TYPE_CORPORATION, \
     TYPE_CONFERENCE
+from seiso.services.oai import HarvestSummary, summary_path
 from seiso.services.promus import Promus
 from seiso.services.promus.authorities import (
     BibbiCorporationRecord,
@@ -37,9 +39,12 @@ class Processor:
 
     cache_filename = 'bibbi_records.cache'
 
-    def __init__(self, noraf: Noraf, promus: Promus):
+    def __init__(self, noraf: Noraf, promus: Promus, status_index: Optional[StatusIndex] = None,
+                 identifier_index: Optional[IdentifierIndex] = None):
         self.noraf: Noraf = noraf
         self.promus: Promus = promus
+        self.status_index = status_index
+        self.identifier_index = identifier_index
         self.overview_report: Report = Report()
         self.error_report: Report = Report()
 
@@ -102,8 +107,9 @@ class Processor:
                     continue
                 noraf_id = str(bibbi_rec.NB_ID)
                 try:
-                    noraf_rec = self.noraf.get(noraf_id)
-                    self.check_link(record_type, bibbi_rec, noraf_rec)
+                    if not self.check_status(record_type, bibbi_rec, noraf_id):
+                        noraf_rec = self.noraf.get(noraf_id)
+                        self.check_link(record_type, bibbi_rec, noraf_rec)
                 except NorafRecordNotFound:
                     self.add_row(self.error_report, bibbi_rec, [
                         '{NORAF}' + noraf_id,
@@ -166,14 +172,15 @@ class Processor:
         self,
         record_type: str,
         bibbi_rec: BibbiAuthorityRecord,
-        old_noraf_rec: NorafJsonRecord,
+        old_noraf_id: str,
+        old_noraf_label: str,
         new_noraf_rec_id: str,
     ):
         replacement_record = self.noraf.get(new_noraf_rec_id)
 
         msg = 'replace_promus_link: Noraf-posten %s (%s) har blitt erstattet av %s (%s)' % (
-            old_noraf_rec.id,
-            str(old_noraf_rec),
+            old_noraf_id,
+            old_noraf_label,
             replacement_record.id,
             str(replacement_record)
         )
@@ -191,6 +198,89 @@ class Processor:
         time.sleep(10)
         return replacement_record
 
+    def find_replacement(self, record_type: str, bibbi_rec: BibbiAuthorityRecord, noraf_id: str,
+                         noraf_label: str) -> Optional[NorafJsonRecord]:
+        """Handle a link to a deleted Noraf record without a known replacement: Look for a single other Noraf
+        record linking to the Bibbi record, and link to it instead. Returns the replacement, or None if an
+        error was reported."""
+        bibbi_id = str(bibbi_rec.Bibsent_ID)
+        rec_ids = self.find_noraf_ids(bibbi_id)
+        rec_ids = [rec_id for rec_id in rec_ids if rec_id != noraf_id]
+        if len(rec_ids) == 1 and self.identifier_index is not None and not self.links_to_bibbi(rec_ids[0], bibbi_id):
+            # The index is behind the API, so don't link to a record from it that the API doesn't confirm
+            logger.warning('Noraf record %s links to Bibbi record %s in the identifier index, but not in the API',
+                           rec_ids[0], bibbi_id)
+            rec_ids = [rec_id for rec_id in self.find_noraf_ids(bibbi_id, use_index=False) if rec_id != noraf_id]
+        if len(rec_ids) == 1:
+            return self.replace_promus_link(record_type, bibbi_rec, noraf_id, noraf_label, rec_ids[0])
+        elif len(rec_ids) > 1:
+            self.add_row(self.error_report, bibbi_rec, [
+                '{NORAF}' + noraf_id,
+                'Noraf-posten har blitt slettet. Fant mer enn én annen Noraf-post som lenker til Bibbi-posten.',
+            ])
+        else:
+            self.add_row(self.error_report, bibbi_rec, [
+                '{NORAF}' + noraf_id,
+                'Noraf-posten har blitt slettet uten at Bibbi-ID-en har blitt overført til en ny post.',
+            ])
+        if self.identifier_index is None:
+            time.sleep(8)
+        return None
+
+    def find_noraf_ids(self, bibbi_id: str, use_index: bool = True) -> List[str]:
+        """Ids of the Noraf records linking to the Bibbi record, from the identifier index of the OAI-PMH
+        harvest if there is one, or else from the SRU API."""
+        if use_index and self.identifier_index is not None:
+            return self.identifier_index.lookup('bibbi', bibbi_id)
+        bibbi_uri = f"https://id.bs.no/bibbi/{bibbi_id}"
+        recs = list(self.noraf.sru_search('bib.identifierAuthority=%s' % bibbi_id))
+        return [
+            x.id
+            for x in recs
+            if bibbi_id in x.other_ids.get("bibbi", [])
+            or bibbi_uri in x.other_ids.get("bibbi", [])
+        ]
+
+    def links_to_bibbi(self, noraf_id: str, bibbi_id: str) -> bool:
+        """Whether the API has the Noraf record as live and linking to the Bibbi record."""
+        try:
+            noraf_rec = self.noraf.get(noraf_id)
+        except NorafRecordNotFound:
+            return False
+        bibbi_ids = noraf_rec.identifiers('bibbi')
+        return not noraf_rec.deleted and (bibbi_id in bibbi_ids or f'https://id.bs.no/bibbi/{bibbi_id}' in bibbi_ids)
+
+    def check_status(self, record_type: str, bibbi_rec: BibbiAuthorityRecord, noraf_id: str) -> bool:
+        """Handle links to deleted and replaced records using the status index from the OAI-PMH harvest, which
+        knows replacements the API doesn't tell. Returns False if the link must be checked with the API, i.e. if
+        the record is live or unknown to the harvest. The index may be behind the API, so the deletion is
+        confirmed with the API before anything is changed in Promus."""
+        if self.status_index is None:
+            return False
+        status = self.status_index.get(noraf_id)
+        if status is None or status.live:
+            return False
+        current = self.status_index.resolve(noraf_id)
+        if current is None:
+            return False
+        api_rec = self.noraf.get(noraf_id)
+        if not api_rec.deleted:
+            logger.warning('Noraf record %s is %s in the status index, but not deleted in the API',
+                           noraf_id, status.status)
+            self.check_link(record_type, bibbi_rec, api_rec)
+            return True
+        label = 'status i OAI-PMH-høstingen: %s' % status.status
+        noraf_rec: Optional[NorafJsonRecord]
+        if current.live:
+            logger.debug('Noraf record %s has been replaced by %s', noraf_id, current.record_id)
+            noraf_rec = self.replace_promus_link(record_type, bibbi_rec, noraf_id, label, current.record_id)
+        else:
+            logger.debug('Noraf record %s has been deleted', noraf_id)
+            noraf_rec = self.find_replacement(record_type, bibbi_rec, noraf_id, label)
+        if noraf_rec is not None:
+            self.check_link(record_type, bibbi_rec, noraf_rec)
+        return True
+
     def check_link(self, record_type: str, bibbi_rec: BibbiAuthorityRecord, noraf_rec: NorafJsonRecord):
         logger.debug('%s "%s" <> %s "%s"', bibbi_rec.Bibsent_ID, bibbi_rec.label(), noraf_rec.id, noraf_rec.name)
         noraf_update_reasons = []
@@ -202,34 +292,13 @@ class Processor:
         if noraf_rec.deleted:
             if noraf_rec.replaced_by is not None and len(noraf_rec.replaced_by) > 1:
                 noraf_rec = self.replace_promus_link(
-                    record_type, bibbi_rec, noraf_rec, noraf_rec.replaced_by
+                    record_type, bibbi_rec, noraf_rec.id, str(noraf_rec), noraf_rec.replaced_by
                 )
             else:
-                recs = list(self.noraf.sru_search('bib.identifierAuthority=%s' % bibbi_id))
-                recs = [
-                    x
-                    for x in recs
-                    if bibbi_id in x.other_ids.get("bibbi", [])
-                    or bibbi_uri in x.other_ids.get("bibbi", [])
-                ]
-                if len(recs) == 1:
-                    noraf_rec = self.replace_promus_link(
-                        record_type, bibbi_rec, noraf_rec, recs[0].id
-                    )
-                elif len(recs) > 1:
-                    self.add_row(self.error_report, bibbi_rec, [
-                        '{NORAF}' + noraf_rec.id,
-                        'Noraf-posten har blitt slettet. Fant mer enn én annen Noraf-post som lenker til Bibbi-posten.',
-                    ])
-                    time.sleep(8)
-                    return
-                else:
-                    self.add_row(self.error_report, bibbi_rec, [
-                        '{NORAF}' + noraf_rec.id,
-                        'Noraf-posten har blitt slettet uten at Bibbi-ID-en har blitt overført til en ny post.',
-                    ])
-                    time.sleep(8)
+                replacement = self.find_replacement(record_type, bibbi_rec, noraf_rec.id, str(noraf_rec))
+                if replacement is None:
                     return
+                noraf_rec = replacement
 
         # 2. Check that record type matches expected record type
         if noraf_rec.record_type != record_type:
@@ -326,6 +395,10 @@ def main():
             
             Foreløpig gjør det ikke noe med nasjonalitet, datoer osv., men det kan nok legges til.
 
+            Finnes det en OAI-PMH-høsting av NORAF (--harvest-dir), brukes statusindeksen i høstingen til å
+            finne slettede og erstattede poster uten å hente dem fra API-et, og identifikatorindeksen til å
+            finne andre NORAF-poster som lenker til BIBBI-posten uten å søke i SRU-API-et.
+
             Scriptet lager to sett med Excel-filer:
               (1) bibbi-noraf-overgang - (type).xlsx : Oversikt over alle mappingene
               (2) bibbi-noraf-overgang - feil.xlsx : Oversikt over alle feil som ikke kunne rettes automatisk
@@ -336,6 +409,9 @@ def main():
 
     parser.add_argument('-v', '--verbose', action='store_true', help='More verbose output.')
     parser.add_argument('--dry-run', action='store_true', help='Dry run mode.')
+    parser.add_argument('--harvest-dir', type=Path, default=storage_path('oai-harvest/noraf', create=False),
+                        help='OAI-PMH harvest of Noraf, whose status and identifier indexes are used to look up '
+                             'deleted and replaced records and links to Bibbi without the API.')
 
     args = parser.parse_args()
 
@@ -351,4 +427,23 @@ def main():
 
     promus = Promus(read_only_mode=args.dry_run)
 
-    Processor(noraf, promus).run()
+    # The indexes are updated as the records are harvested, so they are only complete once a harvest has ended
+    harvest = HarvestSummary.load(summary_path(args.harvest_dir))
+    harvest_ended = harvest is not None and harvest.ended is not None
+    if not harvest_ended:
+        logger.warning('The harvest in %s has not been completed, so its indexes are not used', args.harvest_dir)
+
+    status_index = None
+    if harvest_ended and index_dir(args.harvest_dir).joinpath('%s.sqlite' % StatusIndex.name).exists():
+        status_index = StatusIndex(args.harvest_dir, readonly=True)
+    else:
+        logger.info('No status index found in %s, checking all records with the API', args.harvest_dir)
+
+    identifier_index = None
+    if harvest_ended and index_dir(args.harvest_dir).joinpath('%s.sqlite' % IdentifierIndex.name).exists():
+        identifier_index = IdentifierIndex(args.harvest_dir, readonly=True)
+    else:
+        logger.info('No identifier index found in %s, searching for links to Bibbi with the SRU API',
+                    args.harvest_dir)
+
+    Processor(noraf, promus, status_index, identifier_index).run()
@@ -5,7 +5,6 @@ from __future__ import annotations
 import argparse
 import logging
 import os
-import json
 from dataclasses import dataclass, field
 from pathlib import Path
 from textwrap import dedent
@@ -14,14 +13,17 @@ from typing import Sequence, Optional
 import mdmail
 from dotenv import load_dotenv
 
-from seiso.common.noraf_record import NorafXmlRecord
+from seiso.common.harvest_extractors import BibbiIndex, VocabularyIndex, index_dir
+from seiso.common.harvest_journal import OP_UPSERT, JournalConsumer
+from seiso.common.harvest_reader import HarvestReader, parse_noraf_record
+from seiso.common.harvest_scan_cache import ScanCache
+from seiso.common.harvest_snapshots import PinnedSnapshot, pin_snapshot
 from seiso.common.interfaces import NorafPersonRecord, NorafRecord, NorafCorporationRecord
 from seiso.common.logging import setup_logging
 from tqdm import tqdm
-from lxml import etree
-from seiso.common.xml import XmlNode
 from seiso.console.helpers import Report, ReportHeader, storage_path
 from seiso.services.noraf import Noraf, NorafRecordNotFound
+from seiso.services.oai import HarvestSummary, summary_path
 from seiso.services.promus import Promus
 from seiso.services.promus.authorities import (
     CorporationCollection,
@@ -128,6 +130,11 @@ class SimpleBibbiRecord:
         return f"[{self.id}: {self.label}]({self.uri})"
 
 
+def bibbi_linked(record_id: str, data: bytes) -> Optional[str]:
+    """The record id if the record links to Bibbi. Run in the worker processes of the harvest reader."""
+    return record_id if b'>bibbi<' in data else None
+
+
 class IsDir(argparse.Action):
 
     def __call__(self, parser, namespace, values, option_string=None):
@@ -139,11 +146,29 @@ class IsDir(argparse.Action):
 
 class Processor:
 
-    def __init__(self, noraf: Noraf, promus: Promus, harvest_dir: Path, use_cache: bool):
+    journal_consumer_name = 'verify_noraf_bibbi_mappings'
+
+    def __init__(self, noraf: Noraf, promus: Promus, harvest_dir: Path, changes_only: bool = False,
+                 use_snapshot: bool = True, bibbi_index: Optional[BibbiIndex] = None, workers: Optional[int] = None):
         self.noraf: Noraf = noraf
         self.promus: Promus = promus
+        self.bibbi_index: Optional[BibbiIndex] = bibbi_index
+        self.vocabulary_index: Optional[VocabularyIndex] = None
+        if index_dir(harvest_dir).joinpath('%s.sqlite' % VocabularyIndex.name).exists():
+            self.vocabulary_index = VocabularyIndex(harvest_dir, readonly=True)
         self.harvest_dir: Path = harvest_dir
-        self.use_cache: bool = use_cache
+        self.changes_only: bool = changes_only
+        # Read from the latest snapshot if there is one, so a harvest running at the same time doesn't
+        # change the records under us
+        self.snapshot: Optional[PinnedSnapshot] = pin_snapshot(harvest_dir) if use_snapshot else None
+        if self.snapshot is not None:
+            log.info('Leser fra øyeblikksbilde %d av høstingen, tatt %s', self.snapshot.snapshot.generation,
+                     self.snapshot.snapshot.created.strftime('%Y-%m-%d %H:%M'))
+        # Scanning and parsing the harvest is done in a pool of worker processes, which read the records
+        # from the store themselves
+        self.reader = HarvestReader(self.snapshot.snapshot.path if self.snapshot is not None else harvest_dir,
+                                    workers=workers, chunk_size=200)
+        self.journal_consumer: Optional[JournalConsumer] = None
         self.dead_link_report: Report = Report()
         self.one_to_many_report: Report = Report()
         self.non_symmetric_report: Report = Report()
@@ -167,8 +192,11 @@ class Processor:
 
     @property
     def bibbi_noraf_mapping(self):
-        """Lazy-load the Bibbi-to-Noraf concordance from Promus."""
-        if len(self._bibbi_noraf_mapping) == 0:
+        """Lazy-load the Bibbi-to-Noraf concordance from the local Bibbi index, or from Promus."""
+        if len(self._bibbi_noraf_mapping) == 0 and self.bibbi_index is not None:
+            self._bibbi_noraf_mapping = self.bibbi_index.noraf_mapping(['person', 'corporation', 'conference'])
+            log.info('Fant %d Bibbi-autoritetsposter i den lokale Bibbi-indeksen' % len(self._bibbi_noraf_mapping))
+        elif len(self._bibbi_noraf_mapping) == 0:
             for table in ('AuthorityPerson', 'AuthorityCorp', 'AuthorityConf'):
                 for row in self.promus.connection().select(
                     f"SELECT Bibsent_ID, NB_ID FROM {table} WHERE ISNULL(Bibsent_ID, '') <> ''",
@@ -179,49 +207,72 @@ class Processor:
             log.info('Fant %d Bibbi-autoritetsposter i Promus med lenke til Noraf' % len(self._bibbi_noraf_mapping))
         return self._bibbi_noraf_mapping
 
-    def find_harvest_files(self):
-        """Filter files in the Noraf harvest directory that contain mappings to Bibbi"""
-        filelist_cache = self.harvest_dir.joinpath('bibbi_list.json')
-
-        if self.use_cache:
-            with filelist_cache.open('r', encoding='utf-8') as fp:
-                bibbi_files = json.load(fp)
-            return bibbi_files
-
-        all_files = []
-        for dirpath, dirnames, filenames in os.walk(str(self.harvest_dir)):
-            all_files += [os.path.join(dirpath, filename) for filename in filenames if filename.endswith('.xml')]
-        bibbi_files = []
-        for filename in tqdm(all_files, desc='Scanning OAI-PMH harvest...'):
-            with open(filename, 'r', encoding='utf-8') as fp:
-                if '>bibbi<' in fp.read():
-                    bibbi_files.append(filename)
-        with filelist_cache.open('w', encoding='utf-8') as fp:
-            json.dump(bibbi_files, fp, indent=2)
-        return bibbi_files
+    def bibbi_label(self, bibbi_id: str) -> Optional[str]:
+        """The label of a Bibbi authority, or None if it doesn't exist."""
+        if self.bibbi_index is not None:
+            authority = self.bibbi_index.get(bibbi_id)
+            return authority.label if authority is not None else None
+        full_rec = self.promus.authorities.first(Bibsent_ID=bibbi_id)
+        return full_rec.label() if full_rec is not None else None
+
+    def find_harvest_records(self) -> list[str]:
+        """Find the ids of the records in the Noraf harvest that contain mappings to Bibbi"""
+        if self.changes_only:
+            self.journal_consumer = JournalConsumer(
+                self.harvest_dir,
+                self.journal_consumer_name,
+                end_offset=self.snapshot.snapshot.journal_offset if self.snapshot is not None else None,
+            )
+            if self.journal_consumer.has_cursor:
+                changes = self.journal_consumer.changed_ids()
+                log.info('Fant %d endrede Noraf-poster siden forrige kjøring', len(changes))
+                upserted = [record_id for record_id, entry in changes.items() if entry.op == OP_UPSERT]
+                if self.vocabulary_index is not None:
+                    linked = set(self.vocabulary_index.lookup('bibbi'))
+                    return [record_id for record_id in upserted if record_id in linked]
+                return list(self.reader.map_ids(bibbi_linked, upserted))
+            log.info('Ingen tidligere kjøring med --changes, sjekker hele høstingen')
+            self.journal_consumer.seek_to_end()
+
+        if self.vocabulary_index is not None:
+            # The index follows the live harvest, which may be ahead of a snapshot we're reading from.
+            # Records that are missing from the snapshot are skipped in `run`.
+            return self.vocabulary_index.lookup('bibbi')
+
+        # Without the index, scan the harvest, reading only the records changed since the last scan
+        log.info('Skanner OAI-PMH-høstingen med %d prosesser', self.reader.workers)
+        with ScanCache(index_dir(self.harvest_dir).joinpath('scan-bibbi.sqlite')) as cache:
+            return cache.scan(self.reader, bibbi_linked)
 
     def run(self):
+        try:
+            self._run()
+        finally:
+            if self.snapshot is not None:
+                self.snapshot.release()
+            if self.vocabulary_index is not None:
+                self.vocabulary_index.close()
+
+    def _run(self):
         self.notifications = []
         reports_path = storage_path('reports')
-        filenames = self.find_harvest_files()
-        log.info('Fant %d Noraf-autoritetsposter med lenke til Bibbi', len(filenames))
+        record_ids = self.find_harvest_records()
+        log.info('Fant %d Noraf-autoritetsposter med lenke til Bibbi', len(record_ids))
         self.stats = {}
-        for filename in tqdm(filenames, desc='Checking NORAF records'):
-            with open(filename, 'rb') as fp:
-                doc = XmlNode(
-                    etree.parse(fp),
-                    'info:lc/xmlns/marcxchange-v1',
-                    {'oai': 'http://www.openarchives.org/OAI/2.0/'}
-                )
-                noraf_rec = NorafXmlRecord.parse(doc)
-                if noraf_rec is None:
-                    log.warning('Klarte ikke å tolke Noraf-posten: %s' % filename)
-                else:
-                    self.process_noraf_record(noraf_rec)
-                    
+        # Only the fixes and reports are done here, the records are read and parsed by the workers
+        parsed = 0
+        for noraf_rec in tqdm(self.reader.map_ids(parse_noraf_record, record_ids), total=len(record_ids),
+                              desc='Checking NORAF records'):
+            parsed += 1
+            self.process_noraf_record(noraf_rec)
+
             #if len(self.notifications) > 10:
             #    break
 
+        if parsed < len(record_ids):
+            log.warning('%d Noraf-poster finnes ikke lenger i høstingen eller kunne ikke tolkes',
+                        len(record_ids) - parsed)
+
         self.dead_link_report.save_excel(
             reports_path.joinpath('noraf-bibbi-overgang - døde lenker.xlsx'), headers=[
                 ReportHeader('Kildepost', 'ID', 20),
@@ -268,6 +319,9 @@ class Processor:
         for k, v in self.stats.items():
             print('%s: %s' % (k, v))
 
+        if self.journal_consumer is not None:
+            self.journal_consumer.commit()
+
         # send_email(self.notifications)
 
     def process_dead_link(
@@ -501,16 +555,22 @@ class Processor:
         if n_links > 1:
             row = []
             for bibbi_id in bibbi_ids:
-                full_rec = self.promus.authorities.first(Bibsent_ID=bibbi_id)
-                if full_rec is not None:
+                label = self.bibbi_label(bibbi_id)
+                if label is not None:
                     row.append('{BIBBI}' + bibbi_id)
-                    row.append(full_rec.label())
+                    row.append(label)
             self.add_row(self.one_to_many_report, noraf_rec, row)
 
         # Check if all links are valid
         for bibbi_id in bibbi_ids:
 
             if bibbi_id not in self.bibbi_noraf_mapping:
+                if self.bibbi_index is not None and self.promus.authorities.first(Bibsent_ID=bibbi_id) is not None:
+                    # The Bibbi index lags behind Promus, so the record was added after the harvest.
+                    # process_non_symmetric_link re-reads the record from Promus before changing anything.
+                    log.warning(f"Bibbi-posten {bibbi_id} mangler i Bibbi-indeksen, men finnes i Promus")
+                    self.process_non_symmetric_link(noraf_rec, bibbi_id)
+                    continue
                 # Case 1: Bibbi-posten har blitt slettet
                 self.process_dead_link(noraf_rec, bibbi_id)
 
@@ -521,6 +581,30 @@ class Processor:
                 self.process_non_symmetric_link(noraf_rec, bibbi_id)
 
 
+def open_bibbi_index(bibbi_harvest_dir: Path, noraf_harvest_dir: Path) -> BibbiIndex:
+    """Open the Bibbi index, refusing one from an unfinished harvest or one older than the Noraf harvest."""
+    if not index_dir(bibbi_harvest_dir).joinpath('%s.sqlite' % BibbiIndex.name).exists():
+        raise SystemExit('No Bibbi index found in %s, see "oai index bibbi"' % bibbi_harvest_dir)
+
+    # The index is updated as the records are harvested, so it is only complete once a harvest has ended
+    bibbi_harvest = HarvestSummary.load(summary_path(bibbi_harvest_dir))
+    if bibbi_harvest is None or bibbi_harvest.ended is None:
+        raise SystemExit('The Bibbi harvest in %s has not been completed, so its index is not used'
+                         % bibbi_harvest_dir)
+
+    noraf_harvest = HarvestSummary.load(summary_path(noraf_harvest_dir))
+    if noraf_harvest is None:
+        raise SystemExit('No harvest summary found in %s' % noraf_harvest_dir)
+    noraf_harvested = noraf_harvest.ended or noraf_harvest.started
+    if bibbi_harvest.ended < noraf_harvested:
+        raise SystemExit('The Bibbi harvest in %s ended %s, before the Noraf harvest in %s (%s). '
+                         'Update it with "oai harvest bibbi" or leave out --bibbi-index.'
+                         % (bibbi_harvest_dir, bibbi_harvest.ended.isoformat(), noraf_harvest_dir,
+                            noraf_harvested.isoformat()))
+
+    return BibbiIndex(bibbi_harvest_dir, readonly=True)
+
+
 def main():
     default_harvest_dir = storage_path("oai-harvest/noraf", create=False)
 
@@ -557,7 +641,28 @@ def main():
                         help='destination dir for the xml files')
     parser.add_argument('--use-cache',
                         action='store_true',
-                        help='use cached version of file list')
+                        help='obsolete: the scan of the harvest is always cached, and only changed records are read')
+    parser.add_argument('--changes',
+                        action='store_true',
+                        help='only check Noraf records changed since the last run with --changes, using the '
+                             'harvest journal. Changes on the Bibbi side are not picked up, so a full run '
+                             'is still needed now and then.')
+    parser.add_argument('--live',
+                        action='store_true',
+                        help='read the live harvest even if there are snapshots of it (see "oai snapshot")')
+    parser.add_argument('--bibbi-index',
+                        action='store_true',
+                        help='read the Bibbi-to-Noraf links and labels from the Bibbi index in --bibbi-harvest-dir '
+                             '(see "oai index bibbi") instead of from Promus. The Bibbi harvest must have ended '
+                             'no earlier than the Noraf harvest. Links are still confirmed with Promus before '
+                             'anything is changed.')
+    parser.add_argument('--bibbi-harvest-dir',
+                        type=Path,
+                        default=storage_path('oai-harvest/bibbi', create=False),
+                        help='OAI-PMH harvest of Bibbi, used with --bibbi-index')
+    parser.add_argument('--workers',
+                        type=int,
+                        help='number of processes scanning and parsing the harvest (default: one per CPU)')
     parser.add_argument('-v', '--verbose', action='store_true', help='More verbose output.')
     parser.add_argument('--dry-run', action='store_true', help='Dry run mode.')
     args = parser.parse_args()
@@ -574,5 +679,10 @@ def main():
     noraf = Noraf(noraf_key, read_only_mode=args.dry_run)
     promus = Promus(read_only_mode=args.dry_run)
 
-    Processor(noraf, promus, args.harvest_dir, args.use_cache).run()
+    bibbi_index = None
+    if args.bibbi_index:
+        bibbi_index = open_bibbi_index(args.bibbi_harvest_dir, args.harvest_dir)
+
+    Processor(noraf, promus, args.harvest_dir, args.changes, use_snapshot=not args.live,
+              bibbi_index=bibbi_index, workers=args.workers).run()
 
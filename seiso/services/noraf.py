@@ -4,7 +4,7 @@ import json
 import logging
 import os
 from datetime import datetime
-from typing import Generator, Optional, Dict
+from typing import Generator, Optional, Dict, Tuple
 from pathlib import Path
 from urllib.parse import urljoin
 
@@ -12,8 +12,11 @@ from lxml import etree  # type: ignore
 from requests import Session, HTTPError
 from sickle.oaiexceptions import NoRecordsMatch
 
-from seiso.console.helpers import log_path
+from seiso.console.helpers import log_path, storage_path
 from seiso.services.oai import OaiPmh
+from seiso.common.harvest_extractors import NameIndex, index_dir
+from seiso.common.harvest_reader import parse_noraf_record
+from seiso.common.harvest_store import HarvestStore, open_store
 
 from seiso.common.noraf_record import NorafJsonRecord, NorafXmlRecord
 from seiso.common.xml import XmlNode
@@ -47,7 +50,11 @@ class Noraf:
                  apikey: Optional[str] = None,
                  session: Optional[Session] = None,
                  update_log: Optional[Path] = None,
-                 read_only_mode: bool = True):
+                 read_only_mode: bool = True,
+                 harvest_dir: Optional[Path] = None):
+        """`harvest_dir` is the OAI-PMH harvest used by `local_search`, by default `oai-harvest/noraf`."""
+        self.harvest_dir = Path(harvest_dir) if harvest_dir is not None else None
+        self._local: Optional[Tuple[NameIndex, HarvestStore]] = None
         if update_log is None:
             update_log = log_path('noraf_updates.log')
         self.read_only_mode = read_only_mode
@@ -173,3 +180,30 @@ class Noraf:
                 yield parsed_rec
             else:
                 logger.error('%s - Record type not supported yet', rec.text(':controlfield[@tag="001"]'))
+
+    def local_search(self, name: str, dates: Optional[str] = None,
+                     limit: int = 20) -> Generator[NorafRecord, None, None]:
+        """Search the names (1XX $a and 4XX $a) of the records in the local harvest, instead of the SRU
+        endpoint, best match first. All the words in `name` must match, ignoring case and diacritics (but not
+        æ and ø, which are letters of their own). With `dates`, only records whose 1XX $d contains those
+        words (e.g. a birth year) are returned.
+
+        Requires the names index of the harvest (`oai index noraf --extractors names`). The index and the
+        store are kept open between calls, so that bulk jobs can do many searches quickly."""
+        if self._local is None:
+            if self.harvest_dir is None:
+                self.harvest_dir = storage_path('oai-harvest/noraf', create=False)
+            if not index_dir(self.harvest_dir).joinpath('%s.sqlite' % NameIndex.name).exists():
+                # oai index takes the dir holding the harvests of all the sources
+                raise FileNotFoundError('No names index in %s, run "oai index noraf %s --extractors names" first'
+                                        % (self.harvest_dir, self.harvest_dir.parent))
+            self._local = (NameIndex(self.harvest_dir, readonly=True),
+                           open_store(self.harvest_dir, readonly=True))
+        index, store = self._local
+        for record_id in index.search(name, dates=dates, limit=limit):
+            data = store.get(record_id)
+            if data is None:
+                continue
+            record = parse_noraf_record(record_id, data)
+            if record is not None:
+                yield record
@@ -3,23 +3,63 @@ from __future__ import annotations
 import json
 import logging
 import os
-import sys
+import re
+import threading
 from dataclasses import dataclass, field
-from datetime import datetime
-from hashlib import md5
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from io import BytesIO
 from json import JSONDecodeError
-from time import time
-from typing import Optional
+from queue import Queue, Empty, Full
+from time import sleep, time
+from typing import IO, Callable, Dict, Generator, List, Optional, Set, Tuple, Union
 from pathlib import Path
+from xml.sax.saxutils import unescape
 
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
 from lxml import etree  # type: ignore
-from sickle import Sickle
+from sickle import Sickle, oaiexceptions
+from sickle.response import OAIResponse
+from seiso.common.harvest_extractors import Extractor, StatusIndex, open_extractors
+from seiso.common.harvest_journal import OP_DELETE, OP_UPSERT, HarvestJournal, journal_path, read_journal
+from seiso.common.harvest_metrics import HarvestMetrics, PageMetrics
+from seiso.common.harvest_snapshots import create_snapshot, prune_snapshots
+from seiso.common.harvest_store import HarvestStore, open_store
+from seiso.common.throttle import AdaptiveThrottle
 from seiso.common.xml import XmlNode
 
 logger = logging.getLogger(__name__)
 
 TYPE_PERSON = 'PERSON'
 
+OAI_NS = 'http://www.openarchives.org/OAI/2.0/'
+
+# Only used to pick the resumption token and verb element out of the raw response in the fetch stage,
+# so that the page is parsed only once, by the worker that stores it.
+_list_records_re = re.compile(rb'<(?:[\w.-]+:)?ListRecords[\s>]')
+_resumption_token_re = re.compile(
+    rb'<(?:[\w.-]+:)?resumptionToken\b[^>]*?(?:/>|>([^<]*)</(?:[\w.-]+:)?resumptionToken>)'
+)
+
+
+class HarvestError(Exception):
+    pass
+
+
+def split_date_range(start: date, end: date, partitions: int) -> List[Tuple[str, Optional[str]]]:
+    """Split the days from `start` to `end` into at most `partitions` windows of (from, until), both inclusive.
+    The last window has no `until` date."""
+    days = max((end - start).days + 1, 1)
+    partitions = max(1, min(partitions, days))
+    bounds = [start + timedelta(days=days * n // partitions) for n in range(partitions + 1)]
+    windows: List[Tuple[str, Optional[str]]] = []
+    for n in range(partitions):
+        until = (bounds[n + 1] - timedelta(days=1)).isoformat() if n < partitions - 1 else None
+        windows.append((bounds[n].isoformat(), until))
+    return windows
+
 
 @dataclass
 class OaiPmhSettings:
@@ -29,6 +69,104 @@ class OaiPmhSettings:
     storage_dir: Path
     oai_set: Optional[str] = None
     request_args: Optional[dict] = field(default_factory=dict)
+    oai_sets: List[str] = field(default_factory=list)  # Sets to harvest concurrently with `harvest_sets`
+    store: Optional[str] = None  # 'files' or 'segments'. Detected from the storage dir if not set.
+    compression: Optional[str] = None  # 'none', 'gzip' or 'zstd'. Defaults to what the store used last time.
+    prometheus_textfile: Optional[Path] = None  # Write the harvest metrics here in Prometheus text format
+    max_retries: int = 8  # Retries per request before giving up
+    rate_limit: Optional[float] = None  # Max requests per second to the endpoint
+    max_connections: int = 8  # Size of the connection pool for the endpoint
+    extractors: List[str] = field(default_factory=list)  # Names of extractors to run on the records, see EXTRACTORS
+    status_index: bool = True  # Always keep the record status index ('status' extractor) up to date
+    snapshots: int = 0  # Snapshot generations to keep, taken at the end of each harvest. 0 disables snapshots.
+
+
+@dataclass
+class HarvestPartition:
+    """A part of a harvest, such as a datestamp window or a set, that is harvested and checkpointed on its own."""
+    oai_set: Optional[str] = None
+    from_date: Optional[str] = None
+    until_date: Optional[str] = None
+    resumption_token: Optional[str] = None
+    page_offset: int = 0  # Records of the page fetched by `resumption_token` that have already been processed
+    fetched: int = 0
+    deleted: int = 0
+    done: bool = False
+
+    def __str__(self):
+        dates = '%s..%s' % (self.from_date or '', self.until_date or '')
+        if self.oai_set is None:
+            return dates
+        if dates == '..':
+            return self.oai_set
+        return '%s %s' % (self.oai_set, dates)
+
+    def serialize(self) -> dict:
+        return {
+            'oai_set': self.oai_set,
+            'from_date': self.from_date,
+            'until_date': self.until_date,
+            'resumption_token': self.resumption_token,
+            'page_offset': self.page_offset,
+            'fetched': self.fetched,
+            'deleted': self.deleted,
+            'done': self.done,
+        }
+
+
+class SeenRecords:
+    """Thread-safe state shared by the set partitions of a harvest. Records that appear in more than one set
+    are only stored once, and deleted records are not removed right away, but written to `deletes_file` and
+    handled by `OaiPmh._apply_deletes` when all the sets are done. Servers commonly report a record as
+    deleted in a set when it leaves the set, while it's still live in another one."""
+
+    def __init__(self, deletes_file: Path):
+        self.ids: Set[str] = set()
+        self.duplicates = 0
+        self.deletes_file = deletes_file
+        self._deletes: Optional[IO[str]] = None
+        self.lock = threading.Lock()
+
+    def add(self, record_id: str) -> bool:
+        """Add a record id. Returns False if it was already seen."""
+        with self.lock:
+            if record_id in self.ids:
+                self.duplicates += 1
+                return False
+            self.ids.add(record_id)
+            return True
+
+    def add_delete(self, record: HarvestRecord) -> None:
+        with self.lock:
+            if self._deletes is None:
+                self._deletes = self.deletes_file.open('a', encoding='utf-8')
+            self._deletes.write('%s\t%s\n' % (record.record_id, record.datestamp or ''))
+
+    def flush(self) -> None:
+        with self.lock:
+            if self._deletes is not None:
+                self._deletes.flush()
+
+    def deletes(self) -> Dict[str, Optional[str]]:
+        """The deleted records with their datestamps, including those written before a restart."""
+        with self.lock:
+            if self._deletes is not None:
+                self._deletes.close()
+                self._deletes = None
+            deletes: Dict[str, Optional[str]] = {}
+            try:
+                with self.deletes_file.open('r', encoding='utf-8') as fp:
+                    for line in fp:
+                        values = line.rstrip('\n').split('\t')
+                        if line.endswith('\n') and len(values) == 2:  # Skip lines torn by a crash
+                            deletes[values[0]] = values[1] or None
+            except FileNotFoundError:
+                pass
+            return deletes
+
+
+def summary_path(harvest_dir: Path) -> Path:
+    return Path(harvest_dir).joinpath('summary.json')
 
 
 @dataclass
@@ -36,23 +174,45 @@ class HarvestSummary:
     started: datetime
     ended: Optional[datetime] = None
     resumption_token: Optional[str] = None
+    page_offset: int = 0  # Records of the page fetched by `resumption_token` that have already been processed
     fetched: int = 0
     deleted: int = 0
+    changed: int = 0
     full: bool = True
+    partitions: List[HarvestPartition] = field(default_factory=list)
+    journal_offset: Optional[int] = None  # End of the journal when a set harvest started, see `_apply_deletes`
+    # The first request of a harvest without partitions, to resume from if it stops before the first token
+    request_params: Optional[Dict[str, Optional[str]]] = None
+
+    @property
+    def resumable(self) -> bool:
+        """Whether an unfinished harvest without partitions has got far enough to be resumed."""
+        return self.resumption_token is not None or self.request_params is not None
 
     def serialize(self) -> dict:
         return {
             'started': self.started.isoformat(),
             'ended': self.ended.isoformat() if self.ended else None,
             'resumption_token': self.resumption_token,
+            'page_offset': self.page_offset,
             'fetched': self.fetched,
             'deleted': self.deleted,
+            'changed': self.changed,
             'full': self.full,
+            'partitions': [partition.serialize() for partition in self.partitions],
+            'journal_offset': self.journal_offset,
+            'request_params': self.request_params,
         }
 
     def save_summary(self, dest: Path):
-        with dest.open('w', encoding='utf-8') as fp:
+        """Save the summary atomically, so a crash leaves either the old or the new summary, never a
+        truncated one."""
+        tmp_file = dest.with_suffix('.tmp')
+        with tmp_file.open('w', encoding='utf-8') as fp:
             json.dump(self.serialize(), fp, indent=3)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_file, dest)
 
     @classmethod
     def load(cls, src: Path):
@@ -62,101 +222,1025 @@ class HarvestSummary:
                 data['started'] = datetime.fromisoformat(data['started'])
                 if data['ended'] is not None:
                     data['ended'] = datetime.fromisoformat(data['ended'])
+                data['partitions'] = [HarvestPartition(**partition) for partition in data.get('partitions', [])]
                 return cls(**data)
         except IOError:
             return None
         except JSONDecodeError:
-            logger.warning('Invalid JSON: %s', str(src))
-            return None
+            # Starting over with a full harvest could throw away days of work, so let a human decide
+            raise HarvestError('The harvest summary is not valid JSON: %s. Fix or remove it to start a new '
+                               'full harvest.' % src)
+
+
+@dataclass
+class ReconcileSummary:
+    """The differences found by `OaiPmh.reconcile` between the server and the local store."""
+    listed: int = 0  # Headers listed by the server, including deleted records
+    missing: int = 0  # Live on the server, but not in the store
+    stale: int = 0  # In the store, but with an older datestamp than on the server
+    deleted: int = 0  # Deleted on the server, but still in the store
+    orphaned: int = 0  # In the store, but not listed by the server at all
+    unknown_datestamp: int = 0  # In the store without a known datestamp, so we can't tell if they are stale
+    fetched: int = 0
+    failed: int = 0
+
+    def __str__(self):
+        return 'Listed %d headers. Missing: %d, stale: %d, deleted: %d, orphaned: %d, unknown datestamp: %d. ' \
+               'Fetched %d records, %d failed.' % (self.listed, self.missing, self.stale, self.deleted,
+                                                  self.orphaned, self.unknown_datestamp, self.fetched, self.failed)
+
+
+class ChangeManifest:
+    """The ids of the records that were actually changed by a harvest, as `<id>\t<upsert|delete>` lines.
+
+    Records that are fetched again with the same content, and deletes of records we never had,
+    are not included, so downstream tools can process only the true deltas.
+    """
+
+    def __init__(self, path: Path, count: int = 0):
+        self.path = path
+        self.count = count
+        self.lock = threading.Lock()
+        self.path.parent.mkdir(exist_ok=True)
+        self.fp = self.path.open('a', encoding='utf-8')
+
+    def add(self, record_id: str, op: str):
+        with self.lock:
+            self.fp.write('%s\t%s\n' % (record_id, op))
+            self.count += 1
+
+    def flush(self):
+        with self.lock:
+            self.fp.flush()
+
+    def close(self):
+        with self.lock:
+            self.fp.close()
+
+    @staticmethod
+    def read(path: Path) -> Generator[Tuple[str, str], None, None]:
+        """Read (record id, op) from a manifest."""
+        with path.open('r', encoding='utf-8') as fp:
+            for line in fp:
+                record_id, op = line.rstrip('\n').split('\t')
+                yield record_id, op
+
+
+@dataclass
+class HarvestRecord:
+    """A record from a ListRecords response. `element` is the metadata record element, which is only
+    valid until the parser moves on to the next record."""
+    record_id: str
+    deleted: bool
+    datestamp: Optional[str] = None
+    element: Optional[etree._Element] = None
+
+    def serialize(self) -> bytes:
+        return etree.tostring(self.element, encoding='utf-8', xml_declaration=True)
+
+
+class ListRecordsParser:
+    """Incremental parser for ListRecords responses.
+
+    The response is parsed with iterparse, and each record element is cleared as soon as it has been
+    yielded, so memory use stays flat regardless of the page size. The resumption token is available
+    from `resumption_token` once the iteration is done.
+    """
+
+    def __init__(self, source: IO[bytes], metadata_schema: str):
+        self.source = source
+        self.metadata_tag = '{%s}record' % metadata_schema
+        self.resumption_token: Optional[str] = None
+
+    def __iter__(self) -> Generator[HarvestRecord, None, None]:
+        record_tag = '{%s}record' % OAI_NS
+        token_tag = '{%s}resumptionToken' % OAI_NS
+        error_tag = '{%s}error' % OAI_NS
+        context = etree.iterparse(self.source, events=('end',), tag=(record_tag, token_tag, error_tag),
+                                  remove_blank_text=True, recover=True)
+        for _, elem in context:
+            if elem.tag == record_tag:
+                yield self._record(elem)
+                elem.clear(keep_tail=False)
+                parent = elem.getparent()
+                while elem.getprevious() is not None:
+                    del parent[0]
+            elif elem.tag == token_tag:
+                self.resumption_token = (elem.text or '').strip() or None
+            else:
+                code = elem.attrib.get('code', 'UNKNOWN')
+                exc_cls = getattr(oaiexceptions, code[0].upper() + code[1:], oaiexceptions.OAIError)
+                raise exc_cls(elem.text or '')
+
+    def _record(self, elem: etree._Element) -> HarvestRecord:
+        header = elem.find('{%s}header' % OAI_NS)
+        record = HarvestRecord(
+            record_id=header.findtext('{%s}identifier' % OAI_NS).split(':')[-1],
+            deleted=header.get('status') == 'deleted',
+            datestamp=header.findtext('{%s}datestamp' % OAI_NS),
+        )
+        if not record.deleted:
+            record.element = elem.find('{%s}metadata/%s' % (OAI_NS, self.metadata_tag))
+            if record.element is None:
+                logger.error('Record %s has no metadata: %s', record.record_id, etree.tostring(elem))
+                raise HarvestError('Record %s has no metadata' % record.record_id)
+        return record
+
+
+@dataclass
+class HarvestHeader:
+    """A record header from a ListIdentifiers response."""
+    identifier: str
+    deleted: bool
+    datestamp: Optional[str] = None
+
+    @property
+    def record_id(self) -> str:
+        return self.identifier.split(':')[-1]
+
+
+class ListIdentifiersParser:
+    """Incremental parser for ListIdentifiers responses, like `ListRecordsParser`."""
+
+    def __init__(self, source: IO[bytes]):
+        self.source = source
+        self.resumption_token: Optional[str] = None
+
+    def __iter__(self) -> Generator[HarvestHeader, None, None]:
+        header_tag = '{%s}header' % OAI_NS
+        token_tag = '{%s}resumptionToken' % OAI_NS
+        error_tag = '{%s}error' % OAI_NS
+        context = etree.iterparse(self.source, events=('end',), tag=(header_tag, token_tag, error_tag),
+                                  remove_blank_text=True, recover=True)
+        for _, elem in context:
+            if elem.tag == header_tag:
+                yield HarvestHeader(
+                    identifier=elem.findtext('{%s}identifier' % OAI_NS),
+                    deleted=elem.get('status') == 'deleted',
+                    datestamp=elem.findtext('{%s}datestamp' % OAI_NS),
+                )
+                elem.clear(keep_tail=False)
+            elif elem.tag == token_tag:
+                self.resumption_token = (elem.text or '').strip() or None
+            else:
+                code = elem.attrib.get('code', 'UNKNOWN')
+                exc_cls = getattr(oaiexceptions, code[0].upper() + code[1:], oaiexceptions.OAIError)
+                raise exc_cls(elem.text or '')
+
+
+@dataclass
+class HarvestPage:
+    """A raw ListRecords response, as passed from the fetch stage to the parse/write stage."""
+    number: int
+    content: bytes
+    resumption_token: Optional[str] = None
+    latency: float = 0.0
+    retries: int = 0
+
+
+@dataclass
+class StageStats:
+    """Throughput counters for one stage of a pipelined harvest.
+
+    `busy` is the time spent doing actual work, while `blocked` is the time spent waiting on the queue
+    between the stages. A stage that is mostly blocked is waiting for the other stage, so the stage
+    with the least blocked time is the one limiting the harvest.
+    """
+    name: str
+    pages: int = 0
+    records: int = 0
+    bytes: int = 0
+    busy: float = 0.0
+    blocked: float = 0.0
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def add(self, pages: int = 0, records: int = 0, nbytes: int = 0, busy: float = 0.0, blocked: float = 0.0):
+        with self.lock:
+            self.pages += pages
+            self.records += records
+            self.bytes += nbytes
+            self.busy += busy
+            self.blocked += blocked
+
+    def report(self, elapsed: float) -> str:
+        elapsed = max(elapsed, 1e-6)
+        return '%s: %d pages (%.2f pages/sec), %d records (%.2f recs/sec), %.2f MB (%.2f MB/sec), ' \
+               'busy %.1fs, blocked %.1fs' % (
+                   self.name,
+                   self.pages, self.pages / elapsed,
+                   self.records, self.records / elapsed,
+                   self.bytes / 1e6, self.bytes / 1e6 / elapsed,
+                   self.busy,
+                   self.blocked,
+               )
+
+
+class PooledSickle(Sickle):
+    """Sickle sending its requests through a `requests.Session`, so that connections to the endpoint are
+    kept alive and reused, instead of opening a new connection for every page."""
+
+    def __init__(self, endpoint: str, session: requests.Session, **kwargs):
+        super().__init__(endpoint, **kwargs)
+        self.session = session
+
+    def _request(self, kwargs):
+        if self.http_method == 'GET':
+            return self.session.get(self.endpoint, params=kwargs, **self.request_args)
+        return self.session.post(self.endpoint, data=kwargs, **self.request_args)
 
 
 class OaiPmh:
 
-    def __init__(self, settings: OaiPmhSettings):
+    def __init__(self, settings: OaiPmhSettings, extractors: Optional[List[Extractor]] = None):
+        """`extractors` are run on every record in addition to those named in `settings.extractors`."""
         self.settings = settings
+        self.summary_file = summary_path(self.settings.storage_dir)
+        self.metrics_file = self.settings.storage_dir.joinpath('metrics.json')
+        self.deletes_file = self.settings.storage_dir.joinpath('pending_deletes.tsv')
+        self.store: HarvestStore = open_store(self.settings.storage_dir, self.settings.store,
+                                                 compression=self.settings.compression)
+        self._manifest: Optional[ChangeManifest] = None  # Opened for each harvest or reconciliation
+        self._journal: Optional[HarvestJournal] = None  # Open while a harvest or reconciliation runs
+        self.metrics = HarvestMetrics(harvest_started=datetime.now())  # Replaced when a harvest starts
+        names = list(self.settings.extractors)
+        if self.settings.status_index and StatusIndex.name not in names:
+            names.insert(0, StatusIndex.name)
+        self.extractors: List[Extractor] = open_extractors(self.settings.storage_dir, names) + (extractors or [])
+        self.throttle = AdaptiveThrottle(max_retries=self.settings.max_retries, rate_limit=self.settings.rate_limit)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.settings.max_connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
-    def harvest(self, callback=None, **kwargs):
+    @property
+    def manifest(self) -> ChangeManifest:
+        """The manifest of the running harvest."""
+        if self._manifest is None:
+            raise HarvestError('No harvest has been started')
+        return self._manifest
+
+    @property
+    def journal(self) -> HarvestJournal:
+        """The journal, while a harvest is running."""
+        if self._journal is None:
+            raise HarvestError('No harvest has been started')
+        return self._journal
+
+    def manifest_path(self, harvest: HarvestSummary) -> Path:
+        """Each harvest gets its own manifest, named after its start time, so a resumed harvest keeps
+        appending to the same manifest."""
+        return self.settings.storage_dir.joinpath('manifests', harvest.started.strftime('%Y%m%dT%H%M%S.%f') + '.tsv')
+
+    def _begin_harvest(self, kwargs: dict) -> HarvestSummary:
+        current_harvest = self._load_harvest(kwargs)
+        manifest_path = self.manifest_path(current_harvest)
+        if self._manifest is None or self._manifest.path != manifest_path:
+            self._manifest = ChangeManifest(manifest_path, current_harvest.changed)
+        if self._journal is None:
+            self._journal = HarvestJournal(journal_path(self.settings.storage_dir))
+        self.metrics = HarvestMetrics(harvest_started=current_harvest.started)
+        return current_harvest
 
-        harvest_summary_file = self.settings.storage_dir.joinpath('summary.json')
-        last_harvest = HarvestSummary.load(harvest_summary_file)
+    def _load_harvest(self, kwargs: dict) -> HarvestSummary:
+        """Load the summary of the last harvest and decide whether to resume, harvest incrementally or
+        start a full harvest. Note that `kwargs` gets the `from` argument added for incremental harvests."""
+        last_harvest = HarvestSummary.load(self.summary_file)
 
-        if last_harvest is not None and last_harvest.resumption_token is not None:
+        if last_harvest is not None and last_harvest.ended is None and (
+                last_harvest.resumable or last_harvest.partitions):
             harvest_type = 'full' if last_harvest.full else 'incremental'
             logger.info('Resuming %s harvest started at: %s. Fetched %d records so far.',
                         harvest_type,
                         last_harvest.started.isoformat(),
                         last_harvest.fetched)
-            current_harvest = last_harvest
-        else:
-            if last_harvest is not None and last_harvest.ended is not None:
-                kwargs['from'] = last_harvest.started.strftime('%Y-%m-%d')
-                logger.info('Starting incremental harvest from: %s', kwargs['from'])
-                current_harvest = HarvestSummary(started=datetime.now(), full=False)
-            else:
-                logger.info('Starting full harvest')
-                current_harvest = HarvestSummary(started=datetime.now(), full=True)
+            return last_harvest
+
+        if last_harvest is not None and last_harvest.ended is not None:
+            kwargs['from'] = last_harvest.started.strftime('%Y-%m-%d')
+            logger.info('Starting incremental harvest from: %s', kwargs['from'])
+            return HarvestSummary(started=datetime.now(), full=False)
 
+        logger.info('Starting full harvest')
+        return HarvestSummary(started=datetime.now(), full=True)
+
+    def _harvest_options(self, current_harvest: HarvestSummary, kwargs: dict) -> dict:
         if current_harvest.resumption_token is not None:
-            harvest_options = {
+            return {
                 'resumptionToken': current_harvest.resumption_token,
             }
-        else:
-            harvest_options = {
+        if current_harvest.request_params is None:
+            # Saved with the checkpoints, so that a harvest stopped on the first page is resumed with the same
+            # from/until/set, rather than taken for a new full harvest
+            current_harvest.request_params = {
                 'metadataPrefix': self.settings.metadata_prefix,
                 'set': self.settings.oai_set,
                 **kwargs
             }
+        return dict(current_harvest.request_params)
 
-        print(self.settings.endpoint, harvest_options)
+    def _checkpoint(self, current_harvest: HarvestSummary):
+        self.store.flush()
+        for extractor in self.extractors:
+            extractor.flush()
+        self.manifest.flush()
+        self.journal.flush()
+        current_harvest.changed = self.manifest.count
+        current_harvest.save_summary(self.summary_file)
+        self.metrics.save(self.metrics_file, min_interval=60)
 
-        sickle = Sickle(self.settings.endpoint, max_retries=0, timeout=10, **self.settings.request_args)
-        records = sickle.ListRecords(**harvest_options)
+    def _end_harvest(self, current_harvest: HarvestSummary):
+        self.store.close()
+        for extractor in self.extractors:
+            extractor.flush()
+        self.manifest.close()
+        self.journal.close()
+        self._journal = None
+        current_harvest.changed = self.manifest.count
+        current_harvest.ended = datetime.now()
+        current_harvest.resumption_token = None
+        current_harvest.page_offset = 0
+        logger.info('Harvest completed. Fetched %d records and %d deleted records. %d records were changed, see %s',
+                    current_harvest.fetched, current_harvest.deleted, current_harvest.changed, self.manifest.path)
+        current_harvest.save_summary(self.summary_file)
+        self._save_metrics()
+        self._snapshot()
+
+    def _snapshot(self):
+        """Publish a snapshot of the store for readers, now that the store is consistent."""
+        if self.settings.snapshots > 0:
+            create_snapshot(self.settings.storage_dir, self.store)
+            prune_snapshots(self.settings.storage_dir, self.settings.snapshots)
+
+    def _save_metrics(self):
+        self.metrics.run_ended = datetime.now()
+        self.metrics.save(self.metrics_file)
+        logger.info(self.metrics.summary())
+        if self.settings.prometheus_textfile is not None:
+            self.metrics.write_prometheus(self.settings.prometheus_textfile, self.settings.storage_dir.name)
+
+    def _sickle(self, stream: bool = False) -> Sickle:
+        # Retries are handled by the throttle, and the timeout is set for each request
+        return PooledSickle(self.settings.endpoint, self.session, max_retries=0, timeout=self.throttle.timeout,
+                            stream=stream, **(self.settings.request_args or {}))
+
+    def _process_record(self, record: HarvestRecord, callback: Optional[Callable] = None) -> Optional[str]:
+        """Store or remove a single record. Returns 'deleted' or 'stored', or None if the record was skipped."""
+        if record.deleted:
+            if self.store.delete(record.record_id):
+                logger.info('Removing deleted record: %s', record.record_id)
+                self.manifest.add(record.record_id, OP_DELETE)
+            for extractor in self.extractors:
+                extractor.delete(record.record_id, record.datestamp)
+            self.journal.append(record.record_id, OP_DELETE, record.datestamp)
+            return 'deleted'
+
+        node = XmlNode(record.element, self.settings.metadata_schema)
+        if callback is not None:
+            callback(node)
+
+        if len(record.record_id) <= 2:
+            return None
+
+        for extractor in self.extractors:
+            extractor.upsert(record.record_id, node, record.datestamp)
+
+        if self.store.put(record.record_id, record.serialize()):
+            self.manifest.add(record.record_id, OP_UPSERT)
+            logger.debug('Stored record %s', record.record_id)
+        else:
+            logger.debug('Record %s is unchanged', record.record_id)
+        self.journal.append(record.record_id, OP_UPSERT, record.datestamp)
+        return 'stored'
 
+    def harvest(self, callback=None, **kwargs):
+        """Harvest records page by page. Each page is streamed from the server and parsed incrementally,
+        and the records are stored as they are parsed."""
+
+        current_harvest = self._begin_harvest(kwargs)
+        if current_harvest.partitions:
+            # Resuming a partitioned harvest
+            return self._harvest_partitions(current_harvest, callback, len(current_harvest.partitions))
+
+        params = self._harvest_options(current_harvest, kwargs)
+
+        logger.info('Harvesting %s with %s', self.settings.endpoint, params)
+
+        self._harvest_list(params, current_harvest, callback, lambda: self._checkpoint(current_harvest))
+        self._end_harvest(current_harvest)
+
+    def _harvest_list(self, params: dict, state: Union[HarvestSummary, HarvestPartition],
+                      callback: Optional[Callable], checkpoint: Callable[[], None], label: str = '',
+                      seen: Optional[SeenRecords] = None):
+        """Follow a resumption token chain from `params`, counting records and updating the resumption
+        token in `state`, and calling `checkpoint` after every page and every 1000 records. If `seen` is given,
+        records that have already been stored during this harvest are skipped.
+
+        The checkpoint holds the token of the current page and the number of records of the page processed
+        so far, so that a resumed harvest continues at the exact record where it stopped. This assumes that
+        the server returns the records of a page in the same order each time."""
+        sickle = self._sickle(stream=True)
         t0 = time()
-        for record in records:
-            ident = record.header.identifier
-            record_id = ident.split(':')[-1]
-            # We use md5 just to get a slightly more uniform distribution,
-            # since the prefixes and suffixes are often very non-uniform.
-            file_dir = self.settings.storage_dir.joinpath(md5(record_id.encode('utf-8')).hexdigest()[:2])
-            filename = file_dir.joinpath('%s.xml' % record_id)
-
-            if record.deleted:
-                current_harvest.deleted += 1
-                if filename.exists():
-                    logger.info('Removing deleted record: %s', str(filename))
-                    os.remove(str(filename))
+        fetched0 = state.fetched
+        number = 0
+        processed = state.page_offset  # Records of the current page handled in earlier attempts or runs
+        if processed:
+            logger.info('%sSkipping the first %d records of the page, which were processed before', label, processed)
+        while True:
+            page = PageMetrics(number, partition=str(state) if isinstance(state, HarvestPartition) else '')
+            while True:
+                t1 = time()
+                response = self._list_records(sickle, params, page).http_response
+                t2 = time()
+                page.latency += t2 - t1
+                write_time = page.write_time
+                failure = None
+                try:
+                    response.raw.decode_content = True
+                    parser = ListRecordsParser(response.raw, self.settings.metadata_schema)
+                    for n, record in enumerate(parser):
+                        if n < processed:
+                            continue
+                        processed += 1
+                        if seen is not None and not record.deleted and not seen.add(record.record_id):
+                            continue
+                        t3 = time()
+                        result: Optional[str]
+                        if seen is not None and record.deleted:
+                            seen.add_delete(record)
+                            result = 'deleted'
+                        else:
+                            result = self._process_record(record, callback)
+                        page.write_time += time() - t3
+
+                        if result == 'deleted':
+                            state.deleted += 1
+                            page.deleted += 1
+                        elif result == 'stored':
+                            state.fetched += 1
+                            page.records += 1
+                            if state.fetched % 1000 == 0:
+                                # Until the page is done, the token that fetched this page is the one to resume from
+                                state.resumption_token = params.get('resumptionToken')
+                                state.page_offset = processed
+                                current_speed = (state.fetched - fetched0) / (time() - t0)
+                                checkpoint()
+                                logger.info('%sReceived %d records @ %.2f recs/sec ', label, state.fetched, current_speed)
+                except (requests.RequestException, urllib3.exceptions.HTTPError) as exc:
+                    failure = exc
+                finally:
+                    page.bytes += response.raw.tell()
+                    page.parse_time += time() - t2 - (page.write_time - write_time)
+                    response.close()
+
+                if failure is None:
+                    break
+                # The connection failed while we were streaming the page. Request the page again,
+                # and skip the records we already have.
+                page.retries += 1
+                if page.retries > self.throttle.max_retries:
+                    raise failure
+                delay = self.throttle.backoff(page.retries)
+                logger.warning('%sConnection failed after %d records of page %d (%s), retrying in %.1f seconds',
+                               label, processed, number, failure, delay)
+                sleep(delay)
+
+            self.metrics.add_page(page)
+            if parser.resumption_token is None:
+                break
+            params = {'resumptionToken': parser.resumption_token}
+            number += 1
+            processed = 0
+            state.resumption_token = parser.resumption_token
+            state.page_offset = 0
+            checkpoint()
+
+    def _list_records(self, sickle: Sickle, params: dict, page: Optional[PageMetrics] = None,
+                      verb: str = 'ListRecords') -> OAIResponse:
+        """Send a ListRecords (or other `verb`) request through the throttle, which retries failed requests
+        and adjusts the timeout. Retries are counted in `page`."""
+
+        def request(timeout: float) -> OAIResponse:
+            sickle.request_args['timeout'] = timeout
+            return sickle.harvest(verb=verb, **params)
+
+        def on_retry(attempt: int, delay: float, reason: str):
+            if page is not None:
+                page.retries += 1
+
+        return self.throttle.call(request, on_retry)
+
+    def harvest_partitioned(self, partitions: int, callback=None, **kwargs):
+        """Split the datestamp range into `partitions` windows using `from`/`until`, and harvest them
+        concurrently into the same store. Each window has its own checkpoint in the summary file.
+
+        The windows are of equal length in days, so they will not contain the same number of records.
+        The last window is left open-ended, so that it includes records changed during the harvest.
+        Note that `callback` is called from the partition threads.
+        """
+        current_harvest = self._begin_harvest(kwargs)
+
+        if not current_harvest.partitions:
+            if current_harvest.resumable:
+                logger.warning('Resuming a harvest that was not partitioned, continuing it without partitions')
+                return self.harvest(callback)
+
+            if 'from' in kwargs:
+                start = date.fromisoformat(kwargs['from'][:10])
             else:
-                doc = XmlNode(
-                    etree.fromstring(record.raw),
-                    self.settings.metadata_schema,
-                    {'oai': 'http://www.openarchives.org/OAI/2.0/', 'schema': self.settings.metadata_schema}
-                )
+                start = date.fromisoformat(self._sickle().Identify().earliestDatestamp[:10])
+            current_harvest.partitions = [
+                HarvestPartition(from_date=from_date, until_date=until_date)
+                for from_date, until_date in split_date_range(start, date.today(), partitions)
+            ]
+            logger.info('Harvesting %d windows: %s', len(current_harvest.partitions),
+                        ', '.join(str(partition) for partition in current_harvest.partitions))
 
-                marc = doc.first('oai:metadata/schema:record', True)
+        return self._harvest_partitions(current_harvest, callback, partitions)
 
-                if callback is not None:
-                    callback(marc)
+    def list_sets(self) -> List[Tuple[str, str]]:
+        """Discover the sets exposed by the endpoint, as (setSpec, setName)."""
+        return [(oai_set.setSpec, getattr(oai_set, 'setName', '')) for oai_set in self._sickle().ListSets()]
 
-                if len(record_id) > 2:
-                    file_dir.mkdir(exist_ok=True)
+    def harvest_sets(self, sets: Optional[List[str]] = None, workers: Optional[int] = None, callback=None, **kwargs):
+        """Harvest a list of sets concurrently into the same store, each with its own resumption state
+        in the summary file. If no sets are given, `settings.oai_sets` is used, and if that is empty too,
+        all sets from ListSets are harvested.
 
-                    if marc is None:
-                        print(doc.serialize())
-                        sys.exit(1)
-                    with filename.open('wb') as fp:
-                        fp.write(marc.serialize())
-                    logger.debug('Stored record %s', record_id)
+        Records that appear in more than one set are only stored once per run. After a restart, records
+        from sets that were completed before the restart may be stored once more, which is harmless.
+        Records reported as deleted are only removed when all the sets are done, and only if no set had
+        them as live records (see `_apply_deletes`). Note that `callback` is called from the set threads.
+        """
+        current_harvest = self._begin_harvest(kwargs)
 
-                    current_harvest.fetched += 1
-                    if current_harvest.fetched % 1000 == 0:
-                        current_harvest.resumption_token = records.resumption_token.token
-                        current_speed = current_harvest.fetched / (time() - t0)
-                        current_harvest.save_summary(harvest_summary_file)
-                        logger.info('Received %d records @ %.2f recs/sec ', current_harvest.fetched, current_speed)
+        if not current_harvest.partitions:
+            if current_harvest.resumable:
+                logger.warning('Resuming a harvest that was not partitioned, continuing it without partitions')
+                return self.harvest(callback)
 
-        current_harvest.ended = datetime.now()
-        current_harvest.resumption_token = None
-        logger.info('Harvest completed. Fetched %d records and %d deleted records',
-                    current_harvest.fetched, current_harvest.deleted)
-        current_harvest.save_summary(harvest_summary_file)
+            available = [spec for spec, name in self.list_sets()]
+            sets = sets or self.settings.oai_sets or available
+            unknown = [oai_set for oai_set in sets if oai_set not in available]
+            if unknown:
+                raise HarvestError('Unknown sets: %s. Available sets: %s' % (', '.join(unknown), ', '.join(available)))
+
+            current_harvest.partitions = [
+                HarvestPartition(oai_set=oai_set, from_date=kwargs.get('from'), until_date=kwargs.get('until'))
+                for oai_set in sets
+            ]
+            current_harvest.journal_offset = self.journal.offset()
+            # Left behind by an earlier set harvest that was never completed
+            self.deletes_file.unlink(missing_ok=True)
+            logger.info('Harvesting %d sets: %s', len(sets), ', '.join(sets))
+
+        return self._harvest_partitions(current_harvest, callback, workers or len(current_harvest.partitions))
+
+    def _harvest_partitions(self, current_harvest: HarvestSummary, callback: Optional[Callable], workers: int):
+        lock = threading.Lock()
+        seen = None
+        if any(partition.oai_set for partition in current_harvest.partitions):
+            seen = SeenRecords(self.deletes_file)
+
+        def checkpoint():
+            with lock:
+                if seen is not None:
+                    seen.flush()
+                current_harvest.fetched = sum(partition.fetched for partition in current_harvest.partitions)
+                current_harvest.deleted = sum(partition.deleted for partition in current_harvest.partitions)
+                self._checkpoint(current_harvest)
+
+        def harvest_partition(partition: HarvestPartition):
+            params: Dict[str, Optional[str]]
+            if partition.resumption_token is not None:
+                params = {'resumptionToken': partition.resumption_token}
+            else:
+                params = {
+                    'metadataPrefix': self.settings.metadata_prefix,
+                    'set': partition.oai_set or self.settings.oai_set,
+                    'from': partition.from_date,
+                    'until': partition.until_date,
+                }
+            logger.info('[%s] Starting partition', partition)
+            try:
+                self._harvest_list(params, partition, callback, checkpoint, '[%s] ' % partition, seen)
+            except oaiexceptions.NoRecordsMatch:
+                pass
+            partition.done = True
+            partition.resumption_token = None
+            partition.page_offset = 0
+            logger.info('[%s] Partition completed. Fetched %d records and %d deleted records',
+                        partition, partition.fetched, partition.deleted)
+            checkpoint()
+
+        pending = [partition for partition in current_harvest.partitions if not partition.done]
+        # The throttle lowers the number of concurrent requests if the server can't keep up
+        self.throttle.set_max_concurrency(workers)
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = [executor.submit(harvest_partition, partition) for partition in pending]
+            errors = [error for error in (future.exception() for future in futures) if error is not None]
+
+        checkpoint()
+        if seen is not None and seen.duplicates > 0:
+            logger.info('Skipped %d records already harvested from another set', seen.duplicates)
+        if errors:
+            raise errors[0]
+        if seen is not None:
+            self._apply_deletes(current_harvest, seen)
+        self._end_harvest(current_harvest)
+
+    def _apply_deletes(self, current_harvest: HarvestSummary, seen: SeenRecords):
+        """Remove the records reported as deleted in a set, unless a set had them as live records during the
+        harvest. The records stored before a restart are found in the journal."""
+        deletes = seen.deletes()
+        live = set(seen.ids)
+        if deletes and current_harvest.journal_offset is not None:
+            live.update(entry.record_id for entry in read_journal(self.journal.path, current_harvest.journal_offset)
+                        if entry.op == OP_UPSERT)
+        kept = 0
+        for record_id, datestamp in deletes.items():
+            if record_id in live:
+                kept += 1
+                continue
+            self._process_record(HarvestRecord(record_id, deleted=True, datestamp=datestamp))
+        if kept > 0:
+            logger.info('Kept %d records reported as deleted in one set, but live in another', kept)
+        self.deletes_file.unlink(missing_ok=True)
+
+    def list_identifiers(self, oai_set: Optional[str] = None) -> Generator[HarvestHeader, None, None]:
+        """Stream the headers of all records in a set (or the default set) with ListIdentifiers. A page that
+        fails while it is being streamed is requested again, so a header may be yielded more than once."""
+        sickle = self._sickle(stream=True)
+        params = {'metadataPrefix': self.settings.metadata_prefix, 'set': oai_set or self.settings.oai_set}
+        while True:
+            attempt = 0
+            while True:
+                response = self._list_records(sickle, params, verb='ListIdentifiers').http_response
+                try:
+                    response.raw.decode_content = True
+                    parser = ListIdentifiersParser(response.raw)
+                    yield from parser
+                    break
+                except (requests.RequestException, urllib3.exceptions.HTTPError) as exc:
+                    attempt += 1
+                    if attempt > self.throttle.max_retries:
+                        raise
+                    delay = self.throttle.backoff(attempt)
+                    logger.warning('Connection failed during ListIdentifiers (%s), retrying in %.1f seconds',
+                                   exc, delay)
+                    sleep(delay)
+                finally:
+                    response.close()
+            if parser.resumption_token is None:
+                return
+            params = {'resumptionToken': parser.resumption_token}
+
+    def get_record(self, sickle: Sickle, identifier: str) -> Optional[HarvestRecord]:
+        """Fetch a single record with GetRecord. Returns None if the server doesn't have it."""
+        params = {'identifier': identifier, 'metadataPrefix': self.settings.metadata_prefix}
+        content = self._list_records(sickle, params, verb='GetRecord').http_response.content
+        try:
+            return next(iter(ListRecordsParser(BytesIO(content), self.settings.metadata_schema)), None)
+        except oaiexceptions.IdDoesNotExist:
+            return None
+
+    def reconcile(self, workers: Optional[int] = None, dry_run: bool = False, max_orphaned: float = 0.1,
+                  callback: Optional[Callable] = None) -> ReconcileSummary:
+        """Repair a store that has drifted from the server, e.g. because of missed deletes or interrupted
+        harvests, without a full harvest.
+
+        The headers of all records are listed with ListIdentifiers and compared with the store: records
+        missing from the store, or with a newer datestamp on the server than in the status index, are
+        fetched with GetRecord, and records that are deleted on the server, or not listed at all, are
+        deleted. The changes go through the same path as harvested records, so the manifest, journal and
+        extractors are updated too. With `dry_run`, the differences are only counted.
+
+        A listing that is empty or cut short by the server would make most of the store look orphaned, so
+        nothing is changed if the server lists no records, or if more than `max_orphaned` (a fraction of the
+        store) would be deleted only because they are not listed.
+
+        Shouldn't run at the same time as a harvest into the same dir.
+        """
+        summary = ReconcileSummary()
+        status = next((extractor for extractor in self.extractors if isinstance(extractor, StatusIndex)), None)
+        if status is None:
+            logger.warning('No status index, so stale records can not be detected, only missing and deleted ones')
+        local_ids = set(self.store.ids())
+        logger.info('%d records in the store', len(local_ids))
+
+        listed: Set[str] = set()
+        to_fetch: Dict[str, str] = {}  # Record id -> OAI identifier
+        to_delete: Dict[str, Optional[str]] = {}  # Record id -> datestamp of the delete
+        oai_sets: List[Optional[str]] = list(self.settings.oai_sets) or [self.settings.oai_set]
+        for oai_set in oai_sets:
+            try:
+                for header in self.list_identifiers(oai_set):
+                    summary.listed += 1
+                    if summary.listed % 100000 == 0:
+                        logger.info('Listed %d headers', summary.listed)
+                    record_id = header.record_id
+                    if header.deleted:
+                        if record_id in local_ids:
+                            to_delete[record_id] = header.datestamp
+                        continue
+                    listed.add(record_id)
+                    if record_id not in local_ids:
+                        to_fetch[record_id] = header.identifier
+                        continue
+                    local = status.get(record_id) if status is not None else None
+                    if local is None or local.datestamp is None:
+                        summary.unknown_datestamp += 1
+                    elif header.datestamp is not None and local.datestamp < header.datestamp:
+                        to_fetch[record_id] = header.identifier
+            except oaiexceptions.NoRecordsMatch:
+                logger.error('The server listed no records%s, not reconciling',
+                             ' in set %s' % oai_set if oai_set else '')
+                raise
+
+        # A record may be listed as deleted in one set and live in another
+        to_delete = {record_id: datestamp for record_id, datestamp in to_delete.items() if record_id not in listed}
+        orphaned = local_ids - listed - set(to_delete)
+        summary.missing = len([record_id for record_id in to_fetch if record_id not in local_ids])
+        summary.stale = len(to_fetch) - summary.missing
+        summary.deleted = len(to_delete)
+        summary.orphaned = len(orphaned)
+        logger.info(str(summary))
+        if dry_run:
+            return summary
+        if local_ids and not listed:
+            raise HarvestError('The server listed no live records, refusing to delete all %d records in the store'
+                               % len(local_ids))
+        if local_ids and len(orphaned) > max_orphaned * len(local_ids):
+            raise HarvestError('%d of %d records in the store are not listed by the server, more than the max '
+                               'share of %g. Check the listing, or raise the max share to delete them'
+                               % (len(orphaned), len(local_ids), max_orphaned))
+
+        started = datetime.now()
+        self._manifest = ChangeManifest(self.settings.storage_dir.joinpath(
+            'manifests', started.strftime('%Y%m%dT%H%M%S.%f') + '-reconcile.tsv'))
+        self._journal = HarvestJournal(journal_path(self.settings.storage_dir))
+
+        for record_id, datestamp in to_delete.items():
+            self._process_record(HarvestRecord(record_id, deleted=True, datestamp=datestamp))
+        for record_id in orphaned:
+            self._process_record(HarvestRecord(record_id, deleted=True))
+
+        lock = threading.Lock()
+        sickle = self._sickle()
+
+        def fetch(identifier: str):
+            record = self.get_record(sickle, identifier)
+            if record is None:
+                logger.warning('Record %s could not be fetched', identifier)
+                with lock:
+                    summary.failed += 1
+                return
+            self._process_record(record, callback)
+            with lock:
+                summary.fetched += 1
+                if summary.fetched % 1000 == 0:
+                    logger.info('Fetched %d of %d records', summary.fetched, len(to_fetch))
+
+        workers = workers or self.settings.max_connections
+        self.throttle.set_max_concurrency(workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(fetch, identifier) for identifier in to_fetch.values()]
+            errors = [error for error in (future.exception() for future in futures) if error is not None]
+
+        self.store.close()
+        for extractor in self.extractors:
+            extractor.flush()
+        self.manifest.close()
+        self.journal.close()
+        self._journal = None
+        logger.info('Reconciliation completed. %s %d records were changed, see %s',
+                    summary, self.manifest.count, self.manifest.path)
+        if errors:
+            raise errors[0]
+        self._snapshot()
+        return summary
+
+    def fetch_page(self, sickle: Sickle, number: int, params: dict) -> HarvestPage:
+        """Fetch a single ListRecords page without parsing it."""
+        t0 = time()
+        metrics = PageMetrics(number)
+        response = self._list_records(sickle, params, metrics)
+        content = response.http_response.content
+        latency = time() - t0
+
+        if not _list_records_re.search(content[:4096]):
+            # Not a ListRecords response, so most likely an OAI error. These are small, so we can afford
+            # to parse them to raise the same exceptions as Sickle does.
+            error = etree.XML(content).find('.//{%s}error' % OAI_NS)
+            if error is not None:
+                code = error.attrib.get('code', 'UNKNOWN')
+                exc_cls = getattr(oaiexceptions, code[0].upper() + code[1:], oaiexceptions.OAIError)
+                raise exc_cls(error.text or '')
+            raise HarvestError('Unexpected response from %s: %s' % (self.settings.endpoint, content[:500]))
+
+        token = None
+        match = _resumption_token_re.search(content[-8192:]) or _resumption_token_re.search(content)
+        if match is not None and match.group(1):
+            token = unescape(match.group(1).decode('utf-8')).strip() or None
+
+        return HarvestPage(number=number, content=content, resumption_token=token, latency=latency,
+                           retries=metrics.retries)
+
+    def harvest_pipelined(self, callback=None, workers: int = 4, queue_size: int = 8,
+                          report_interval: int = 50, **kwargs):
+        """Harvest with separate fetch and parse/write stages.
+
+        A fetch thread follows the resumption tokens and puts raw pages on a bounded queue, while a pool
+        of worker threads parses and stores the records. The queue size limits how far the fetcher can get
+        ahead of the workers. Note that `callback` is called from the worker threads.
+
+        The resumption token is only checkpointed once all pages before it have been stored, so a resumed
+        harvest never skips records, although it may store some of them twice.
+        """
+        current_harvest = self._begin_harvest(kwargs)
+        if current_harvest.partitions:
+            # Resuming a partitioned harvest
+            return self._harvest_partitions(current_harvest, callback, len(current_harvest.partitions))
+
+        harvest_options = self._harvest_options(current_harvest, kwargs)
+        first_page_offset = current_harvest.page_offset
+
+        logger.info('Harvesting %s with %s', self.settings.endpoint, harvest_options)
+
+        pages: Queue[Optional[HarvestPage]] = Queue(maxsize=queue_size)
+        abort = threading.Event()
+        errors: List[BaseException] = []
+        fetch_stats = StageStats('fetch')
+        parse_stats = StageStats('parse/write')
+
+        # Pages can complete out of order, so we keep track of which pages are done and only
+        # move the checkpoint forward past a contiguous run of completed pages.
+        checkpoint_lock = threading.Lock()
+        completed_tokens: dict[int, Optional[str]] = {}
+        next_checkpoint = 0
+
+        def put(item: Optional[HarvestPage]) -> bool:
+            while not abort.is_set():
+                try:
+                    pages.put(item, timeout=1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def fetcher():
+            sickle = self._sickle()
+            params = harvest_options
+            number = 0
+            try:
+                while not abort.is_set():
+                    t1 = time()
+                    page = self.fetch_page(sickle, number, params)
+                    t2 = time()
+                    if not put(page):
+                        break
+                    fetch_stats.add(pages=1, nbytes=len(page.content), busy=t2 - t1, blocked=time() - t2)
+                    if page.resumption_token is None:
+                        break
+                    params = {'resumptionToken': page.resumption_token}
+                    number += 1
+            except BaseException as exc:
+                errors.append(exc)
+                abort.set()
+            finally:
+                for _ in range(workers):
+                    put(None)
+
+        def worker():
+            try:
+                while not abort.is_set():
+                    t1 = time()
+                    try:
+                        page = pages.get(timeout=1)
+                    except Empty:
+                        parse_stats.add(blocked=time() - t1)
+                        continue
+                    t2 = time()
+                    parse_stats.add(blocked=t2 - t1)
+                    if page is None:
+                        break
+                    metrics = self._process_page(page, callback, skip=first_page_offset if page.number == 0 else 0)
+                    self.metrics.add_page(metrics)
+                    parse_stats.add(pages=1, records=metrics.records + metrics.deleted, nbytes=len(page.content),
+                                    busy=time() - t2)
+                    page_done(page, metrics.records, metrics.deleted)
+            except BaseException as exc:
+                errors.append(exc)
+                abort.set()
+
+        def page_done(page: HarvestPage, fetched: int, deleted: int):
+            nonlocal next_checkpoint
+            with checkpoint_lock:
+                current_harvest.fetched += fetched
+                current_harvest.deleted += deleted
+                completed_tokens[page.number] = page.resumption_token
+                token = None
+                while next_checkpoint in completed_tokens:
+                    token = completed_tokens.pop(next_checkpoint)
+                    next_checkpoint += 1
+                if token is not None:
+                    current_harvest.resumption_token = token
+                    current_harvest.page_offset = 0
+                    self._checkpoint(current_harvest)
+                if page.number % report_interval == 0:
+                    self._log_stage_stats(current_harvest, t0, fetch_stats, parse_stats)
+
+        t0 = time()
+        threads = [threading.Thread(target=fetcher, name='oai-fetch', daemon=True)] + [
+            threading.Thread(target=worker, name='oai-worker-%d' % n, daemon=True)
+            for n in range(workers)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=1)
+        except KeyboardInterrupt:
+            abort.set()
+            raise
+
+        if errors:
+            raise errors[0]
+
+        self._log_stage_stats(current_harvest, t0, fetch_stats, parse_stats)
+        self._end_harvest(current_harvest)
+
+    def _process_page(self, page: HarvestPage, callback: Optional[Callable] = None, skip: int = 0) -> PageMetrics:
+        """Parse a ListRecords page and store the records in it, except the first `skip` records.
+        Returns the metrics for the page, including the number of stored and deleted records."""
+        metrics = PageMetrics(page.number, latency=page.latency, bytes=len(page.content), retries=page.retries)
+        t0 = time()
+        for n, record in enumerate(ListRecordsParser(BytesIO(page.content), self.settings.metadata_schema)):
+            if n < skip:
+                continue
+            t1 = time()
+            result = self._process_record(record, callback)
+            metrics.write_time += time() - t1
+            if result == 'deleted':
+                metrics.deleted += 1
+            elif result == 'stored':
+                metrics.records += 1
+        metrics.parse_time = time() - t0 - metrics.write_time
+        return metrics
+
+    @staticmethod
+    def _log_stage_stats(current_harvest: HarvestSummary, t0: float, *stages: StageStats):
+        elapsed = time() - t0
+        logger.info('Received %d records @ %.2f recs/sec', current_harvest.fetched, current_harvest.fetched / max(elapsed, 1e-6))
+        for stage in stages:
+            logger.info(stage.report(elapsed))
+
+
+def harvest_concurrently(providers: Dict[str, OaiPmh], harvest: Callable[[OaiPmh], None],
+                         report_interval: float = 60.0) -> Dict[str, Optional[BaseException]]:
+    """Run `harvest(provider)` for several sources at once, with one thread per source.
+
+    Each provider has its own connection pool, throttle, store and checkpoint, so a slow or failing source
+    doesn't hold back the others. A combined progress line is logged every `report_interval` seconds.
+    Returns the error for each source, or None if the harvest succeeded.
+    """
+    errors: Dict[str, Optional[BaseException]] = {}
+    status = {name: 'waiting' for name in providers}
+    t0 = time()
+
+    def run(name: str, provider: OaiPmh):
+        status[name] = 'running'
+        try:
+            harvest(provider)
+            status[name] = 'done'
+            errors[name] = None
+        except BaseException as exc:
+            logger.exception('Harvest of %s failed', name)
+            status[name] = 'failed'
+            errors[name] = exc
+
+    def report():
+        elapsed = max(time() - t0, 1e-6)
+        parts = []
+        for name, provider in providers.items():
+            totals = provider.metrics.totals()
+            parts.append('%s: %d records @ %.1f recs/sec, %d retries (%s)' % (
+                name, totals['records'] + totals['deleted'], (totals['records'] + totals['deleted']) / elapsed,
+                totals['retries'], status[name]))
+        logger.info('Progress: %s', ' | '.join(parts))
+
+    threads = [
+        threading.Thread(target=run, args=(name, provider), name='oai-%s' % name, daemon=True)
+        for name, provider in providers.items()
+    ]
+    for thread in threads:
+        thread.start()
+    last_report = time()
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(timeout=1)
+            if time() - last_report >= report_interval:
+                report()
+                last_report = time()
+    report()
+    return errors
@@ -0,0 +1,251 @@
+import sqlite3
+from pathlib import Path
+
+from lxml import etree
+
+from seiso.common.harvest_extractors import (
+    STATUS_DELETED, STATUS_LIVE, STATUS_REPLACED, BibbiIndex, BibbiLinkedItem, IdentifierIndex, NameIndex,
+    RecordStats, StatusIndex, VocabularyIndex, build_extractors, open_extractors,
+)
+from seiso.common.harvest_store import open_store
+from seiso.common.xml import XmlNode
+
+MARC_NS = 'info:lc/xmlns/marcxchange-v1'
+
+
+def marc(record_id: str, name: str, identifiers=(), references=(), tag='100', replaces=()) -> bytes:
+    fields = [f'<controlfield tag="001">{record_id}</controlfield>',
+              f'<datafield tag="{tag}" ind1="1" ind2=" "><subfield code="a">{name}</subfield>'
+              f'<subfield code="d">1900-1980</subfield></datafield>']
+    fields += [f'<datafield tag="035" ind1=" " ind2=" "><subfield code="z">(NO-TrBIB){old_id}</subfield></datafield>'
+               for old_id in replaces]
+    fields += [f'<datafield tag="024" ind1="7" ind2=" "><subfield code="a">{value}</subfield>'
+               f'<subfield code="2">{vocabulary}</subfield></datafield>' for vocabulary, value in identifiers]
+    fields += [f'<datafield tag="400" ind1="1" ind2=" "><subfield code="a">{ref}</subfield></datafield>'
+               for ref in references]
+    return f'<record xmlns="{MARC_NS}">{"".join(fields)}</record>'.encode('utf-8')
+
+
+def node(data: bytes) -> XmlNode:
+    return XmlNode(etree.fromstring(data), MARC_NS)
+
+
+def test_identifier_index(tmp_path: Path):
+    index = IdentifierIndex(tmp_path)
+    index.upsert('1', node(marc('1', 'Hansen, Per', [('bibbi', '123'), ('viaf', '999')])))
+    index.upsert('2', node(marc('2', 'Olsen, Kari', [('bibbi', '456')])))
+    assert index.lookup('bibbi', '123') == ['1']
+    assert sorted(index.identifiers('1')) == [('bibbi', '123'), ('viaf', '999')]
+
+    # Upserts replace the previous identifiers, and are idempotent
+    index.upsert('1', node(marc('1', 'Hansen, Per', [('bibbi', '789')])))
+    index.upsert('1', node(marc('1', 'Hansen, Per', [('bibbi', '789')])))
+    assert index.lookup('bibbi', '123') == []
+    assert index.lookup('bibbi', '789') == ['1']
+
+    index.delete('2')
+    index.close()
+
+    # State is persisted
+    index = IdentifierIndex(tmp_path, readonly=True)
+    assert index.lookup('bibbi', '456') == []
+    assert index.lookup('bibbi', '789') == ['1']
+
+
+
+def test_identifier_index_normalizes_identifiers(tmp_path: Path):
+    index = IdentifierIndex(tmp_path)
+    index.upsert('1', node(marc('1', 'Hansen, Per', [
+        ('bibbi', 'https://id.bs.no/bibbi/407922'),
+        ('isni', 'https://isni.org/isni/0000 0001 2145 903x'),
+        ('hdl', 'https://hdl.handle.net/11250/1234'),
+    ])))
+    index.upsert('2', node(marc('2', 'Hansen, Per', [('bibbi', '407922'), ('viaf', 'http://viaf.org/viaf/42/')])))
+    assert index.lookup('bibbi', '407922') == ['1', '2']
+    assert index.lookup('bibbi', '(bibbi)407922') == ['1', '2']
+    assert index.lookup('isni', '000000012145903X') == ['1']
+    assert index.lookup('handle', '11250/1234') == ['1']
+    assert index.lookup('viaf', '42') == ['2']
+    assert ('bibbi', 'https://id.bs.no/bibbi/407922') in index.identifiers('1')
+
+
+def test_identifier_index_upgrades_old_index(tmp_path: Path):
+    tmp_path.joinpath('indexes').mkdir()
+    db = sqlite3.connect(str(tmp_path.joinpath('indexes', 'identifiers.sqlite')))
+    db.executescript('''
+        CREATE TABLE identifiers (record_id TEXT NOT NULL, vocabulary TEXT NOT NULL, identifier TEXT NOT NULL);
+        CREATE INDEX identifiers_identifier ON identifiers (vocabulary, identifier);
+        INSERT INTO identifiers VALUES ('1', 'bibbi', 'https://id.bs.no/bibbi/123');
+    ''')
+    db.commit()
+    db.close()
+    assert IdentifierIndex(tmp_path, readonly=True).lookup('bibbi', '123') == []
+
+    IdentifierIndex(tmp_path).close()
+    assert IdentifierIndex(tmp_path, readonly=True).lookup('bibbi', '123') == ['1']
+
+def test_vocabulary_index(tmp_path: Path):
+    index = VocabularyIndex(tmp_path)
+    index.upsert('2', node(marc('2', 'Olsen, Kari', [('bibbi', '456'), ('bibbi', '457'), ('viaf', '1')])))
+    index.upsert('1', node(marc('1', 'Hansen, Per', [('bibbi', '123')])))
+    index.upsert('3', node(marc('3', 'Berg, Ola', [('viaf', '2')])))
+    assert index.lookup('bibbi') == ['1', '2']
+    assert index.vocabularies('2') == ['bibbi', 'viaf']
+
+    index.upsert('2', node(marc('2', 'Olsen, Kari', [('viaf', '1')])))
+    index.delete('1')
+    index.close()
+
+    index = VocabularyIndex(tmp_path, readonly=True)
+    assert index.lookup('bibbi') == []
+    assert index.counts() == {'viaf': 2}
+
+def test_name_index(tmp_path: Path):
+    index = NameIndex(tmp_path)
+    index.upsert('1', node(marc('1', 'Hansen, Per', references=['Hansen, P.'])))
+    assert index.lookup('hansen, per') == ['1']
+    assert index.lookup('Hansen, P.') == ['1']
+    index.delete('1')
+    assert index.lookup('Hansen, Per') == []
+
+
+def test_name_index_search(tmp_path: Path):
+    index = NameIndex(tmp_path)
+    index.upsert('1', node(marc('1', 'Sæther, Åse', references=['Saether, Aase'])))
+    index.upsert('2', node(marc('2', 'Åsen, Per')))
+    assert index.search('sæther ase') == ['1']
+    assert index.search('aase') == ['1']
+    assert index.search('åse*') == ['1']  # Operators are ignored, so this is not a prefix search for Åsen
+    assert index.search('asen', dates='1900') == ['2']
+    assert index.search('asen', dates='1901') == []
+
+    index.upsert('1', node(marc('1', 'Sæther, Åse')))
+    index.delete('2')
+    assert index.search('aase') == []
+    assert index.search('asen') == []
+    assert index.execute('SELECT COUNT(*) FROM names') == [(1,)]
+    assert index.execute("SELECT COUNT(*) FROM names_fts WHERE names_fts MATCH 'aase'") == [(0,)]
+
+def test_record_stats(tmp_path: Path):
+    stats = RecordStats(tmp_path)
+    stats.upsert('1', node(marc('1', 'Hansen, Per')))
+    stats.upsert('1', node(marc('1', 'Hansen, Per')))
+    stats.upsert('2', node(marc('2', 'Forlaget', tag='110')))
+    assert stats.counts() == {'100': 1, '110': 1}
+    assert stats.summary()['records'] == 2
+
+
+def test_build_extractors_from_store(tmp_path: Path):
+    store = open_store(tmp_path)
+    store.put('1', marc('1', 'Hansen, Per', [('bibbi', '123')]))
+    store.put('2', marc('2', 'Olsen, Kari', [('bibbi', '456')]))
+
+    extractors = open_extractors(tmp_path, ['identifiers', 'names'])
+    extractors[0].upsert('3', node(marc('3', 'Stale', [('bibbi', '000')])))
+    assert build_extractors(store, extractors, MARC_NS) == 2
+
+    assert extractors[0].lookup('bibbi', '456') == ['2']
+    assert extractors[0].lookup('bibbi', '000') == []
+    assert extractors[1].lookup('Hansen, Per') == ['1']
+
+
+def test_status_index(tmp_path: Path):
+    index = StatusIndex(tmp_path)
+    index.upsert('1', node(marc('1', 'Hansen, Per')), '2024-01-01T00:00:00Z')
+    index.upsert('2', node(marc('2', 'Hansen, P.')), '2024-01-01T00:00:00Z')
+    index.delete('2', '2024-02-01T00:00:00Z')
+    index.delete('2', '2024-02-01T00:00:00Z')
+
+    assert index.get('1').status == STATUS_LIVE
+    assert index.get('2').status == STATUS_DELETED
+    assert index.get('2').datestamp == '2024-02-01T00:00:00Z'
+    assert index.get('3') is None
+
+    # Record 1 is merged into record 4, and deleted afterwards
+    index.upsert('4', node(marc('4', 'Hansen, Per', replaces=['1'])), '2024-03-01T00:00:00Z')
+    assert index.get('1').status == STATUS_LIVE
+    index.delete('1', '2024-03-02T00:00:00Z')
+    assert index.get('1').status == STATUS_REPLACED
+    assert index.get('1').replaced_by == '4'
+
+    # The replacement may also be harvested after the deletion, and may itself be replaced later
+    index.upsert('5', node(marc('5', 'Olsen, Kari', replaces=['2', '4'])))
+    index.delete('4')
+    assert index.get('2').replaced_by == '5'
+    assert index.resolve('1').record_id == '5'
+    assert index.resolve('3') is None
+    assert index.counts() == {STATUS_LIVE: 1, STATUS_REPLACED: 3}
+
+
+def test_status_index_keeps_deleted_records_on_rebuild(tmp_path: Path):
+    store = open_store(tmp_path)
+    store.put('1', marc('1', 'Hansen, Per'))
+    index = StatusIndex(tmp_path)
+    index.upsert('1', node(marc('1', 'Hansen, Per')))
+    index.upsert('2', node(marc('2', 'Olsen, Kari')))
+    index.delete('3')
+
+    build_extractors(store, [index], MARC_NS)
+
+    assert index.get('1').status == STATUS_LIVE
+    assert index.get('2') is None
+    assert index.get('3').status == STATUS_DELETED
+
+
+def test_status_index_keeps_datestamps_on_rebuild(tmp_path: Path):
+    store = open_store(tmp_path)
+    store.put('1', marc('1', 'Hansen, Per'))
+    store.put('2', marc('2', 'Olsen, Kari'))
+    index = StatusIndex(tmp_path)
+    index.upsert('1', node(marc('1', 'Hansen, Per')), '2024-01-01T00:00:00Z')
+    index.upsert('2', node(marc('2', 'Olsen, Kari')))
+    index.delete('3', '2024-02-01T00:00:00Z')
+
+    build_extractors(store, [index], MARC_NS)
+
+    assert index.get('1').datestamp == '2024-01-01T00:00:00Z'
+    assert index.get('2').datestamp is None
+    assert index.get('3').datestamp == '2024-02-01T00:00:00Z'
+
+    # Datestamps from the harvest still win after a rebuild
+    index.upsert('1', node(marc('1', 'Hansen, Per')), '2024-03-01T00:00:00Z')
+    assert index.get('1').datestamp == '2024-03-01T00:00:00Z'
+
+
+def bibbi_item(item_id: str, title: str, links) -> bytes:
+    fields = ['<leader>00000cam a2200000 c 4500</leader>',
+              f'<controlfield tag="001">{item_id}</controlfield>',
+              f'<datafield tag="245" ind1="1" ind2="0"><subfield code="a">{title}</subfield></datafield>']
+    fields += [f'<datafield tag="{tag}" ind1="1" ind2=" "><subfield code="a">Navn</subfield>'
+               f'<subfield code="0">{link}</subfield></datafield>' for tag, link in links]
+    return f'<record xmlns="{MARC_NS}">{"".join(fields)}</record>'.encode('utf-8')
+
+
+def test_bibbi_index(tmp_path: Path):
+    index = BibbiIndex(tmp_path)
+    index.upsert('1', node(marc('1', 'Hansen, Per', [('noraf', '90001')], references=['Hansen, P.'])))
+    index.upsert('2', node(marc('2', 'Forlaget', tag='110')))
+    index.upsert('100', node(bibbi_item('100', 'Boka', [('100', 'https://id.bs.no/bibbi/1'),
+                                                         ('700', '(NO-TrBIB)90001')])))
+    index.upsert('101', node(bibbi_item('101', 'Om Per', [('600', '(bibbi)1'), ('710', '(bibbi)2')])))
+
+    authority = index.get('1')
+    assert (authority.record_type, authority.name, authority.label, authority.dates, authority.noraf_id) == \
+           ('person', 'Hansen, Per', 'Hansen, Per 1900-1980', '1900-1980', '90001')
+    assert authority.references == ['Hansen, P.']
+    assert index.get('2').record_type == 'corporation'
+    assert index.get('100') is None
+    assert index.items('1') == [BibbiLinkedItem('100', '100', 'Boka'), BibbiLinkedItem('101', '600', 'Om Per')]
+    assert index.lookup_noraf('90001') == ['1']
+    assert index.noraf_mapping(['person']) == {'1': '90001'}
+    assert index.counts() == {'person': 1, 'corporation': 1, 'items': 2}
+
+    # Upserts replace, and deletes remove the item links too
+    index.upsert('1', node(marc('1', 'Hansen, Per', references=['Hansen, Peder'])))
+    index.delete('101')
+    assert index.get('1').references == ['Hansen, Peder']
+    assert index.get('1').noraf_id is None
+    assert [item.item_id for item in index.items('1')] == ['100']
+    index.close()
+
+    assert BibbiIndex(tmp_path, readonly=True).items('2') == []
@@ -0,0 +1,59 @@
+from seiso.common.harvest_journal import (
+    OP_DELETE, OP_UPSERT, HarvestJournal, JournalConsumer, journal_path,
+)
+
+
+def write_entries(harvest_dir, entries):
+    journal = HarvestJournal(journal_path(harvest_dir))
+    for record_id, op in entries:
+        journal.append(record_id, op, '2024-01-01')
+    journal.close()
+
+
+def test_sequence_continues_after_reopen(tmp_path):
+    write_entries(tmp_path, [('1', OP_UPSERT), ('2', OP_UPSERT)])
+    journal = HarvestJournal(journal_path(tmp_path))
+    assert journal.append('3', OP_UPSERT) == 3
+    journal.close()
+
+
+def test_torn_last_line_is_dropped(tmp_path):
+    write_entries(tmp_path, [('1', OP_UPSERT)])
+    with journal_path(tmp_path).open('a') as fp:
+        fp.write('2\t2\tups')
+    journal = HarvestJournal(journal_path(tmp_path))
+    assert journal.append('2', OP_UPSERT) == 2
+    journal.close()
+    assert [e.record_id for e in JournalConsumer(tmp_path, 'test').entries()] == ['1', '2']
+
+
+def test_consumer_only_sees_new_entries_after_commit(tmp_path):
+    write_entries(tmp_path, [('1', OP_UPSERT), ('2', OP_UPSERT)])
+
+    consumer = JournalConsumer(tmp_path, 'test')
+    assert not consumer.has_cursor
+    assert set(consumer.changed_ids()) == {'1', '2'}
+
+    # Not committed, so the same changes are returned again
+    assert set(JournalConsumer(tmp_path, 'test').changed_ids()) == {'1', '2'}
+
+    consumer.commit()
+    write_entries(tmp_path, [('2', OP_DELETE), ('3', OP_UPSERT)])
+
+    consumer = JournalConsumer(tmp_path, 'test')
+    assert consumer.has_cursor
+    changes = consumer.changed_ids()
+    assert set(changes) == {'2', '3'}
+    assert changes['2'].op == OP_DELETE
+
+    # Other consumers have their own cursor
+    assert set(JournalConsumer(tmp_path, 'other').changed_ids()) == {'1', '2', '3'}
+
+
+def test_seek_to_end(tmp_path):
+    write_entries(tmp_path, [('1', OP_UPSERT)])
+    consumer = JournalConsumer(tmp_path, 'test')
+    consumer.seek_to_end()
+    consumer.commit()
+    write_entries(tmp_path, [('2', OP_UPSERT)])
+    assert list(JournalConsumer(tmp_path, 'test').changed_ids()) == ['2']
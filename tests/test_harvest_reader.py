@@ -0,0 +1,87 @@
+from pathlib import Path
+
+import pytest
+
+from seiso.common.harvest_reader import HarvestReader, parse_noraf_record
+from seiso.common.harvest_store import open_store
+from seiso.common.interfaces import NorafCorporationRecord, NorafPersonRecord
+
+MARC_NS = 'info:lc/xmlns/marcxchange-v1'
+
+
+def marc(record_id: str, name: str, tag: str = '100') -> bytes:
+    return (
+        f'<record xmlns="{MARC_NS}">'
+        f'<controlfield tag="001">{record_id}</controlfield>'
+        f'<controlfield tag="005">20240102120000.0</controlfield>'
+        f'<controlfield tag="008">240101n| azannaabn          |a aaa      </controlfield>'
+        f'<datafield tag="024" ind1="7" ind2=" "><subfield code="a">b{record_id}</subfield>'
+        f'<subfield code="2">bibbi</subfield></datafield>'
+        f'<datafield tag="{tag}" ind1="1" ind2=" "><subfield code="a">{name}</subfield>'
+        f'<subfield code="d">1900-1980</subfield></datafield>'
+        f'<datafield tag="400" ind1="1" ind2=" "><subfield code="a">{name} (ref)</subfield></datafield>'
+        f'</record>'
+    ).encode('utf-8')
+
+
+def record_name(record_id: str, data: bytes):
+    record = parse_noraf_record(record_id, data)
+    return record.name if record is not None else None
+
+
+@pytest.fixture
+def harvest_dir(tmp_path: Path) -> Path:
+    with open_store(tmp_path) as store:
+        for n in range(25):
+            store.put(str(1000 + n), marc(str(1000 + n), 'Name %d' % n, tag='110' if n % 5 == 0 else '100'))
+        store.put('2000', f'<record xmlns="{MARC_NS}"><controlfield tag="001">2000</controlfield></record>'.encode())
+    return tmp_path
+
+
+def test_reader_parses_records(harvest_dir: Path):
+    records = list(HarvestReader(harvest_dir, workers=0))
+
+    assert len(records) == 25  # The record without a heading is skipped
+    record = next(record for record in records if record.id == '1001')
+    assert isinstance(record, NorafPersonRecord)
+    assert record.name == 'Name 1'
+    assert record.alt_names == ['Name 1 (ref)']
+    assert record.other_ids == {'bibbi': ['b1001']}
+    assert isinstance(next(record for record in records if record.id == '1000'), NorafCorporationRecord)
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_reader_with_process_pool(harvest_dir: Path, ordered: bool):
+    expected = [record.id for record in HarvestReader(harvest_dir, workers=0)]
+
+    ids = [record.id for record in HarvestReader(harvest_dir, workers=2, chunk_size=3, ordered=ordered)]
+
+    if ordered:
+        assert ids == expected
+    else:
+        assert sorted(ids) == sorted(expected)
+
+
+def test_reader_fields(harvest_dir: Path):
+    rows = list(HarvestReader(harvest_dir, workers=2, chunk_size=4).fields(['id', 'type', 'modified']))
+
+    assert {'id': '1000', 'type': 'corporation', 'modified': '2024-01-02'} in rows
+    assert {'id': '1001', 'type': 'person', 'modified': '2024-01-02'} in rows
+
+
+def test_reader_raw(harvest_dir: Path):
+    raw = dict(HarvestReader(harvest_dir).raw())
+
+    assert len(raw) == 26
+    assert raw['1001'] == marc('1001', 'Name 1')
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_reader_map_ids_reads_in_workers(harvest_dir: Path, workers: int):
+    reader = HarvestReader(harvest_dir, workers=workers, chunk_size=4)
+
+    records = list(reader.map_ids(parse_noraf_record, ['1003', '1001', 'missing', '2000']))
+    names = list(reader.map_ids(record_name))
+
+    assert [record.id for record in records] == ['1003', '1001']
+    assert sorted(names) == sorted(['Name %d' % n for n in range(25)])
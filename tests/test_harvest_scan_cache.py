@@ -0,0 +1,117 @@
+from functools import partial
+from pathlib import Path
+
+import pytest
+
+from seiso.common import harvest_scan_cache
+from seiso.common.harvest_reader import HarvestReader
+from seiso.common.harvest_scan_cache import ScanCache
+from seiso.common.harvest_snapshots import create_snapshot
+from seiso.common.harvest_store import open_store
+
+
+def linked(record_id: str, data: bytes):
+    return record_id if b'>bibbi<' in data else None
+
+
+def vocabulary_match(vocabulary: bytes, record_id: str, data: bytes):
+    return record_id if b'>%s<' % vocabulary in data else None
+
+
+def record(n: int, vocabulary: str = 'bibbi') -> bytes:
+    return b'<record><id>%d</id><v>%s</v></record>' % (n, vocabulary.encode())
+
+
+@pytest.fixture(autouse=True)
+def trust_recent_mtimes(monkeypatch):
+    monkeypatch.setattr(harvest_scan_cache, 'MTIME_SLACK', 0)
+
+
+@pytest.mark.parametrize('kind', ['files', 'segments'])
+def test_scan_reads_only_changed_records(tmp_path: Path, kind: str):
+    harvest_dir = tmp_path.joinpath('harvest')
+    cache_file = tmp_path.joinpath('scan.sqlite')
+    harvest_dir.mkdir()
+    store = open_store(harvest_dir, kind)
+    for n in range(50):
+        store.put(str(n), record(n, 'bibbi' if n % 5 == 0 else 'viaf'))
+    store.close()
+    reader = HarvestReader(harvest_dir, workers=0)
+
+    with ScanCache(cache_file) as cache:
+        assert cache.scan(reader, linked) == sorted(str(n) for n in range(0, 50, 5))
+        assert cache.read == 50
+    with ScanCache(cache_file) as cache:
+        assert len(cache.scan(reader, linked)) == 10
+        assert cache.read == 0
+
+    store = open_store(harvest_dir, kind)
+    store.put('1', record(1, 'bibbi'))
+    store.put('5', record(5, 'viaf'))
+    store.delete('10')
+    store.put('100', record(100))
+    store.close()
+
+    with ScanCache(cache_file) as cache:
+        assert cache.scan(reader, linked) == sorted(['0', '1', '100', '15', '20', '25', '30', '35', '40', '45'])
+        assert 0 < cache.read < 50
+
+
+def test_scan_after_compaction(tmp_path: Path):
+    store = open_store(tmp_path, 'segments')
+    for n in range(20):
+        store.put(str(n), record(n, 'bibbi' if n < 10 else 'viaf'))
+    store.delete('3')
+    reader = HarvestReader(tmp_path, workers=0)
+    cache = ScanCache(tmp_path.joinpath('scan.sqlite'))
+    store.flush()
+    expected = sorted(str(n) for n in range(10) if n != 3)
+    assert cache.scan(reader, linked) == expected
+
+    store.compact()
+    store.close()
+    assert cache.scan(reader, linked) == expected
+    assert cache.read == 19
+
+
+def test_cache_is_shared_with_snapshots(tmp_path: Path):
+    store = open_store(tmp_path, 'files')
+    for n in range(20):
+        store.put(str(n), record(n))
+    snapshot = create_snapshot(tmp_path, store)
+    cache = ScanCache(tmp_path.joinpath('indexes', 'scan.sqlite'))
+    assert len(cache.scan(HarvestReader(tmp_path, workers=0), linked)) == 20
+
+    assert len(cache.scan(HarvestReader(snapshot.path, workers=0), linked)) == 20
+    assert cache.read == 0
+
+
+def any_record(record_id: str, data: bytes):
+    return record_id
+
+
+def test_cache_starts_over_for_another_function(tmp_path: Path):
+    with open_store(tmp_path, 'files') as store:
+        store.put('1', record(1, 'viaf'))
+    reader = HarvestReader(tmp_path, workers=0)
+    cache = ScanCache(tmp_path.joinpath('scan.sqlite'))
+    assert cache.scan(reader, linked) == []
+
+    assert cache.scan(reader, any_record) == ['1']
+    assert cache.read == 1
+
+
+def test_cache_requires_a_key_for_anonymous_functions(tmp_path: Path):
+    with open_store(tmp_path, 'files') as store:
+        store.put('1', record(1, 'viaf'))
+    reader = HarvestReader(tmp_path, workers=0)
+    cache = ScanCache(tmp_path.joinpath('scan.sqlite'))
+
+    with pytest.raises(ValueError):
+        cache.scan(reader, lambda record_id, data: record_id)
+    with pytest.raises(ValueError):
+        cache.scan(reader, partial(vocabulary_match, b'viaf'))
+
+    assert cache.scan(reader, partial(vocabulary_match, b'viaf'), key='vocabulary:viaf') == ['1']
+    assert cache.scan(reader, partial(vocabulary_match, b'bibbi'), key='vocabulary:bibbi') == []
+    assert cache.read == 1
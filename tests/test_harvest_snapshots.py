@@ -0,0 +1,119 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from seiso.common.harvest_journal import OP_UPSERT, HarvestJournal, JournalConsumer, journal_path
+from seiso.common.harvest_snapshots import create_snapshot, list_snapshots, pin_snapshot, prune_snapshots
+from seiso.common.harvest_store import FileStore, MappedIndex, open_store
+from seiso.common.oai_server import MARCXCHANGE_NS, OaiServer, OaiServerSettings, synthetic_records
+from seiso.services.oai import OaiPmh, OaiPmhSettings
+
+
+@pytest.fixture(params=[('files', 'none'), ('segments', 'none'), ('segments', 'zstd')],
+                ids=lambda param: '-'.join(param))
+def store(request, tmp_path: Path):
+    kind, compression = request.param
+    store = open_store(tmp_path, kind, compression=compression)
+    yield store
+    store.close()
+
+
+def test_snapshot_is_not_changed_by_the_live_store(store, tmp_path: Path):
+    store.put('1', b'<record>1</record>')
+    store.put('2', b'<record>2</record>')
+    snapshot = create_snapshot(tmp_path, store)
+
+    store.put('1', b'<record>1 changed</record>')
+    store.delete('2')
+    store.put('3', b'<record>3</record>')
+    store.compact()
+    store.flush()
+
+    with snapshot.open_store() as frozen:
+        assert dict(frozen.scan()) == {'1': b'<record>1</record>', '2': b'<record>2</record>'}
+    assert dict(store.scan()) == {'1': b'<record>1 changed</record>', '3': b'<record>3</record>'}
+
+
+def test_segment_snapshot_has_mapped_index(tmp_path: Path):
+    with open_store(tmp_path, 'segments') as store:
+        store.put('1', b'<record>1</record>')
+        snapshot = create_snapshot(tmp_path, store)
+
+    with snapshot.open_store() as frozen:
+        assert isinstance(frozen.index, MappedIndex)
+        assert frozen.get('1') == b'<record>1</record>'
+
+
+def test_file_store_ignores_snapshots(tmp_path: Path):
+    store = FileStore(tmp_path)
+    store.put('1', b'<record>1</record>')
+    create_snapshot(tmp_path, store)
+    create_snapshot(tmp_path, store)
+
+    assert list(store.ids()) == ['1']
+
+
+def test_prune_keeps_pinned_snapshots(tmp_path: Path):
+    with open_store(tmp_path, 'segments') as store:
+        for n in range(4):
+            store.put('1', b'<record>%d</record>' % n)
+            create_snapshot(tmp_path, store)
+
+    pinned = pin_snapshot(tmp_path, generation=1)
+    assert prune_snapshots(tmp_path, keep=2) == [2]
+    assert [snapshot.generation for snapshot in list_snapshots(tmp_path)] == [1, 3, 4]
+    assert pinned.store.get('1') == b'<record>0</record>'
+
+    pinned.release()
+    assert prune_snapshots(tmp_path, keep=2) == [1]
+    assert pin_snapshot(tmp_path).snapshot.generation == 4
+
+
+def test_stale_pins_are_ignored(tmp_path: Path):
+    with open_store(tmp_path) as store:
+        store.put('1', b'<record>1</record>')
+        create_snapshot(tmp_path, store)
+        create_snapshot(tmp_path, store)
+    pinned = pin_snapshot(tmp_path, generation=1)
+    os.utime(pinned.pin_file, (0, 0))
+
+    assert prune_snapshots(tmp_path, keep=1) == [1]
+
+
+def test_journal_consumer_stops_at_snapshot(tmp_path: Path):
+    journal = HarvestJournal(journal_path(tmp_path))
+    journal.append('1', OP_UPSERT)
+    journal.close()
+    snapshot = create_snapshot(tmp_path)
+    journal = HarvestJournal(journal_path(tmp_path))
+    journal.append('2', OP_UPSERT)
+    journal.close()
+
+    consumer = JournalConsumer(tmp_path, 'test', end_offset=snapshot.journal_offset)
+    assert list(consumer.changed_ids()) == ['1']
+    consumer.commit()
+    assert list(JournalConsumer(tmp_path, 'test').changed_ids()) == ['2']
+
+
+def test_harvest_takes_snapshots(tmp_path: Path):
+    records = synthetic_records(40, deleted_share=0)
+    settings = OaiPmhSettings(
+        endpoint='',
+        metadata_prefix='marcxchange',
+        metadata_schema=MARCXCHANGE_NS,
+        storage_dir=tmp_path,
+        store='segments',
+        snapshots=2,
+    )
+    with OaiServer(records, OaiServerSettings(page_size=10)) as server:
+        settings.endpoint = server.url
+        OaiPmh(settings).harvest()
+        # Incremental runs would find no new records, so reconcile, which also ends with a snapshot
+        OaiPmh(settings).reconcile()
+        OaiPmh(settings).reconcile()
+
+    assert [snapshot.generation for snapshot in list_snapshots(tmp_path)] == [2, 3]
+    with pin_snapshot(tmp_path) as pinned:
+        assert len(list(pinned.store.ids())) == 40
+        assert pinned.snapshot.journal_offset == journal_path(tmp_path).stat().st_size
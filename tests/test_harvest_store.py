@@ -0,0 +1,194 @@
+from pathlib import Path
+
+import pytest
+
+from seiso.common.compression import CODEC_GZIP, CODEC_ZSTD, detect_codec, train_dictionary
+from seiso.common.harvest_store import FileStore, MappedIndex, SegmentStore, content_digest, open_store
+
+
+@pytest.fixture(params=[
+    ('files', 'none'), ('segments', 'none'), ('files', 'gzip'), ('segments', 'zstd'),
+], ids=lambda param: '-'.join(param))
+def store(request, tmp_path: Path):
+    kind, compression = request.param
+    return open_store(tmp_path, kind, compression=compression)
+
+
+def test_put_get_delete(store):
+    store.put('123', b'<record>1</record>')
+    store.put('456', b'<record>2</record>')
+    store.put('123', b'<record>3</record>')
+
+    assert store.get('123') == b'<record>3</record>'
+    assert store.get('789') is None
+    assert '456' in store
+
+    assert store.delete('456') is True
+    assert store.delete('456') is False
+    assert '456' not in store
+    assert sorted(store.ids()) == ['123']
+    assert list(store.scan()) == [('123', b'<record>3</record>')]
+
+
+def test_open_store_detects_layout(tmp_path: Path):
+    assert isinstance(open_store(tmp_path), FileStore)
+    SegmentStore(tmp_path).close()
+    assert isinstance(open_store(tmp_path), SegmentStore)
+
+
+def test_segment_store_reopen(tmp_path: Path):
+    store = SegmentStore(tmp_path)
+    store.put('1', b'one')
+    store.put('2', b'two')
+    store.close()
+
+    # Entries written after the index was saved are replayed when the store is opened
+    store = SegmentStore(tmp_path)
+    store.delete('1')
+    store.put('3', b'three')
+    store.flush()
+
+    reopened = SegmentStore(tmp_path, readonly=True)
+    assert sorted(reopened.ids()) == ['2', '3']
+    assert reopened.get('3') == b'three'
+
+
+def test_segment_store_truncates_torn_write(tmp_path: Path):
+    store = SegmentStore(tmp_path)
+    store.put('1', b'one')
+    store.close()
+    with store.segment_path(1).open('ab') as fp:
+        fp.write(b'P\x00\x01\x00\x00')
+
+    store = SegmentStore(tmp_path)
+    assert list(store.scan()) == [('1', b'one')]
+    store.put('2', b'two')
+    store.close()
+    assert dict(SegmentStore(tmp_path).scan()) == {'1': b'one', '2': b'two'}
+
+
+def test_segment_store_compact(tmp_path: Path):
+    store = SegmentStore(tmp_path, segment_size=64)
+    for n in range(20):
+        store.put(str(n % 5), b'version %d' % n)
+    store.delete('4')
+    store.flush()
+    assert len(store.segments()) > 1
+
+    size_before, size_after = store.compact()
+    store.close()
+
+    assert size_after < size_before
+    store = SegmentStore(tmp_path)
+    assert dict(store.scan()) == {str(n): b'version %d' % (n + 15) for n in range(4)}
+
+
+def test_put_skips_unchanged(store):
+    assert store.put('123', b'<record>1</record>') is True
+    assert store.put('123', b'<record>1</record>') is False
+    assert store.put('123', b'<record>2</record>') is True
+    assert store.get('123') == b'<record>2</record>'
+
+
+def test_segment_store_keeps_digests_across_reopen(tmp_path: Path):
+    store = SegmentStore(tmp_path)
+    store.put('1', b'one')
+    store.close()
+    store = SegmentStore(tmp_path)
+    store.put('2', b'two')
+    store.flush()
+
+    store = SegmentStore(tmp_path)
+    assert store.put('1', b'one') is False
+    assert store.put('2', b'two') is False
+
+
+def test_readonly_segment_store_maps_index(tmp_path: Path):
+    store = SegmentStore(tmp_path)
+    for n in range(100):
+        store.put(str(n), b'record %d' % n)
+    store.close()
+    store = SegmentStore(tmp_path)
+    store.delete('5')
+    store.put('7', b'changed')
+    store.put('100', b'record 100')
+    store.flush()
+
+    # The entries written after the mapped index was saved are replayed on top of it
+    reader = SegmentStore(tmp_path, readonly=True)
+    assert isinstance(reader.index, MappedIndex)
+    assert len(reader) == 100
+    assert reader.get('7') == b'changed'
+    assert reader.get('99') == b'record 99'
+    assert reader.get('1000') is None
+    assert '5' not in reader
+    assert sorted(reader.ids(), key=int) == [str(n) for n in range(101) if n != 5]
+    assert reader.index['1'][3] == content_digest(b'record 1')
+    reader.close()
+    store.close()
+
+
+def test_segment_store_ignores_invalid_mapped_index(tmp_path: Path):
+    store = SegmentStore(tmp_path)
+    store.put('1', b'one')
+    store.close()
+    store.mapped_index_file.write_bytes(b'garbage')
+
+    reader = SegmentStore(tmp_path, readonly=True)
+    assert not isinstance(reader.index, MappedIndex)
+    assert reader.get('1') == b'one'
+
+
+def make_marc(n: int) -> bytes:
+    return (
+        '<record xmlns="info:lc/xmlns/marcxchange-v1" format="MARC21" type="Authority">'
+        '<leader>99999nz  a2299999n  4500</leader><controlfield tag="001">%d</controlfield>'
+        '<datafield tag="100" ind1="1" ind2=" "><subfield code="a">Person %d</subfield></datafield>'
+        '<datafield tag="024" ind1="7" ind2=" "><subfield code="a">%d</subfield><subfield code="2">bibbi</subfield>'
+        '</datafield></record>' % (n, n, n * 7)
+    ).encode('utf-8')
+
+
+@pytest.mark.parametrize('kind', ['files', 'segments'])
+def test_compression_setting_is_remembered_and_old_records_readable(tmp_path: Path, kind):
+    store = open_store(tmp_path, kind)
+    store.put('1', make_marc(1))
+    store.close()
+
+    store = open_store(tmp_path, kind, compression=CODEC_GZIP)
+    store.put('2', make_marc(2))
+    store.close()
+
+    store = open_store(tmp_path, readonly=True)
+    assert store.codec.codec == CODEC_GZIP
+    assert dict(store.scan()) == {'1': make_marc(1), '2': make_marc(2)}
+
+
+def test_file_store_compact_converts_records(tmp_path: Path):
+    store = open_store(tmp_path, 'files')
+    for n in range(5):
+        store.put(str(n), make_marc(n))
+    store = open_store(tmp_path, 'files', compression=CODEC_ZSTD)
+    store.compact()
+
+    assert all(path.name.endswith('.xml.zst') for path in store.files())
+    assert store.get('3') == make_marc(3)
+    assert sorted(store.ids()) == ['0', '1', '2', '3', '4']
+
+
+def test_segment_store_with_trained_dictionary(tmp_path: Path):
+    store = open_store(tmp_path, 'segments')
+    for n in range(500):
+        store.put(str(n), make_marc(n))
+    store.close()
+    size_plain = sum(path.stat().st_size for path in tmp_path.glob('segments/*.seg'))
+
+    train_dictionary(tmp_path, (data for record_id, data in open_store(tmp_path, readonly=True).scan()), size=4096)
+    store = open_store(tmp_path, compression=CODEC_ZSTD)
+    store.compact()
+    store.close()
+
+    store = open_store(tmp_path, readonly=True)
+    assert store.get('42') == make_marc(42)
+    assert detect_codec(next(store._read_entries(store.segments()[0]))[3]) == CODEC_ZSTD
+    assert sum(path.stat().st_size for path in tmp_path.glob('segments/*.seg')) < size_plain / 3
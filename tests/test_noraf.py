@@ -2,6 +2,8 @@ from datetime import date
 
 import pytest
 
+from seiso.common.harvest_extractors import NameIndex, build_extractors
+from seiso.common.harvest_store import open_store
 from seiso.common.interfaces import NorafPersonRecord
 from seiso.services.noraf import Noraf, NorafRecordNotFound
 
@@ -102,3 +104,34 @@ def test_noraf_get_not_found():
         noraf.get('expected_fail')
 
     assert 'expected_fail' in str(exc)
+
+
+def test_noraf_local_search(tmp_path):
+    marc_ns = 'info:lc/xmlns/marcxchange-v1'
+    names = {
+        '1': ('Brontë, Charlotte', '1816-1855', 'Bell, Currer'),
+        '2': ('Brontë, Emily', '1818-1848', 'Bell, Ellis'),
+        '3': ('Hveberg, Klara', '1974-', 'Hveberg, K.'),
+    }
+    with open_store(tmp_path) as store:
+        for record_id, (name, dates, reference) in names.items():
+            store.put(record_id, (
+                f'<record xmlns="{marc_ns}"><controlfield tag="001">{record_id}</controlfield>'
+                f'<controlfield tag="005">20240102120000.0</controlfield>'
+                f'<controlfield tag="008">240101n| azannaabn          |a aaa      </controlfield>'
+                f'<datafield tag="100" ind1="1" ind2=" "><subfield code="a">{name}</subfield>'
+                f'<subfield code="d">{dates}</subfield></datafield>'
+                f'<datafield tag="400" ind1="1" ind2=" "><subfield code="a">{reference}</subfield></datafield>'
+                f'</record>'
+            ).encode('utf-8'))
+        index = NameIndex(tmp_path)
+        build_extractors(store, [index], marc_ns)
+        index.close()
+
+    noraf = Noraf(update_log=tmp_path.joinpath('updates.log'), harvest_dir=tmp_path)
+
+    assert sorted(record.id for record in noraf.local_search('bronte')) == ['1', '2']
+    assert [record.name for record in noraf.local_search('Bronte', dates='1818')] == ['Brontë, Emily']
+    assert [record.id for record in noraf.local_search('currer bell')] == ['1']
+    assert [record.dates for record in noraf.local_search('hveberg klara')] == ['1974-']
+    assert list(noraf.local_search('Hansen')) == []
@@ -0,0 +1,612 @@
+import json
+from datetime import date, datetime
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+from requests import Response
+from lxml import etree
+from sickle import Sickle
+from sickle.oaiexceptions import NoRecordsMatch
+from sickle.response import OAIResponse
+from urllib3 import HTTPResponse
+
+from seiso.common.harvest_extractors import STATUS_DELETED, STATUS_LIVE, NameIndex, RecordStats, StatusIndex
+from seiso.common.harvest_journal import OP_DELETE, OP_UPSERT, JournalConsumer
+from seiso.common.harvest_store import STORE_SEGMENTS, SegmentStore, open_store
+from seiso.common.xml import XmlNode
+from seiso.services.oai import (
+    OaiPmh, OaiPmhSettings, ChangeManifest, HarvestError, HarvestSummary, HarvestPartition, ListRecordsParser,
+    harvest_concurrently, split_date_range,
+)
+
+MARC_NS = 'info:lc/xmlns/marcxchange-v1'
+
+
+def make_record(record_id: str, deleted: bool = False) -> str:
+    if deleted:
+        return f'<record><header status="deleted"><identifier>oai:example:{record_id}</identifier>' \
+               f'<datestamp>2024-01-01T00:00:00Z</datestamp></header></record>'
+    return f'<record><header><identifier>oai:example:{record_id}</identifier>' \
+           f'<datestamp>2024-01-01T00:00:00Z</datestamp></header>' \
+           f'<metadata><marc:record xmlns:marc="{MARC_NS}">' \
+           f'<marc:controlfield tag="001">{record_id}</marc:controlfield>' \
+           f'<marc:datafield tag="100" ind1="1" ind2=" "><marc:subfield code="a">Name {record_id}</marc:subfield>' \
+           f'</marc:datafield></marc:record></metadata></record>'
+
+
+def make_page(records: list[str], token: str | None) -> bytes:
+    token_elem = f'<resumptionToken>{token}</resumptionToken>' if token else '<resumptionToken/>'
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">'
+        '<responseDate>2024-01-01T00:00:00Z</responseDate><request verb="ListRecords">http://example.com/oai</request>'
+        f'<ListRecords>{"".join(records)}{token_elem}</ListRecords></OAI-PMH>'
+    ).encode('utf-8')
+
+
+def http_response(content: bytes) -> Response:
+    response = Response()
+    response.status_code = 200
+    response.raw = HTTPResponse(body=BytesIO(content), preload_content=False)
+    return response
+
+
+@pytest.fixture
+def pages():
+    return {
+        None: make_page([make_record('1001'), make_record('1002')], 'page2'),
+        'page2': make_page([make_record('1003'), make_record('1004', deleted=True)], 'page3'),
+        'page3': make_page([make_record('1005')], None),
+    }
+
+
+@pytest.fixture
+def fake_endpoint(monkeypatch, pages):
+    requests = []
+
+    def harvest(self, **kwargs):
+        requests.append(kwargs)
+        return OAIResponse(http_response(pages[kwargs.get('resumptionToken')]), params=kwargs)
+
+    monkeypatch.setattr(Sickle, 'harvest', harvest)
+    return requests
+
+
+@pytest.fixture
+def provider(tmp_path: Path) -> OaiPmh:
+    return OaiPmh(OaiPmhSettings(
+        endpoint='http://example.com/oai',
+        metadata_prefix='marcxchange',
+        metadata_schema=MARC_NS,
+        storage_dir=tmp_path,
+    ))
+
+
+def stored_ids(storage_dir: Path) -> set[str]:
+    return set(open_store(storage_dir).ids())
+
+
+def test_harvest(fake_endpoint, provider: OaiPmh):
+    provider.store.put('1004', b'<record/>')
+
+    provider.harvest()
+
+    assert stored_ids(provider.settings.storage_dir) == {'1001', '1002', '1003', '1005'}
+    summary = HarvestSummary.load(provider.summary_file)
+    assert summary.fetched == 4
+    assert summary.deleted == 1
+    assert summary.ended is not None
+    assert summary.resumption_token is None
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_harvest_pipelined(fake_endpoint, provider: OaiPmh, workers: int):
+    provider.store.put('1004', b'<record/>')
+
+    provider.harvest_pipelined(workers=workers, queue_size=1)
+
+    assert stored_ids(provider.settings.storage_dir) == {'1001', '1002', '1003', '1005'}
+    assert [req.get('resumptionToken') for req in fake_endpoint] == [None, 'page2', 'page3']
+    summary = HarvestSummary.load(provider.summary_file)
+    assert summary.fetched == 4
+    assert summary.deleted == 1
+    assert summary.resumption_token is None
+
+
+def test_pipelined_and_sequential_harvests_store_the_same_bytes(fake_endpoint, tmp_path: Path):
+    settings = dict(endpoint='http://example.com/oai', metadata_prefix='marcxchange', metadata_schema=MARC_NS)
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'b').mkdir()
+    OaiPmh(OaiPmhSettings(storage_dir=tmp_path / 'a', **settings)).harvest()
+    OaiPmh(OaiPmhSettings(storage_dir=tmp_path / 'b', **settings)).harvest_pipelined()
+
+    assert stored_ids(tmp_path / 'a') == stored_ids(tmp_path / 'b')
+    for path in (tmp_path / 'a').glob('*/*.xml'):
+        assert path.read_bytes() == (tmp_path / 'b' / path.relative_to(tmp_path / 'a')).read_bytes()
+
+
+def test_harvest_into_segment_store(fake_endpoint, provider: OaiPmh):
+    provider.settings.store = STORE_SEGMENTS
+    provider = OaiPmh(provider.settings)
+    provider.store.put('1004', b'<record/>')
+
+    provider.harvest_pipelined(workers=2)
+
+    store = open_store(provider.settings.storage_dir)
+    assert isinstance(store, SegmentStore)
+    assert set(store.ids()) == {'1001', '1002', '1003', '1005'}
+    assert b'Name 1003' in store.get('1003')
+
+
+def test_list_records_parser():
+    page = make_page([make_record('1001'), make_record('1002', deleted=True)], 'next&amp;page')
+    parser = ListRecordsParser(BytesIO(page), MARC_NS)
+
+    records = [(rec.record_id, rec.deleted, rec.datestamp, rec.serialize() if rec.element is not None else None)
+               for rec in parser]
+
+    assert [rec[:3] for rec in records] == [
+        ('1001', False, '2024-01-01T00:00:00Z'),
+        ('1002', True, '2024-01-01T00:00:00Z'),
+    ]
+    assert parser.resumption_token == 'next&page'
+    stored = etree.fromstring(records[0][3])
+    assert stored.tag == '{%s}record' % MARC_NS
+    assert stored.findtext('{%s}controlfield' % MARC_NS) == '1001'
+
+
+def test_list_records_parser_raises_oai_errors():
+    page = b'<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><error code="noRecordsMatch">' \
+           b'No records</error></OAI-PMH>'
+    with pytest.raises(NoRecordsMatch):
+        list(ListRecordsParser(BytesIO(page), MARC_NS))
+
+
+def test_split_date_range():
+    assert split_date_range(date(2020, 1, 1), date(2020, 1, 10), 3) == [
+        ('2020-01-01', '2020-01-03'),
+        ('2020-01-04', '2020-01-06'),
+        ('2020-01-07', None),
+    ]
+    assert split_date_range(date(2020, 1, 1), date(2020, 1, 2), 5) == [
+        ('2020-01-01', '2020-01-01'),
+        ('2020-01-02', None),
+    ]
+
+
+def test_harvest_partitioned(monkeypatch, provider: OaiPmh):
+    identify = b'<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><Identify>' \
+               b'<earliestDatestamp>2000-01-01T00:00:00Z</earliestDatestamp></Identify></OAI-PMH>'
+    no_records = b'<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">' \
+                 b'<error code="noRecordsMatch">No records</error></OAI-PMH>'
+    windows = {
+        '2000-01-01': make_page([make_record('1001')], 'w1p2'),
+        'w1p2': make_page([make_record('1002')], None),
+        'w3': make_page([make_record('1003'), make_record('1001')], None),
+    }
+    requests = []
+
+    def harvest(self, **kwargs):
+        requests.append(kwargs)
+        if kwargs['verb'] == 'Identify':
+            content = identify
+        elif 'resumptionToken' in kwargs:
+            content = windows[kwargs['resumptionToken']]
+        elif kwargs['until'] is None:
+            content = windows['w3']
+        else:
+            content = windows.get(kwargs['from'], no_records)
+        return OAIResponse(http_response(content), params=kwargs)
+
+    monkeypatch.setattr(Sickle, 'harvest', harvest)
+
+    provider.harvest_partitioned(3)
+
+    assert stored_ids(provider.settings.storage_dir) == {'1001', '1002', '1003'}
+    summary = HarvestSummary.load(provider.summary_file)
+    assert summary.ended is not None
+    assert summary.fetched == 4
+    assert len(summary.partitions) == 3
+    assert all(partition.done for partition in summary.partitions)
+    assert [partition.fetched for partition in summary.partitions] == [2, 0, 2]
+    assert summary.partitions[0].from_date == '2000-01-01'
+    assert summary.partitions[2].until_date is None
+
+
+def test_resume_partitioned_harvest(fake_endpoint, provider: OaiPmh):
+    HarvestSummary(started=datetime.now(), partitions=[
+        HarvestPartition(from_date='2000-01-01', until_date='2009-12-31', done=True, fetched=10),
+        HarvestPartition(from_date='2010-01-01', resumption_token='page3', fetched=5),
+    ]).save_summary(provider.summary_file)
+
+    provider.harvest()
+
+    assert [req.get('resumptionToken') for req in fake_endpoint] == ['page3']
+    summary = HarvestSummary.load(provider.summary_file)
+    assert summary.ended is not None
+    assert summary.fetched == 16
+
+
+def test_harvest_sets(monkeypatch, provider: OaiPmh):
+    list_sets = b'<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><ListSets>' \
+                b'<set><setSpec>persons</setSpec><setName>Persons</setName></set>' \
+                b'<set><setSpec>corporations</setSpec><setName>Corporations</setName></set>' \
+                b'<set><setSpec>other</setSpec><setName>Other</setName></set>' \
+                b'</ListSets></OAI-PMH>'
+    sets = {
+        'persons': make_page([make_record('1001'), make_record('1002')], 'persons2'),
+        'persons2': make_page([make_record('1003')], None),
+        'corporations': make_page([make_record('2001'), make_record('1002')], None),
+    }
+    requests = []
+
+    def harvest(self, **kwargs):
+        requests.append(kwargs)
+        if kwargs['verb'] == 'ListSets':
+            content = list_sets
+        else:
+            content = sets[kwargs.get('resumptionToken') or kwargs['set']]
+        return OAIResponse(http_response(content), params=kwargs)
+
+    monkeypatch.setattr(Sickle, 'harvest', harvest)
+
+    assert provider.list_sets() == [('persons', 'Persons'), ('corporations', 'Corporations'), ('other', 'Other')]
+
+    provider.harvest_sets(['persons', 'corporations'])
+
+    assert stored_ids(provider.settings.storage_dir) == {'1001', '1002', '1003', '2001'}
+    summary = HarvestSummary.load(provider.summary_file)
+    assert summary.ended is not None
+    assert {partition.oai_set: partition.done for partition in summary.partitions} == {
+        'persons': True,
+        'corporations': True,
+    }
+    # Record 1002 is in both sets, but is only stored once
+    assert summary.fetched == 4
+
+
+@pytest.fixture
+def overlapping_sets(monkeypatch):
+    """Record 1002 leaves the persons set, which reports it as deleted, but is still live in corporations."""
+    sets = {
+        'persons': make_page([make_record('1001'), make_record('1002', deleted=True)], 'persons2'),
+        'persons2': make_page([make_record('1004', deleted=True)], None),
+        'corporations': make_page([make_record('1002'), make_record('2001')], None),
+    }
+    failing = set()
+
+    def harvest(self, **kwargs):
+        key = kwargs.get('resumptionToken') or kwargs['set']
+        if key in failing:
+            raise HarvestError('Simulated failure')
+        return OAIResponse(http_response(sets[key]), params=kwargs)
+
+    monkeypatch.setattr(Sickle, 'harvest', harvest)
+    monkeypatch.setattr(OaiPmh, 'list_sets', lambda self: [('persons', ''), ('corporations', '')])
+    return failing
+
+
+@pytest.mark.parametrize('order', [['persons', 'corporations'], ['corporations', 'persons']])
+def test_harvest_sets_keeps_records_deleted_in_one_set_but_live_in_another(overlapping_sets, provider: OaiPmh,
+                                                                            order):
+    provider.store.put('1002', b'<record/>')
+    provider.store.put('1004', b'<record/>')
+    provider.harvest_sets(order, workers=1)
+
+    assert stored_ids(provider.settings.storage_dir) == {'1001', '1002', '2001'}
+    assert not provider.deletes_file.exists()
+
+
+def test_harvest_sets_keeps_deletes_across_restart(overlapping_sets, provider: OaiPmh):
+    provider.store.put('1004', b'<record/>')
+    overlapping_sets.add('persons2')
+    with pytest.raises(HarvestError):
+        provider.harvest_sets(['corporations', 'persons'], workers=1)
+    assert provider.deletes_file.exists()
+
+    # The resumed run doesn't see 1002 stored, but finds it in the journal
+    overlapping_sets.clear()
+    resumed = OaiPmh(provider.settings)
+    resumed.harvest_sets()
+    assert stored_ids(provider.settings.storage_dir) == {'1001', '1002', '2001'}
+
+def test_harvest_unknown_set(monkeypatch, provider: OaiPmh):
+    monkeypatch.setattr(OaiPmh, 'list_sets', lambda self: [('persons', 'Persons')])
+    with pytest.raises(HarvestError):
+        provider.harvest_sets(['corporations'])
+
+
+def test_incremental_harvest_only_writes_changed_records(fake_endpoint, provider: OaiPmh, pages):
+    provider.store.put('1004', b'<record/>')
+    provider.harvest()
+    first = HarvestSummary.load(provider.summary_file)
+    assert sorted(ChangeManifest.read(provider.manifest_path(first))) == [
+        ('1001', 'upsert'), ('1002', 'upsert'), ('1003', 'upsert'), ('1004', 'delete'), ('1005', 'upsert'),
+    ]
+
+    pages['page3'] = make_page([make_record('1005').replace('Name 1005', 'New name')], None)
+    provider = OaiPmh(provider.settings)
+    provider.harvest()
+
+    second = HarvestSummary.load(provider.summary_file)
+    assert second.fetched == 4
+    assert second.changed == 1
+    assert list(ChangeManifest.read(provider.manifest_path(second))) == [('1005', 'upsert')]
+
+
+def test_harvest_writes_journal(fake_endpoint, provider: OaiPmh):
+    provider.harvest()
+    changes = JournalConsumer(provider.settings.storage_dir, 'test').changed_ids()
+    assert sorted(changes) == ['1001', '1002', '1003', '1004', '1005']
+    assert changes['1004'].op == OP_DELETE
+    assert changes['1001'].op == OP_UPSERT
+
+
+@pytest.mark.parametrize('method', ['harvest', 'harvest_pipelined'])
+def test_harvest_writes_metrics(fake_endpoint, provider: OaiPmh, tmp_path: Path, method):
+    provider.settings.prometheus_textfile = tmp_path / 'oai.prom'
+    getattr(provider, method)()
+
+    with provider.metrics_file.open() as fp:
+        metrics = json.load(fp)
+    assert metrics['totals']['pages'] == 3
+    assert metrics['totals']['records'] == 4
+    assert metrics['totals']['deleted'] == 1
+    assert metrics['totals']['bytes'] > 0
+    assert [page['number'] for page in sorted(metrics['pages'], key=lambda page: page['number'])] == [0, 1, 2]
+    assert metrics['run_ended'] is not None
+
+    prom = (tmp_path / 'oai.prom').read_text()
+    assert 'oai_harvest_run_records{source="%s"} 4' % provider.settings.storage_dir.name in prom
+    assert 'oai_harvest_run_stage_seconds{source="%s",stage="parse"}' % provider.settings.storage_dir.name in prom
+
+
+class BrokenStream(BytesIO):
+    """A response body where the connection drops after `limit` bytes."""
+
+    def __init__(self, content: bytes, limit: int):
+        super().__init__(content)
+        self.limit = limit
+
+    def read(self, size=-1):
+        if self.tell() >= self.limit:
+            raise ConnectionResetError('Connection reset by peer')
+        if size is None or size < 0 or self.tell() + size > self.limit:
+            size = self.limit - self.tell()
+        return super().read(size)
+
+
+@pytest.fixture
+def flaky_endpoint(monkeypatch, pages):
+    """Fails the first request for page2 with a 503, and drops the connection in the middle of page3 once."""
+    monkeypatch.setattr('seiso.services.oai.sleep', lambda seconds: None)
+    monkeypatch.setattr('seiso.common.throttle.sleep', lambda seconds: None)
+    requests = []
+
+    def harvest(self, **kwargs):
+        token = kwargs.get('resumptionToken')
+        requests.append(token)
+        if token == 'page2' and requests.count(token) == 1:
+            response = http_response(b'Service unavailable')
+            response.status_code = 503
+            response.headers['Retry-After'] = '0'
+            response.raise_for_status()
+        response = http_response(pages[token])
+        if token == 'page3' and requests.count(token) == 1:
+            content = pages[token]
+            response.raw = HTTPResponse(body=BrokenStream(content, content.index(b'</record>') + 20),
+                                        preload_content=False)
+        return OAIResponse(response, params=kwargs)
+
+    monkeypatch.setattr(Sickle, 'harvest', harvest)
+    return requests
+
+
+def test_harvest_retries_failed_requests_and_broken_streams(flaky_endpoint, provider: OaiPmh, pages):
+    pages['page3'] = make_page([make_record('1005'), make_record('1006')], None)
+    provider.harvest()
+
+    assert flaky_endpoint == [None, 'page2', 'page2', 'page3', 'page3']
+    assert stored_ids(provider.settings.storage_dir) == {'1001', '1002', '1003', '1005', '1006'}
+    summary = HarvestSummary.load(provider.summary_file)
+    assert summary.fetched == 5
+    with provider.metrics_file.open() as fp:
+        metrics = json.load(fp)
+    assert [page['retries'] for page in metrics['pages']] == [0, 1, 1]
+    assert [page['records'] for page in metrics['pages']] == [2, 1, 2]
+
+
+def test_harvest_concurrently(fake_endpoint, tmp_path: Path):
+    providers = {}
+    for name in ['a', 'b', 'broken']:
+        (tmp_path / name).mkdir()
+        providers[name] = OaiPmh(OaiPmhSettings(
+            endpoint='http://example.com/oai', metadata_prefix='marcxchange', metadata_schema=MARC_NS,
+            storage_dir=tmp_path / name,
+        ))
+
+    def harvest(provider: OaiPmh):
+        if provider.settings.storage_dir.name == 'broken':
+            raise HarvestError('Broken endpoint')
+        provider.harvest()
+
+    errors = harvest_concurrently(providers, harvest, report_interval=0)
+
+    assert errors['a'] is None and errors['b'] is None
+    assert isinstance(errors['broken'], HarvestError)
+    assert stored_ids(tmp_path / 'a') == stored_ids(tmp_path / 'b') == {'1001', '1002', '1003', '1005'}
+    assert providers['a'].session is not providers['b'].session
+
+
+def test_checkpoint_after_every_page(fake_endpoint, provider: OaiPmh):
+    def crash_on_1005(record):
+        if record.node.findtext('.//{%s}controlfield' % MARC_NS) == '1005':
+            raise KeyboardInterrupt()
+
+    with pytest.raises(KeyboardInterrupt):
+        provider.harvest(crash_on_1005)
+
+    summary = HarvestSummary.load(provider.summary_file)
+    assert summary.ended is None
+    assert summary.resumption_token == 'page3'
+    assert summary.page_offset == 0
+    assert summary.fetched == 3
+
+
+def test_resume_within_first_page_of_incremental_harvest(monkeypatch, provider: OaiPmh):
+    page = make_page([make_record(str(n)) for n in range(1001, 2501)], None)
+    requests = []
+
+    def harvest(self, **kwargs):
+        requests.append(kwargs)
+        return OAIResponse(http_response(page), params=kwargs)
+
+    def crash_on_2200(record):
+        if record.node.findtext('.//{%s}controlfield' % MARC_NS) == '2200':
+            raise KeyboardInterrupt()
+
+    monkeypatch.setattr(Sickle, 'harvest', harvest)
+    HarvestSummary(started=datetime(2024, 1, 1), ended=datetime(2024, 1, 1, 12)).save_summary(provider.summary_file)
+    with pytest.raises(KeyboardInterrupt):
+        provider.harvest(crash_on_2200)
+
+    summary = HarvestSummary.load(provider.summary_file)
+    assert (summary.resumption_token, summary.page_offset, summary.full) == (None, 1000, False)
+
+    provider.harvest()
+
+    assert [req.get('from') for req in requests] == ['2024-01-01', '2024-01-01']
+    changes = JournalConsumer(provider.settings.storage_dir, 'test').changed_ids()
+    assert len(changes) == 1500
+    summary = HarvestSummary.load(provider.summary_file)
+    assert (summary.fetched, summary.full) == (1500, False)
+    assert summary.ended is not None
+
+
+@pytest.mark.parametrize('method', ['harvest', 'harvest_pipelined'])
+def test_resume_within_page(fake_endpoint, provider: OaiPmh, method):
+    HarvestSummary(started=datetime(2024, 1, 1), resumption_token='page2', page_offset=1, fetched=3) \
+        .save_summary(provider.summary_file)
+    provider.store.put('1004', b'<record/>')
+
+    getattr(provider, method)()
+
+    assert [req.get('resumptionToken') for req in fake_endpoint] == ['page2', 'page3']
+    # 1003 was processed before the crash, so only 1004 (deleted) and 1005 are processed now
+    changes = JournalConsumer(provider.settings.storage_dir, 'test').changed_ids()
+    assert sorted(changes) == ['1004', '1005']
+    summary = HarvestSummary.load(provider.summary_file)
+    assert summary.fetched == 4
+    assert summary.deleted == 1
+    assert summary.ended is not None
+
+
+def test_invalid_summary_is_not_treated_as_no_harvest(fake_endpoint, provider: OaiPmh):
+    provider.summary_file.write_text('{"started": "2024-01-01T00:00:00", "ended": nu')
+    with pytest.raises(HarvestError):
+        provider.harvest()
+    assert fake_endpoint == []
+
+
+def test_harvest_runs_extractors(fake_endpoint, provider: OaiPmh):
+    provider.settings.extractors = ['names', 'stats']
+    provider = OaiPmh(provider.settings)
+    provider.harvest()
+
+    names = NameIndex(provider.settings.storage_dir, readonly=True)
+    assert names.lookup('Name 1001') == ['1001']
+    stats = RecordStats(provider.settings.storage_dir, readonly=True)
+    assert stats.summary()['records'] == 4
+
+
+def test_harvest_keeps_status_of_deleted_records(fake_endpoint, provider: OaiPmh):
+    provider.harvest()
+
+    status = StatusIndex(provider.settings.storage_dir, readonly=True)
+    assert status.get('1001').status == STATUS_LIVE
+    assert status.get('1004').status == STATUS_DELETED
+    assert status.get('1004').datestamp == '2024-01-01T00:00:00Z'
+    assert status.get('9999') is None
+
+
+def make_header(record_id: str, datestamp: str = '2024-01-01T00:00:00Z', deleted: bool = False) -> str:
+    status = ' status="deleted"' if deleted else ''
+    return f'<header{status}><identifier>oai:example:{record_id}</identifier><datestamp>{datestamp}</datestamp></header>'
+
+
+@pytest.fixture
+def reconcile_endpoint(monkeypatch):
+    headers = {
+        None: [make_header('1001'), make_header('1002', '2024-03-01T00:00:00Z')],
+        'ids2': [make_header('1003'), make_header('1004', deleted=True)],
+    }
+    requests = []
+
+    def harvest(self, **kwargs):
+        requests.append(kwargs)
+        if kwargs['verb'] == 'ListIdentifiers':
+            token = kwargs.get('resumptionToken')
+            next_token = '<resumptionToken>ids2</resumptionToken>' if token is None else '<resumptionToken/>'
+            content = (f'<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><ListIdentifiers>'
+                       f'{"".join(headers[token])}{next_token}</ListIdentifiers></OAI-PMH>').encode('utf-8')
+        else:
+            record_id = kwargs['identifier'].split(':')[-1]
+            content = (f'<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><GetRecord>'
+                       f'{make_record(record_id)}</GetRecord></OAI-PMH>').encode('utf-8')
+        return OAIResponse(http_response(content), params=kwargs)
+
+    monkeypatch.setattr(Sickle, 'harvest', harvest)
+    return requests
+
+
+def test_reconcile(reconcile_endpoint, provider: OaiPmh):
+    status = provider.extractors[0]
+    for record_id in ['1001', '1002', '1004', '1005']:
+        provider.store.put(record_id, b'<record/>')
+        status.upsert(record_id, XmlNode(etree.fromstring(b'<record/>'), MARC_NS), '2024-01-01T00:00:00Z')
+
+    summary = provider.reconcile(workers=2, max_orphaned=0.5)
+
+    # 1002 is stale, 1003 is missing, 1004 is deleted and 1005 is no longer on the server
+    assert (summary.listed, summary.missing, summary.stale, summary.deleted, summary.orphaned) == (4, 1, 1, 1, 1)
+    assert sorted(req['identifier'] for req in reconcile_endpoint if req['verb'] == 'GetRecord') == \
+        ['oai:example:1002', 'oai:example:1003']
+    assert stored_ids(provider.settings.storage_dir) == {'1001', '1002', '1003'}
+    assert b'Name 1002' in open_store(provider.settings.storage_dir).get('1002')
+    status = StatusIndex(provider.settings.storage_dir, readonly=True)
+    assert status.get('1005').status == STATUS_DELETED
+
+
+def test_reconcile_dry_run(reconcile_endpoint, provider: OaiPmh):
+    provider.store.put('1005', b'<record/>')
+
+    summary = provider.reconcile(dry_run=True)
+
+    assert (summary.missing, summary.orphaned) == (3, 1)
+    assert [req['verb'] for req in reconcile_endpoint] == ['ListIdentifiers', 'ListIdentifiers']
+    assert stored_ids(provider.settings.storage_dir) == {'1005'}
+
+
+def test_reconcile_refuses_to_delete_too_many_orphans(reconcile_endpoint, provider: OaiPmh):
+    for record_id in ['1001', '1005', '1006']:
+        provider.store.put(record_id, b'<record/>')
+
+    with pytest.raises(HarvestError, match='2 of 3 records'):
+        provider.reconcile()
+
+    assert [req['verb'] for req in reconcile_endpoint] == ['ListIdentifiers', 'ListIdentifiers']
+    assert stored_ids(provider.settings.storage_dir) == {'1001', '1005', '1006'}
+
+
+def test_reconcile_stops_when_nothing_is_listed(monkeypatch, provider: OaiPmh):
+    def list_identifiers(oai_set):
+        raise NoRecordsMatch('No records')
+
+    monkeypatch.setattr(provider, 'list_identifiers', list_identifiers)
+    provider.store.put('1001', b'<record/>')
+
+    with pytest.raises(NoRecordsMatch):
+        provider.reconcile(max_orphaned=1)
+
+    assert stored_ids(provider.settings.storage_dir) == {'1001'}
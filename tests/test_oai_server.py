@@ -0,0 +1,108 @@
+from pathlib import Path
+
+import pytest
+import requests
+from sickle import oaiexceptions
+
+from seiso.common import throttle
+from seiso.common.harvest_benchmark import run_benchmark
+from seiso.common.harvest_store import open_store
+from seiso.common.oai_server import MARCXCHANGE_NS, OaiServer, OaiServerSettings, synthetic_records
+from seiso.services import oai
+from seiso.services.oai import HarvestSummary, OaiPmh, OaiPmhSettings
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(throttle, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(oai, 'sleep', lambda seconds: None)
+
+
+def provider(url: str, storage_dir: Path) -> OaiPmh:
+    return OaiPmh(OaiPmhSettings(
+        endpoint=url,
+        metadata_prefix='marcxchange',
+        metadata_schema=MARCXCHANGE_NS,
+        storage_dir=storage_dir,
+    ))
+
+
+def test_harvest_from_local_server(tmp_path: Path):
+    records = synthetic_records(250, deleted_share=0.1)
+    live = {record.record_id for record in records if not record.deleted}
+
+    with OaiServer(records, OaiServerSettings(page_size=40)) as server:
+        provider(server.url, tmp_path).harvest()
+
+    assert set(open_store(tmp_path).ids()) == live
+    summary = HarvestSummary.load(tmp_path.joinpath('summary.json'))
+    assert (summary.fetched, summary.deleted) == (len(live), len(records) - len(live))
+    assert server.requests == 7
+
+
+def test_harvest_survives_injected_errors(tmp_path: Path, no_sleep):
+    records = synthetic_records(300, deleted_share=0)
+    settings = OaiServerSettings(page_size=25, error_rate=0.2, truncate_rate=0.2, seed=3)
+
+    with OaiServer(records, settings) as server:
+        harvester = provider(server.url, tmp_path)
+        harvester.harvest()
+
+    assert server.errors > 0
+    assert len(set(open_store(tmp_path).ids())) == 300
+    assert harvester.metrics.totals()['retries'] >= server.errors
+
+
+@pytest.mark.parametrize('store', ['files', 'segments'])
+def test_pipelined_harvest_survives_truncated_responses(tmp_path: Path, no_sleep, store: str):
+    records = synthetic_records(300, deleted_share=0)
+    settings = OaiServerSettings(page_size=25, truncate_rate=0.3, seed=3)
+
+    with OaiServer(records, settings) as server:
+        harvester = provider(server.url, tmp_path)
+        harvester.settings.store = store
+        OaiPmh(harvester.settings).harvest_pipelined(workers=2)
+
+    assert server.errors > 0
+    assert len(set(open_store(tmp_path).ids())) == 300
+
+
+def test_reconcile_survives_truncated_responses(tmp_path: Path, no_sleep):
+    records = synthetic_records(50, deleted_share=0)
+    settings = OaiServerSettings(page_size=25, truncate_rate=0.3, seed=5)
+
+    with OaiServer(records, settings) as server:
+        summary = provider(server.url, tmp_path).reconcile(workers=2)
+
+    assert server.errors > 0
+    assert (summary.fetched, summary.failed) == (50, 0)
+    assert len(set(open_store(tmp_path).ids())) == 50
+
+
+def test_resumption_tokens_expire(tmp_path: Path):
+    with OaiServer(synthetic_records(20), OaiServerSettings(page_size=5, token_expiry=0)) as server:
+        with pytest.raises(oaiexceptions.BadResumptionToken):
+            provider(server.url, tmp_path).harvest()
+
+
+def test_get_record_and_list_identifiers(tmp_path: Path):
+    records = synthetic_records(30, deleted_share=0)
+    with OaiServer(records, OaiServerSettings(page_size=7)) as server:
+        harvester = provider(server.url, tmp_path)
+        headers = list(harvester.list_identifiers())
+        record = harvester.get_record(harvester._sickle(), headers[3].identifier)
+        missing = requests.get(server.url, params={'verb': 'GetRecord', 'identifier': 'oai:example:0'})
+
+    assert [header.record_id for header in headers] == [record.record_id for record in records]
+    assert record.record_id == records[3].record_id
+    assert b'idDoesNotExist' in missing.content
+
+
+def test_benchmark(tmp_path: Path):
+    result = run_benchmark(synthetic_records(200), OaiServerSettings(page_size=50), method='pipelined',
+                           work_dir=tmp_path)
+
+    assert result.records + result.deleted == 200
+    assert result.records_per_sec > 0
+    assert result.cpu_time > 0
+    assert result.peak_rss_mb > 0
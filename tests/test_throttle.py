@@ -0,0 +1,142 @@
+from datetime import datetime, timedelta, timezone
+from time import monotonic
+from email.utils import format_datetime
+
+import pytest
+import requests
+
+from seiso.common import throttle as throttle_module
+from seiso.common.throttle import AdaptiveThrottle, RetriesExhausted, parse_retry_after
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(throttle_module, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(throttle_module, 'sleep', clock.sleep)
+    return clock
+
+
+def http_error(status: int, retry_after: str | None = None) -> requests.HTTPError:
+    response = requests.Response()
+    response.status_code = status
+    if retry_after is not None:
+        response.headers['Retry-After'] = retry_after
+    return requests.HTTPError(response=response)
+
+
+def flaky(*failures, result='ok', latency=0.0, clock=None):
+    """A request that raises the given exceptions in turn before succeeding."""
+    calls = []
+
+    def request(timeout):
+        calls.append(timeout)
+        if clock is not None:
+            clock.now += latency
+        if len(calls) <= len(failures):
+            raise failures[len(calls) - 1]
+        return result
+
+    request.calls = calls
+    return request
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('120') == 120
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('soon') is None
+    in_a_minute = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=60), usegmt=True)
+    assert 55 < parse_retry_after(in_a_minute) <= 60
+
+
+def test_honors_retry_after(clock):
+    request = flaky(http_error(503, '7'))
+    assert AdaptiveThrottle().call(request) == 'ok'
+    assert len(request.calls) == 2
+    assert clock.sleeps == [7]
+
+
+def test_exponential_backoff_with_jitter(clock):
+    request = flaky(requests.ConnectionError(), requests.ConnectionError(), requests.ConnectionError())
+    throttle = AdaptiveThrottle(base_delay=1.0)
+    assert throttle.call(request) == 'ok'
+    assert throttle.retries == 3
+    for attempt, delay in enumerate(clock.sleeps):
+        assert 0 <= delay <= 2 ** attempt
+
+
+def test_retries_responses_cut_off_halfway(clock):
+    request = flaky(requests.exceptions.ChunkedEncodingError(), requests.exceptions.ContentDecodingError())
+    assert AdaptiveThrottle().call(request) == 'ok'
+    assert len(request.calls) == 3
+
+
+def test_gives_up_after_max_retries(clock):
+    request = flaky(*[requests.Timeout()] * 5)
+    with pytest.raises(RetriesExhausted):
+        AdaptiveThrottle(max_retries=3).call(request)
+    assert len(request.calls) == 4
+
+
+def test_does_not_retry_client_errors(clock):
+    request = flaky(http_error(404))
+    with pytest.raises(requests.HTTPError):
+        AdaptiveThrottle().call(request)
+    assert len(request.calls) == 1
+
+
+def test_does_not_retry_http_errors_without_response(clock):
+    request = flaky(requests.HTTPError('No response'))
+    with pytest.raises(requests.HTTPError):
+        AdaptiveThrottle().call(request)
+    assert len(request.calls) == 1
+
+
+def test_overload_halves_concurrency_and_success_restores_it(clock):
+    throttle = AdaptiveThrottle(max_concurrency=8)
+    throttle.call(flaky(http_error(503, '1')))
+    assert 4 <= throttle.limit < 5
+    for _ in range(100):
+        throttle.call(flaky())
+    assert throttle.limit == 8
+
+
+def test_rising_latency_reduces_concurrency(clock):
+    throttle = AdaptiveThrottle(max_concurrency=8)
+    for _ in range(5):
+        throttle.call(flaky(latency=1.0, clock=clock))
+    assert throttle.limit == 8
+    for _ in range(20):
+        throttle.call(flaky(latency=5.0, clock=clock))
+    assert throttle.limit < 8
+
+
+def test_timeout_follows_latency(clock):
+    throttle = AdaptiveThrottle(initial_timeout=30, min_timeout=1, max_timeout=100)
+    request = flaky(latency=2.0, clock=clock)
+    throttle.call(request)
+    assert request.calls == [30]
+    for _ in range(20):
+        throttle.call(request)
+    assert 2 < throttle.timeout < 10
+
+
+def test_rate_limit_spaces_requests():
+    throttle = AdaptiveThrottle(rate_limit=50)
+    t0 = monotonic()
+    for _ in range(6):
+        throttle.call(flaky())
+    assert monotonic() - t0 >= 0.1